@@ -0,0 +1,308 @@
+"""
+Headless load generator for PeerServer and PeerClient.
+
+Starts a server (in this process, as a subprocess, or uses a running one),
+spawns simulated PeerClients spread over one or more processes and drives
+register, broadcast and direct-chat workloads. Reports messages/sec,
+p50/p99 latency, server memory per connection and thread counts, and writes
+everything as JSON so runs can be compared between commits.
+
+    python -m bench.loadgen --clients 1000 --procs 4 --workload register,broadcast
+    python -m bench.loadgen --engine asyncio --server subprocess --out result.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from client.core import PeerClient
+from client.ioloop import IOLoop
+
+MAX_SAMPLES = 100000  # latency samples kept per process and workload
+
+def _proc_status(pid=None):
+    """RSS in KiB and thread count of a process (Linux /proc, else this process only)."""
+    try:
+        with open(f"/proc/{pid or 'self'}/status") as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line)
+        return int(fields['VmRSS'].split()[0]), int(fields['Threads'])
+    except (OSError, KeyError, ValueError):
+        if pid is not None:
+            return None, None
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, threading.active_count()
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def _wait_for_port(port, timeout=10.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Server did not start on port {port}")
+
+def _percentile(samples, q):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return round(samples[min(len(samples) - 1, int(len(samples) * q))] * 1000.0, 3)  # ms
+
+class Samples:
+    """Thread-safe counter plus a bounded random sample of latencies."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.latencies = []
+        self.last = 0.0
+
+    def add(self, latency):
+        with self.lock:
+            self.count += 1
+            self.last = time.time()
+            if len(self.latencies) < MAX_SAMPLES:
+                self.latencies.append(latency)
+            else:
+                i = random.randrange(self.count)
+                if i < MAX_SAMPLES:
+                    self.latencies[i] = latency
+
+class Swarm:
+    """The simulated clients of one process."""
+
+    def __init__(self, port, index, count, first, protocol_version, chat_port_base):
+        self.port = port
+        self.index = index
+        self.clients = []
+        self.registered = Samples()
+        self.broadcasts = Samples()
+        self.chats = Samples()
+        self.errors = 0
+        self.loop = IOLoop()  # one I/O thread for all clients of this process
+        for n in range(first, first + count):
+            # The server expects a TCP port before registration completes
+            c = PeerClient('127.0.0.1', port, f"load{n}", 20000 + n % 20000, chat_port_base + n, protocol_version,
+                           loop=self.loop)
+            c.set_callbacks(**self._callbacks(c))
+            self.clients.append(c)
+
+    def _callbacks(self, client):
+        def on_info(msg):
+            if msg.startswith("Registered") and hasattr(client, 'started'):
+                self.registered.add(time.time() - client.started)
+        def on_broadcast(msg):
+            parts = msg.split(' ', 2)
+            if parts[0] == 'bench':
+                self.broadcasts.add(time.time() - float(parts[1]))
+        def on_peer_message(addr, msg):
+            parts = msg.split(' ', 2)
+            if parts[0] == 'bench':
+                self.chats.add(time.time() - float(parts[1]))
+        def on_chat_request(addr, nick, respond):
+            respond(True)
+        def on_error(msg):
+            self.errors += 1
+        return dict(on_info=on_info, on_broadcast=on_broadcast, on_peer_message=on_peer_message,
+                    on_chat_request=on_chat_request, on_error=on_error)
+
+    def register(self, timeout):
+        for c in self.clients:
+            c.started = time.time()
+            c.register()
+        _wait(lambda: self.registered.count >= len(self.clients), timeout)
+
+    def broadcast(self, senders, messages, payload):
+        for c in self.clients[:senders]:
+            for _ in range(messages):
+                c.send_broadcast(f"bench {time.time()!r} {payload}")
+
+    def chat(self, messages, payload, timeout):
+        # Pair neighbours: even clients open a direct connection to the next one
+        for c in self.clients:
+            c.start_peer_server(c.tcp_port)
+        time.sleep(0.2)
+        socks = []
+        for a, b in zip(self.clients[::2], self.clients[1::2]):
+            sock = a.send_tcp_to_peer('127.0.0.1', b.tcp_port)
+            if sock is not None:
+                socks.append((a, sock))
+        time.sleep(0.5)  # CHAT_ACCEPT round trip
+        for _ in range(messages):
+            for a, sock in socks:
+                a.send_message_to_peer(sock, f"bench {time.time()!r} {payload}")
+        _wait(lambda: self.chats.count >= len(socks) * messages, timeout)
+
+def _wait(done, timeout):
+    deadline = time.time() + timeout
+    while not done() and time.time() < deadline:
+        time.sleep(0.01)
+
+def _settle(samples, expected, timeout, idle=1.0):
+    """Wait until all expected messages arrived or nothing arrived for `idle` seconds."""
+    deadline = time.time() + timeout
+    while samples.count < expected and time.time() < deadline:
+        if samples.count and time.time() - samples.last > idle:
+            break
+        time.sleep(0.01)
+
+def _summary(samples, started):
+    elapsed = (samples.last - started) if samples.count else 0.0
+    return {
+        'messages': samples.count,
+        'seconds': round(elapsed, 3),
+        'latencies': samples.latencies,
+    }
+
+def _worker(args, index, first, count, total, barrier, results):
+    """Run one process worth of clients through the configured workloads."""
+    swarm = Swarm(args.port, index, count, first, args.protocol, args.chat_port_base)
+    report = {'clients': count}
+    started = time.time()
+    swarm.register(args.timeout)
+    report['register'] = _summary(swarm.registered, started)
+    barrier.wait()
+    if 'broadcast' in args.workload:
+        senders = min(args.senders, count) if index == 0 else 0
+        expected = args.senders * args.messages * total
+        started = time.time()
+        swarm.broadcast(senders, args.messages, 'x' * args.payload)
+        _settle(swarm.broadcasts, expected * count // total, args.timeout)
+        report['broadcast'] = _summary(swarm.broadcasts, started)
+        barrier.wait()
+    if 'chat' in args.workload:
+        started = time.time()
+        swarm.chat(args.messages, 'x' * args.payload, args.timeout)
+        report['chat'] = _summary(swarm.chats, started)
+        barrier.wait()
+    report['rss_kib'], report['threads'] = _proc_status()
+    report['errors'] = swarm.errors
+    results.put(report)
+    barrier.wait()  # keep connections open until every process has reported
+
+def _start_server(args):
+    """Returns (stop function, server pid or None for in-process)."""
+    if args.server == 'inproc':
+        if args.engine == 'asyncio':
+            from server.aio import AsyncPeerServer
+            server = AsyncPeerServer('127.0.0.1', args.port)
+        else:
+            from server.core import PeerServer
+            server = PeerServer('127.0.0.1', args.port)
+        server.input_thread = lambda: None
+        threading.Thread(target=server.start, daemon=True).start()
+        _wait_for_port(args.port)
+        return server.stop, None
+    if args.server == 'subprocess':
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        proc = subprocess.Popen([sys.executable, '-m', 'server.main', '-a', '127.0.0.1', '-p', str(args.port),
+                                 '-e', args.engine], cwd=root, stdin=subprocess.PIPE)
+        _wait_for_port(args.port)
+        return proc.kill, proc.pid
+    _wait_for_port(args.port)
+    return (lambda: None), None
+
+def _git_commit():
+    try:
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=root, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args):
+    if args.server != 'external':
+        args.port = args.port or _free_port()
+    stop, server_pid = _start_server(args)
+    try:
+        idle_rss, idle_threads = _proc_status(server_pid)
+        ctx = multiprocessing.get_context('fork' if hasattr(os, 'fork') else 'spawn')
+        barrier = ctx.Barrier(args.procs + 1)
+        results = ctx.Queue()
+        per_proc, extra = divmod(args.clients, args.procs)
+        procs, first = [], 0
+        for i in range(args.procs):
+            count = per_proc + (1 if i < extra else 0)
+            procs.append(ctx.Process(target=_worker, args=(args, i, first, count, args.clients, barrier, results)))
+            first += count
+        started = time.time()
+        for p in procs:
+            p.start()
+        phases = 1 + ('broadcast' in args.workload) + ('chat' in args.workload)
+        for _ in range(phases):
+            barrier.wait()
+        reports = [results.get(timeout=args.timeout * 4) for _ in procs]
+        loaded_rss, loaded_threads = _proc_status(server_pid)
+        barrier.wait()
+        for p in procs:
+            p.join()
+    finally:
+        stop()
+
+    out = {
+        'commit': _git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(started)),
+        'config': {k: v for k, v in vars(args).items() if k != 'out'},
+        'server': {'pid': server_pid, 'idle_rss_kib': idle_rss, 'loaded_rss_kib': loaded_rss,
+                   'idle_threads': idle_threads, 'loaded_threads': loaded_threads},
+        'errors': sum(r['errors'] for r in reports),
+    }
+    if server_pid is not None and loaded_rss is not None:
+        out['server']['rss_per_connection_kib'] = round((loaded_rss - idle_rss) / max(args.clients, 1), 2)
+    out['client_processes'] = [{'rss_kib': r['rss_kib'], 'threads': r['threads']} for r in reports]
+    for workload in ('register', 'broadcast', 'chat'):
+        parts = [r[workload] for r in reports if workload in r]
+        if not parts:
+            continue
+        latencies = [x for p in parts for x in p['latencies']]
+        messages = sum(p['messages'] for p in parts)
+        seconds = max(p['seconds'] for p in parts)
+        out[workload] = {
+            'messages': messages,
+            'seconds': seconds,
+            'messages_per_sec': round(messages / seconds, 1) if seconds else None,
+            'p50_ms': _percentile(latencies, 0.50),
+            'p99_ms': _percentile(latencies, 0.99),
+        }
+    return out
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless PeerChat load generator")
+    parser.add_argument("--clients", type=int, default=200, help="Simulated clients in total")
+    parser.add_argument("--procs", type=int, default=1, help="Processes the clients are spread over")
+    parser.add_argument("--workload", default="register,broadcast",
+                        help="Comma separated: register, broadcast, chat (register always runs)")
+    parser.add_argument("--senders", type=int, default=5, help="Clients sending broadcasts")
+    parser.add_argument("--messages", type=int, default=20, help="Messages per sender or chat pair")
+    parser.add_argument("--payload", type=int, default=32, help="Extra bytes per message")
+    parser.add_argument("--protocol", type=int, choices=(1, 2), default=2, help="Client protocol version")
+    parser.add_argument("--server", choices=("inproc", "subprocess", "external"), default="subprocess",
+                        help="Run the server in this process, as a subprocess, or use one on --port")
+    parser.add_argument("-e", "--engine", choices=("threads", "asyncio"), default="threads")
+    parser.add_argument("-p", "--port", type=int, default=0, help="Server port (default: a free port)")
+    parser.add_argument("--chat-port-base", type=int, default=30000,
+                        help="First peer TCP port (announced to the server, listened on for chat)")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Seconds to wait per phase")
+    parser.add_argument("-o", "--out", help="Write the JSON result to this file")
+    args = parser.parse_args()
+    args.workload = [w.strip() for w in args.workload.split(',') if w.strip()]
+
+    result = run(args)
+    text = json.dumps(result, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text + '\n')
+    print(text)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Registration throughput under concurrent broadcast.
+
+Compares the sharded copy-on-write Registry with a single dict behind one
+lock (the previous PeerServer.clients). Broadcaster threads repeatedly walk
+all clients and enqueue a frame for each, while registrar threads add and
+remove clients as fast as they can.
+
+    python -m bench.registry_contention --clients 5000 --broadcasters 4
+"""
+import argparse
+import threading
+import time
+from collections import deque
+from server.registry import Registry
+
+class LockedRegistry:
+    """One dict and one lock, copied under the lock for every broadcast."""
+
+    def __init__(self):
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    def add(self, nickname, entry):
+        with self.lock:
+            if nickname in self.clients:
+                return False
+            self.clients[nickname] = entry
+        return True
+
+    def remove(self, nickname, conn):
+        with self.lock:
+            if self.clients.get(nickname, (None,) * 4)[3] is not conn:
+                return False
+            del self.clients[nickname]
+        return True
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.clients.items())
+
+class FakeConn:
+    def __init__(self):
+        self.queue = deque(maxlen=64)
+
+    def send(self, frame, key=None):
+        self.queue.append(frame)
+
+def run(registry, clients, broadcasters, registrars, seconds):
+    for i in range(clients):
+        registry.add(f"idle{i}", ("127.0.0.1", 1, 2, FakeConn()))
+    stop = threading.Event()
+    counts = {'registrations': 0, 'broadcasts': 0}
+    latencies = []
+    count_lock = threading.Lock()
+
+    def broadcaster():
+        done = 0
+        while not stop.is_set():
+            for _, entry in registry.snapshot():
+                entry[3].send(b'frame')
+            done += 1
+        with count_lock:
+            counts['broadcasts'] += done
+
+    def registrar(n):
+        conn = FakeConn()
+        done = 0
+        samples = []
+        while not stop.is_set():
+            nickname = f"r{n}-{done}"
+            start = time.perf_counter()
+            registry.add(nickname, ("127.0.0.1", 1, 2, conn))
+            samples.append(time.perf_counter() - start)
+            registry.remove(nickname, conn)
+            done += 1
+        with count_lock:
+            counts['registrations'] += done
+            latencies.extend(samples)
+
+    threads = [threading.Thread(target=broadcaster) for _ in range(broadcasters)]
+    threads += [threading.Thread(target=registrar, args=(n,)) for n in range(registrars)]
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99)] * 1e6 if latencies else 0.0
+    return counts['registrations'] / seconds, p99, counts['broadcasts'] / seconds
+
+def main():
+    parser = argparse.ArgumentParser(description="Registry contention benchmark")
+    parser.add_argument("--clients", type=int, default=5000, help="Idle registered clients")
+    parser.add_argument("--broadcasters", type=int, default=4, help="Threads broadcasting in a loop")
+    parser.add_argument("--registrars", type=int, default=4, help="Threads registering and leaving")
+    parser.add_argument("--seconds", type=float, default=3.0, help="Duration per run")
+    args = parser.parse_args()
+
+    print(f"{args.clients} clients, {args.broadcasters} broadcasters, {args.registrars} registrars")
+    print(f"{'registry':<16}{'registrations/s':>18}{'p99 add (us)':>16}{'broadcasts/s':>16}")
+    for name, registry in (("single lock", LockedRegistry()), ("sharded", Registry())):
+        regs, p99, casts = run(registry, args.clients, args.broadcasters, args.registrars, args.seconds)
+        print(f"{name:<16}{regs:>18.0f}{p99:>16.1f}{casts:>16.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,244 @@
-from network.tcp import send_message, recv_message
-from network.udp import listen_for_udp
+from network.tcp import send_message, FramedReader, decode_frame, MAX_FRAME_SIZE
+from network.stream import FrameWriter, StreamReceiver, chunks_of, MAX_MESSAGE
 import network.protocol as prot
+from network.udp import UdpTransport
+from network.rudp import ReliableUdp, RUDP_MAGIC
+from client.ioloop import IOLoop
+from client.discovery import LanDiscovery
+from client.transfer import FileSender, FileReceiver, valid_offer
+from client.tracing import Tracer
+import os
 import socket
 import threading
+import time
+import weakref
+from collections import OrderedDict
+
+class PooledPeer:
+    __slots__ = ('nickname', 'addr', 'sock', 'last_used', 'last_seen', 'chat_open', 'keepalive')
+
+    def __init__(self, nickname, addr, sock):
+        self.nickname = nickname
+        self.addr = addr
+        self.sock = sock
+        self.last_used = self.last_seen = time.monotonic()
+        self.chat_open = False   # CHAT_REQUEST sent and not closed since
+        self.keepalive = False   # the peer announced FLAG_KEEPALIVE
+
+class PeerPool:
+    """Outgoing peer connections keyed by nickname, reused across chats.
+
+    Closing a chat keeps its connection, so reopening it only sends a new
+    CHAT_REQUEST. Peers that announced FLAG_KEEPALIVE get a PING after
+    `keepalive` quiet seconds and are dropped after three silent intervals.
+    Above `limit` connections the least recently used one without an open
+    chat is closed, as is any that stayed unused for `idle_timeout`.
+    """
+
+    def __init__(self, client, limit: int = 16, keepalive: float = 15.0, idle_timeout: float = 600.0,
+                 prewarm: int = 4):
+        self.client = client
+        self.limit = limit
+        self.keepalive = keepalive
+        self.idle_timeout = idle_timeout
+        self.prewarm_count = prewarm
+        self.peers = OrderedDict()  # nickname -> PooledPeer, least recently used first
+        self.by_sock = {}
+        self.recent = OrderedDict()  # nicknames chatted with, most recent last
+        self.warming = set()  # nicknames a pre-warm thread is connecting to
+        self.lock = threading.Lock()
+        self.timer = None
+
+    def __contains__(self, nickname):
+        return nickname in self.peers
+
+    def connect(self, nickname, announce: bool = True):
+        """Return the pooled connection to nickname, opening one if needed (blocking connect).
+
+        A connection opened with announce=False (pre-warming) is not a chat:
+        it stays out of client.peer_socks until chat_with sends CHAT_REQUEST on it.
+        """
+        with self.lock:
+            entry = self.peers.get(nickname)
+            if entry is not None:
+                self.peers.move_to_end(nickname)
+                entry.last_used = time.monotonic()
+                return entry
+        info = self.client.peers.get(nickname)
+        if not info:
+            return None
+        addr = (info[0], info[2])
+        sock = self.client._open_peer(addr, announce)
+        if sock is None:
+            return None
+        entry = PooledPeer(nickname, addr, sock)
+        with self.lock:
+            old = self.peers.pop(nickname, None)
+            self.peers[nickname] = entry
+            self.by_sock[sock] = entry
+            evicted = self._evict()
+            if self.timer is None:
+                self.timer = self.client.loop.call_later(self.keepalive, self._tick)
+        for stale in evicted + ([old] if old is not None else []):
+            self._close(stale)
+        return entry
+
+    def use(self, nickname):
+        """Remember nickname as recently used (for pre-warming)."""
+        self.recent.pop(nickname, None)
+        self.recent[nickname] = None
+        while len(self.recent) > self.limit:
+            self.recent.popitem(last=False)
+
+    def seen(self, sock):
+        entry = self.by_sock.get(sock)
+        if entry is not None:
+            entry.last_seen = time.monotonic()
+
+    def accepted(self, sock, caps):
+        entry = self.by_sock.get(sock)
+        if entry is not None:
+            entry.keepalive = bool(caps and caps & prot.FLAG_KEEPALIVE)
+
+    def release(self, sock) -> bool:
+        """The chat on sock was closed. Returns False if sock is not pooled."""
+        entry = self.by_sock.get(sock)
+        if entry is None:
+            return False
+        entry.chat_open = False
+        entry.last_used = time.monotonic()
+        return True
+
+    def discard(self, sock):
+        with self.lock:
+            entry = self.by_sock.pop(sock, None)
+            if entry is not None and self.peers.get(entry.nickname) is entry:
+                del self.peers[entry.nickname]
+
+    def _evict(self):
+        """Remove least recently used idle connections above the limit (lock held)."""
+        evicted = []
+        for nickname, entry in list(self.peers.items()):
+            if len(self.peers) <= self.limit:
+                break
+            if not entry.chat_open:
+                del self.peers[nickname]
+                self.by_sock.pop(entry.sock, None)
+                evicted.append(entry)
+        return evicted
+
+    def _close(self, entry):
+        self.client._forget_sock(entry.addr, entry.sock)
+        self.client.loop.call_soon(self.client._close_sock, entry.sock)
+
+    def _tick(self):
+        """Keepalive and idle check, every `keepalive` seconds on the I/O loop."""
+        now = time.monotonic()
+        dead, idle, ping = [], [], []
+        with self.lock:
+            for entry in self.peers.values():
+                if not entry.chat_open and now - entry.last_used > self.idle_timeout:
+                    idle.append(entry)
+                elif entry.keepalive and now - entry.last_seen > 3 * self.keepalive:
+                    dead.append(entry)
+                elif entry.keepalive and now - entry.last_seen >= self.keepalive:
+                    ping.append(entry)
+            for entry in idle:
+                del self.peers[entry.nickname]
+                self.by_sock.pop(entry.sock, None)
+            self.timer = self.client.loop.call_later(self.keepalive, self._tick) if self.peers else None
+        for entry in idle:
+            self._close(entry)
+        for entry in dead:
+            self.client._drop_peer(entry.addr, entry.sock)
+        for entry in ping:
+            try:
+                self.client._send_peer(entry.sock, prot.OP_PING)
+            except OSError:
+                self.client._drop_peer(entry.addr, entry.sock)
+
+    def prewarm(self):
+        """Open connections to recently used peers that are online, in the background."""
+        with self.lock:
+            wanted = [n for n in reversed(self.recent)
+                      if n in self.client.peers and n not in self.peers and n not in self.warming]
+            wanted = wanted[:max(0, min(self.prewarm_count, self.limit - len(self.peers) - len(self.warming)))]
+            self.warming.update(wanted)
+        def warm():
+            for nickname in wanted:
+                self.connect(nickname, announce=False)
+                self.warming.discard(nickname)
+        if wanted:
+            threading.Thread(target=warm, daemon=True).start()
 
 class PeerClient:
-    def __init__(self, server_ip, server_port, nickname, udp_port, tcp_port=None):
+    def __init__(self, server_ip, server_port, nickname, udp_port, tcp_port=None,
+                 protocol_version=prot.PROTOCOL_V2, loop=None):
         self.server_ip = server_ip
         self.server_port = server_port
         self.nickname = nickname
         self.udp_port = udp_port
         self.tcp_port = tcp_port
+        self.protocol_version = protocol_version  # highest version we speak
+        self.server_version = None  # negotiated with the server at REGISTER time
         self.running = True
         self.lock = threading.Lock()
         self.peer_socks = {}  # addr -> socket
         self.peer_nicknames = {}  # addr -> nickname
+        self.sock_versions = {}  # socket -> protocol version used when sending on it
+        self.writers = weakref.WeakKeyDictionary()  # socket -> FrameWriter
+        self.writers_lock = threading.Lock()  # separate from self.lock, which callers of _send_peer may hold
+        self.streams = {}  # socket -> StreamReceiver for the STREAM frames arriving on it
+        self.stream_consumers = {}  # opcode -> fn(addr) returning a generator fed the chunks of a streamed message
+        self.max_frame = MAX_FRAME_SIZE  # largest frame accepted from the server or a peer
+        self.max_message = MAX_MESSAGE   # largest streamed message reassembled in memory
+        self.stream_threshold = 64 * 1024  # chat messages longer than this (in bytes) are streamed to v2 peers
+        self.max_server_frame = 1024 * 1024  # largest frame we send the server (its default --max-frame)
         self.callbacks = {}
         self.server_sock = None
-        self.server_listener_thread = None
+        self.loop = loop  # IOLoop serving all our sockets; may be shared, else created on first use
         self.peers = {}  # nickname -> (ip, udp_port, tcp_port)
+        self.peer_versions = {}  # nickname -> protocol version announced by the server
+        self.peer_flags = {}  # nickname -> JOINED flags
+        self.rooms = {}  # room -> set of member nicknames, for the rooms we joined
+        self.roster_epoch = None  # server roster version that self.peers reflects
+        self.roster_version = None
+        self.store = None  # optional client.store.MessageLog that chat messages are written to
+        self.pool = PeerPool(self)
+        self.udp = None  # UdpTransport bound to udp_port, once start_udp_listener ran
+        self.discovery = None  # LanDiscovery, once start_discovery ran
+        self.rudp = None  # reliable UDP chat channels on udp_port, once start_udp_listener ran
+        self.udp_chats = False  # open new chats over reliable UDP with peers that support it
+        self.download_dir = os.path.join(os.path.expanduser("~"), ".peerchat", "files")
+        self.unannounced = set()  # accepted sockets whose first message (chat or file transfer) is pending
+        self.tracer = None  # client.tracing.Tracer, once enable_tracing ran
+        # Message handlers keyed by opcode, one table per link type
+        self.server_dispatcher = prot.Dispatcher()
+        for op, handler in ((prot.OP_WELCOME, self._on_welcome),
+                            (prot.OP_NICKNAME_TAKEN, self._on_nickname_taken),
+                            (prot.OP_ERROR, self._on_server_error),
+                            (prot.OP_JOINED, self._on_joined),
+                            (prot.OP_LEFT, self._on_left),
+                            (prot.OP_BROADCAST, self._on_broadcast),
+                            (prot.OP_PORT, self._on_port),
+                            (prot.OP_ROSTER, self._on_roster),
+                            (prot.OP_ROSTER_DELTA, self._on_roster_delta),
+                            (prot.OP_ROOM_JOIN, self._on_room_join),
+                            (prot.OP_ROOM_PART, self._on_room_part),
+                            (prot.OP_ROOM_MSG, self._on_room_msg)):
+            self.server_dispatcher.register(op, handler)
+        self.peer_dispatcher = prot.Dispatcher(default=self._on_unknown_peer_message)
+        for op, handler in ((prot.OP_CHAT_REQUEST, self._on_chat_request),
+                            (prot.OP_CHAT_ACCEPT, self._on_chat_accept),
+                            (prot.OP_CHAT_REJECT, self._on_chat_reject),
+                            (prot.OP_LEFT_CHAT, self._on_left_chat),
+                            (prot.OP_CHAT_MSG, self._on_chat_msg),
+                            (prot.OP_PING, self._on_ping),
+                            (prot.OP_STREAM, self._on_stream),
+                            (prot.OP_PONG, lambda addr, sock, record: None),  # any frame counts as alive
+                            (prot.OP_ERROR, self._on_peer_error),
+                            (prot.OP_MALFORMED, self._on_malformed_peer_message)):
+            self.peer_dispatcher.register(op, handler)
 
     def set_callbacks(self, **kwargs):
         self.callbacks = kwargs
@@ -28,229 +248,647 @@ class PeerClient:
         if cb:
             cb(*args, **kwargs)
 
+    def enable_tracing(self, threshold: float = 0.05, on_slow=None) -> Tracer:
+        """Time receiving, parsing, every message handler and every callback from now on.
+
+        Methods are replaced by timed wrappers on this instance only, so an
+        untraced client pays nothing. Returns the Tracer (see client.tracing).
+        """
+        if self.tracer is not None:
+            return self.tracer
+        tracer = self.tracer = Tracer(threshold, on_slow)
+        for name, span in (('_on_server_readable', 'server'), ('_on_peer_readable', 'peer'),
+                           ('_read_frames', 'recv'), ('_parse', 'parse'),
+                           ('_handle_peer_message', 'handle_peer_message'),
+                           ('_on_rudp_message', 'rudp_message')):
+            setattr(self, name, tracer.wrap(span, getattr(self, name)))
+        for prefix, dispatcher in (('server', self.server_dispatcher), ('peer', self.peer_dispatcher)):
+            for op, handler in dispatcher.handlers.items():
+                label = handler.__name__ if handler.__name__ != '<lambda>' else prot.OP_NAMES.get(op, op)
+                dispatcher.handlers[op] = tracer.wrap(f"{prefix}:{label}", handler)
+            if dispatcher.default is not None:
+                dispatcher.default = tracer.wrap(f"{prefix}:{dispatcher.default.__name__}", dispatcher.default)
+        if self.rudp is not None:
+            self.rudp.on_message = self._on_rudp_message
+        cb = self._cb
+        self._cb = lambda name, *args, **kwargs: tracer.call(f"cb:{name}", cb, name, *args, **kwargs)
+        return tracer
+
+    def _read_frames(self, reader):
+        return reader.read_frames()
+
+    def _parse(self, msg):
+        return prot.parse(msg)
+
+    def _io(self):
+        with self.lock:
+            if self.loop is None:
+                self.loop = IOLoop()
+        return self.loop.start()
+
+    def _registered_info(self):
+        self._cb('on_info', f"Registered with server {self.server_ip}:{self.server_port} as {self.nickname} on UDP port {self.udp_port} and TCP port {self.tcp_port}")
+
     def register(self):
         try:
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             sock.connect((self.server_ip, self.server_port))
-            send_message(sock, f"REGISTER {self.nickname} {self.udp_port}")
-            if self.tcp_port:
-                send_message(sock, prot.make_port(self.nickname, self.tcp_port))
+            if self.protocol_version >= prot.PROTOCOL_V2 and self.server_version != prot.PROTOCOL_V1:
+                # Binary REGISTER carries the TCP port; old servers answer with a text ERROR.
+                # With a known roster version the server only sends what changed since.
+                since = (self.roster_epoch, self.roster_version) if self.roster_epoch is not None else ()
+                sock.sendall(prot.encode(prot.PROTOCOL_V2, prot.OP_REGISTER, self.nickname,
+                                         self.udp_port, self.tcp_port or 0,
+                                         prot.FLAG_V2 | prot.FLAG_ROSTER | prot.FLAG_DATAGRAM, *since))
+            else:
+                self.server_version = prot.PROTOCOL_V1
+                send_message(sock, prot.make_register(self.nickname, self.udp_port))
+                if self.tcp_port:
+                    send_message(sock, prot.make_port(self.nickname, self.tcp_port))
+                self._registered_info()
             self.server_sock = sock
-            self._cb('on_info', f"Registered with server {self.server_ip}:{self.server_port} as {self.nickname} on UDP port {self.udp_port} and TCP port {self.tcp_port}")
-            self.server_listener_thread = threading.Thread(target=self._listen_to_server, daemon=True)
-            self.server_listener_thread.start()
+            reader = FramedReader(sock, max_frame=self.max_frame)
+            self._io().add_reader(sock, lambda: self._on_server_readable(sock, reader))
         except Exception as e:
             self._cb('on_error', f"Failed to register with server: {e}")
 
-    def _listen_to_server(self):
-        sock = self.server_sock
+    def _on_server_readable(self, sock, reader):
+        fallback = False
         try:
-            while self.running:
-                msg = recv_message(sock)
+            for msg in self._read_frames(reader):
                 if not msg:
                     break
-                if prot.is_nickname_taken(msg):
-                    self._cb('on_nickname_taken')
+                record = self._parse(msg)
+                if record.op == prot.OP_ERROR and self.server_version is None and isinstance(msg, str):
+                    # The server does not understand v2; register again in text
+                    fallback = True
                     break
-                elif prot.is_error(msg):
-                    self._cb('on_error', prot.parse_error(msg))
+                if self.server_dispatcher.dispatch(record) is False:
                     break
-                elif msg.startswith("JOINED "):
-                    parts = msg.strip().split()
-                    if len(parts) == 5:
-                        nickname, ip, udp_port, tcp_port = parts[1], parts[2], int(parts[3]), int(parts[4])
-                        self.peers[nickname] = (ip, udp_port, tcp_port)
-                        self._cb('on_peer_joined', nickname, ip, udp_port)
-                elif msg.startswith("LEFT "):
-                    parts = msg.strip().split()
-                    if len(parts) == 2:
-                        nickname = parts[1]
-                        if nickname in self.peers:
-                            del self.peers[nickname]
-                        self._cb('on_peer_left_server', nickname)
-                elif msg.startswith("BROADCAST "):
-                    self._cb('on_broadcast', msg[len("BROADCAST "):])
-                elif msg.startswith("PORT "):
-                    port_info = prot.parse_port(msg)
-                    if port_info:
-                        nickname, tcp_port = port_info
-                        if nickname in self.peers:
-                            ip, udp_port, _ = self.peers[nickname]
-                            self.peers[nickname] = (ip, udp_port, tcp_port)
+            else:
+                if self.running:
+                    return  # keep listening
         except Exception as e:
             self._cb('on_error', f"Lost connection to server: {e}")
-        finally:
+        self.loop.remove_reader(sock)
+        try:
+            sock.close()
+        except:
+            pass
+        if fallback:
+            self.server_version = prot.PROTOCOL_V1
+            self.register()
+
+    # --- Server message handlers (return False to stop listening) ---
+    def _on_welcome(self, record):
+        self.server_version = prot.PROTOCOL_V2
+        self._registered_info()
+
+    def _on_nickname_taken(self, record):
+        self._cb('on_nickname_taken')
+        return False
+
+    def _on_server_error(self, record):
+        self._cb('on_error', record.reason)
+        # After the handshake errors (e.g. the broadcast rate limit) are not fatal;
+        # the server closes the connection itself when they are
+        if self.server_version is None:
+            return False
+
+    def _on_joined(self, record):
+        if record.nickname == self.nickname:
+            return
+        self.peers[record.nickname] = (record.ip, record.udp_port, record.tcp_port)
+        v2 = record.flags and record.flags & prot.FLAG_V2
+        self.peer_versions[record.nickname] = prot.PROTOCOL_V2 if v2 else prot.PROTOCOL_V1
+        self.peer_flags[record.nickname] = record.flags or 0
+        self._cb('on_peer_joined', record.nickname, record.ip, record.udp_port)
+        if record.nickname in self.pool.recent:
+            self.pool.prewarm()
+
+    def _on_left(self, record):
+        nickname = record.nickname
+        if nickname in self.peers:
+            del self.peers[nickname]
+        self.peer_versions.pop(nickname, None)
+        self.peer_flags.pop(nickname, None)
+        self._cb('on_peer_left_server', nickname)
+
+    def _on_broadcast(self, record):
+        self._cb('on_broadcast', record.message)
+
+    def _on_room_join(self, record):
+        self.rooms.setdefault(record.room, set()).add(record.nickname)
+        self._cb('on_room_joined', record.room, record.nickname)
+
+    def _on_room_part(self, record):
+        if record.nickname == self.nickname:
+            self.rooms.pop(record.room, None)
+        elif record.room in self.rooms:
+            self.rooms[record.room].discard(record.nickname)
+        self._cb('on_room_left', record.room, record.nickname)
+
+    def _on_room_msg(self, record):
+        self._cb('on_room_message', record.room, record.nickname, record.message)
+
+    def _on_port(self, record):
+        if record.nickname in self.peers:
+            ip, udp_port, _ = self.peers[record.nickname]
+            self.peers[record.nickname] = (ip, udp_port, record.tcp_port)
+
+    def _on_roster(self, record):
+        """Full roster: replace the peer list, reporting only what changed."""
+        entries = {entry[0]: entry for entry in record.entries}
+        for nickname in list(self.peers):
+            if nickname not in entries and not (self.discovery and nickname in self.discovery.added):
+                self._on_left(prot.Left(nickname))
+        for nickname, entry in entries.items():
+            ip, udp_port, tcp_port = entry[1:4]
+            if self.peers.get(nickname) != (ip, udp_port, tcp_port):
+                self._on_joined(prot.Joined(*entry))
+        self.roster_epoch, self.roster_version = record.epoch, record.version
+
+    def _on_roster_delta(self, record):
+        if record.epoch != self.roster_epoch or record.base != self.roster_version:
+            if record.epoch == self.roster_epoch and record.version <= self.roster_version:
+                return  # already covered by a newer roster
+            # Missed an update (e.g. dropped while we were slow): ask for a resync
+            self.server_sock.sendall(prot.encode(prot.PROTOCOL_V2, prot.OP_SYNC,
+                                                 self.roster_epoch or 0, self.roster_version or 0))
+            return
+        for change in record.changes:
+            kind, fields = change[0], change[1:]
+            if kind == prot.CHANGE_JOIN:
+                if self.peers.get(fields[0]) != tuple(fields[1:4]):
+                    self._on_joined(prot.Joined(*fields))
+            elif kind == prot.CHANGE_LEAVE:
+                if fields[0] in self.peers:
+                    self._on_left(prot.Left(*fields))
+            else:
+                self._on_port(prot.Port(*fields))
+        self.roster_version = record.version
+
+    def _send_peer(self, sock, op, *fields):
+        """Send a peer message in the protocol version used on this socket."""
+        self._writer(sock).send(prot.encode(self.sock_versions.get(sock, prot.PROTOCOL_V1), op, *fields))
+
+    def _writer(self, sock) -> FrameWriter:
+        with self.writers_lock:
+            writer = self.writers.get(sock)
+            if writer is None:
+                writer = self.writers[sock] = FrameWriter(sock)
+            return writer
+
+    def _peer_version(self, peer_ip, peer_port):
+        """Protocol version to open a connection with, based on the server roster."""
+        if self.protocol_version < prot.PROTOCOL_V2:
+            return prot.PROTOCOL_V1
+        for nickname, (ip, _, tcp_port) in list(self.peers.items()):
+            if ip == peer_ip and tcp_port == peer_port:
+                return self.peer_versions.get(nickname, prot.PROTOCOL_V1)
+        return prot.PROTOCOL_V1
+
+    def _forget_sock(self, addr, sock):
+        with self.lock:
+            if self.peer_socks.get(addr) is sock:
+                self.peer_socks.pop(addr, None)
+            self.sock_versions.pop(sock, None)
+            self.unannounced.discard(sock)
+            receiver = self.streams.pop(sock, None)
+        if receiver is not None:
+            receiver.close()
+
+    def _watch_peer(self, sock, addr, error_prefix):
+        reader = FramedReader(sock, max_frame=self.max_frame)
+        self._io().add_reader(sock, lambda: self._on_peer_readable(sock, addr, reader, error_prefix))
+
+    def _on_peer_readable(self, sock, addr, reader, error_prefix):
+        self.pool.seen(sock)
+        try:
+            for msg in self._read_frames(reader):
+                if not msg:
+                    break
+                self._handle_peer_message(addr, msg, sock)
+            else:
+                return  # keep listening
+        except Exception as e:
+            if not (isinstance(e, OSError) and (getattr(e, 'winerror', None) == 10054 or '10054' in str(e))):
+                self._cb('on_error', f"{error_prefix}{e}")
+        self._drop_peer(addr, sock)
+
+    def _drop_peer(self, addr, sock):
+        """Tell the peer we left, close the connection and report it (on the loop thread)."""
+        self.loop.remove_reader(sock)
+        self.pool.discard(sock)
+        announced = self.peer_socks.get(addr) is sock  # not a pre-warmed or unannounced connection
+        if announced:
             try:
-                sock.close()
+                self._send_peer(sock, prot.OP_LEFT_CHAT, self.nickname)
             except:
                 pass
+        sock.close()
+        self._forget_sock(addr, sock)
+        if announced:
+            self._cb('on_peer_disconnected', addr)
+
+    def _close_sock(self, sock):
+        self.loop.remove_reader(sock)
+        sock.close()
+        receiver = self.streams.pop(sock, None)
+        if receiver is not None:
+            receiver.close()
 
     def start_peer_server(self, tcp_port):
-        def handle_peer(conn, addr):
-            def receive_messages():
-                try:
-                    while True:
-                        msg = recv_message(conn)
-                        if not msg:
-                            break
-                        self._handle_peer_message(addr, msg, conn)
-                except Exception as e:
-                    if not (isinstance(e, OSError) and (getattr(e, 'winerror', None) == 10054 or '10054' in str(e))):
-                        self._cb('on_error', f"Peer connection error: {e}")
-                finally:
-                    try:
-                        send_message(conn, prot.make_left_chat(self.nickname))
-                    except:
-                        pass
-                    conn.close()
-                    with self.lock:
-                        self.peer_socks.pop(addr, None)
-                    self._cb('on_peer_disconnected', addr)
-            threading.Thread(target=receive_messages, daemon=True).start()
-            with self.lock:
-                self.peer_socks[addr] = conn
-            self._cb('on_peer_connected', addr)
-        def tcp_server():
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
-                server_socket.bind(('', tcp_port))
-                server_socket.listen()
-                self._cb('on_info', f"Peer server listening on TCP port {tcp_port}...")
-                while True:
-                    conn, addr = server_socket.accept()
-                    threading.Thread(target=handle_peer, args=(conn, addr)).start()
-        threading.Thread(target=tcp_server, daemon=True).start()
+        """Listen for peer connections; returns right away, the I/O loop accepts them."""
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            server_socket.bind(('', tcp_port))
+            server_socket.listen()
+            server_socket.setblocking(False)
+        except OSError as e:
+            server_socket.close()
+            self._cb('on_error', f"Failed to start peer server on TCP port {tcp_port}: {e}")
+            return
+        self._io().add_reader(server_socket, lambda: self._accept_peer(server_socket))
+        self._cb('on_info', f"Peer server listening on TCP port {tcp_port}...")
 
-    def send_tcp_to_peer(self, peer_ip, peer_port):
-        addr = (peer_ip, peer_port)
+    def _accept_peer(self, server_socket):
+        try:
+            conn, addr = server_socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        conn.setblocking(True)  # sends stay blocking; reads only happen once readable
+        with self.lock:
+            self.unannounced.add(conn)  # entered in peer_socks once it turns out not to be a file transfer
+        self._watch_peer(conn, addr, "Peer connection error: ")
+
+    def _open_peer(self, addr, announce: bool = True):
+        """Connect to a peer and start reading from it. Returns the socket or None.
+
+        Only an announced connection is entered in peer_socks and reported.
+        """
         try:
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             sock.connect(addr)
             with self.lock:
-                self.peer_socks[addr] = sock
-            def receive_messages():
-                try:
-                    while True:
-                        msg = recv_message(sock)
-                        if not msg:
-                            break
-                        self._handle_peer_message(addr, msg, sock)
-                except Exception as e:
-                    if not (isinstance(e, OSError) and (getattr(e, 'winerror', None) == 10054 or '10054' in str(e))):
-                        self._cb('on_error', f"[Connection closed] {e}")
-                finally:
-                    try:
-                        send_message(sock, prot.make_left_chat(self.nickname))
-                    except:
-                        pass
-                    sock.close()
-                    with self.lock:
-                        self.peer_socks.pop(addr, None)
-                    self._cb('on_peer_disconnected', addr)
-            threading.Thread(target=receive_messages, daemon=True).start()
-            self._cb('on_peer_connected', addr)
-            send_message(sock, prot.make_chat_request(self.nickname))
+                self.sock_versions[sock] = self._peer_version(*addr)
+            self._watch_peer(sock, addr, "[Connection closed] ")
+            if announce:
+                self._announce_peer(addr, sock)
             return sock
         except Exception as e:
             self._cb('on_error', f"Failed to connect to peer: {e}")
             return None
 
+    def _announce_peer(self, addr, sock):
+        """Enter sock in peer_socks as the chat connection to addr and report it."""
+        with self.lock:
+            if self.peer_socks.get(addr) is sock:
+                return
+            self.peer_socks[addr] = sock
+        self._cb('on_peer_connected', addr)
+
+    def send_tcp_to_peer(self, peer_ip, peer_port):
+        sock = self._open_peer((peer_ip, peer_port))
+        if sock is not None:
+            try:
+                self._send_peer(sock, prot.OP_CHAT_REQUEST, self.nickname, prot.FLAG_KEEPALIVE)
+            except Exception as e:
+                self._cb('on_error', f"Failed to connect to peer: {e}")
+                return None
+        return sock
+
+    def chat_with(self, nickname):
+        """Open a chat with a peer from the roster, reusing a pooled connection.
+
+        Returns the peer address, or None if the peer cannot be reached.
+        """
+        if self.udp_chats and self.rudp is not None and self.peer_flags.get(nickname, 0) & prot.FLAG_DATAGRAM:
+            return self._chat_over_udp(nickname)
+        self.pool.use(nickname)
+        for _ in range(2):  # a pooled connection may have died unnoticed: retry once with a new one
+            entry = self.pool.connect(nickname)
+            if entry is None:
+                return None
+            if entry.chat_open:
+                return entry.addr
+            self._announce_peer(entry.addr, entry.sock)  # e.g. a pre-warmed connection
+            try:
+                self._send_peer(entry.sock, prot.OP_CHAT_REQUEST, self.nickname, prot.FLAG_KEEPALIVE)
+            except OSError:
+                self.pool.discard(entry.sock)
+                self._forget_sock(entry.addr, entry.sock)
+                self.loop.call_soon(self._close_sock, entry.sock)
+                continue
+            entry.chat_open = True
+            return entry.addr
+        return None
+
+    def _chat_over_udp(self, nickname):
+        """Send CHAT_REQUEST on a reliable UDP channel to the peer's UDP port."""
+        peer = self.peers.get(nickname)
+        if peer is None:
+            return None
+        addr = (peer[0], peer[1])
+        channel = self.rudp.channel(addr)
+        self._add_channel(addr, channel)
+        try:
+            self._send_peer(channel, prot.OP_CHAT_REQUEST, self.nickname, 0)
+        except OSError as e:
+            self._cb('on_error', f"Failed to connect to peer: {e}")
+            return None
+        return addr
+
+    def _add_channel(self, addr, channel):
+        """Treat a reliable UDP channel like a peer socket."""
+        with self.lock:
+            if self.peer_socks.get(addr) is channel:
+                return
+            self.peer_socks[addr] = channel
+            self.sock_versions[channel] = prot.PROTOCOL_V2
+        self._cb('on_peer_connected', addr)
+
+    def _on_rudp_message(self, addr, channel, data):
+        self._add_channel(addr, channel)
+        try:
+            msg = decode_frame(data)
+        except ValueError:
+            msg = data  # parses as Malformed/Unknown and gets an ERROR reply
+        self._handle_peer_message(addr, msg, channel)
+
+    def _on_rudp_closed(self, addr, channel, reason):
+        if reason:
+            self._cb('on_info', f"[UDP chat with {self.get_peer_nickname(addr)} closed] {reason}")
+        if self.peer_socks.get(addr) is channel:
+            self._forget_sock(addr, channel)
+            self._cb('on_peer_disconnected', addr)
+
     def send_message_to_peer(self, sock, msg):
+        data = msg.encode()
+        version = self.sock_versions.get(sock, prot.PROTOCOL_V1)
+        if len(data) > self.stream_threshold and version >= prot.PROTOCOL_V2:
+            # Streamed from its own thread, so the caller (the Tk thread) does not wait for the network
+            threading.Thread(target=self._stream_message, args=(sock, msg, data), daemon=True).start()
+            return
+        # A v1 peer gets the whole message in one frame, up to the frame size it accepts
+        frame = prot.encode(version, prot.OP_CHAT_MSG, self.nickname, msg)
+        if len(frame) > self.max_frame:
+            self._cb('on_error', f"Message too long for this peer ({len(data)} bytes, "
+                                 f"at most {self.max_frame} without protocol v2)")
+            return
         try:
-            send_message(sock, prot.make_chat_msg(self.nickname, msg))
+            self._writer(sock).send(frame)
         except Exception as e:
             self._cb('on_error', f"Failed to send message: {e}")
+            return
+        self._store_own_message(sock, msg)
+
+    def _stream_message(self, sock, msg, data):
+        try:
+            self._writer(sock).send_stream(prot.OP_CHAT_MSG, chunks_of(data))
+        except Exception as e:
+            self._cb('on_error', f"Failed to send message: {e}")
+            return
+        self._store_own_message(sock, msg)
+
+    def _store_own_message(self, sock, msg):
+        if self.store is not None:
+            addr = next((a for a, s in list(self.peer_socks.items()) if s is sock), None)
+            if addr is not None:
+                self.store.append(self.get_peer_nickname(addr), self.nickname, msg)
 
     def close_chat(self, addr):
         with self.lock:
             sock = self.peer_socks.get(addr)
-            if sock:
+            if sock and self.pool.release(sock):
+                # Keep pooled connections open for the next chat with this peer, but
+                # not as a chat: the next one starts with a new CHAT_REQUEST again
                 try:
-                    send_message(sock, prot.make_left_chat(self.nickname))
+                    self._send_peer(sock, prot.OP_LEFT_CHAT, self.nickname)
                 except:
                     pass
+                self.peer_socks.pop(addr, None)
+            elif sock:
                 try:
-                    sock.close()
+                    self._send_peer(sock, prot.OP_LEFT_CHAT, self.nickname)
                 except:
                     pass
+                # Unregister and close on the loop thread, so the fd is not reused while still watched
+                self.loop.call_soon(self._close_sock, sock)
                 self.peer_socks.pop(addr, None)
+                self.sock_versions.pop(sock, None)
 
     def get_peer_nickname(self, addr):
         return self.peer_nicknames.get(addr) or f"Peer{addr[1]}"
 
     def _handle_peer_message(self, addr, msg, sock):
-        if prot.is_chat_request(msg):
-            peer_nick = prot.parse_chat_request(msg)
-            if not peer_nick:
-                send_message(sock, prot.make_error("Malformed CHAT_REQUEST"))
-                return
-            self.peer_nicknames[addr] = peer_nick
-            responded = threading.Event()
-            def respond(accept):
-                responded.set()
-                if accept:
-                    send_message(sock, prot.make_chat_accept(self.nickname))
-                    self._cb('on_peer_accepted', addr, peer_nick)
-                else:
-                    send_message(sock, prot.make_chat_reject(self.nickname))
-                    self._cb('on_peer_rejected', addr, peer_nick)
-            def timeout_watcher():
-                if not responded.wait(10):
-                    self._cb('on_error', f"No response to chat request from {peer_nick} at {addr} (timeout)")
-                    try:
-                        send_message(sock, prot.make_error("No response to chat request (timeout)"))
-                    except:
-                        pass
-                    try:
-                        sock.close()
-                    except:
-                        pass
-            threading.Thread(target=timeout_watcher, daemon=True).start()
-            self._cb('on_chat_request', addr, peer_nick, respond)
-            return
-        elif prot.is_chat_accept(msg):
-            peer_nick = prot.parse_chat_accept(msg)
-            if not peer_nick:
-                send_message(sock, prot.make_error("Malformed CHAT_ACCEPT"))
-                return
-            self.peer_nicknames[addr] = peer_nick
-            self._cb('on_chat_accept', addr, peer_nick)
-            return
-        elif prot.is_chat_reject(msg):
-            peer_nick = prot.parse_chat_reject(msg)
-            if not peer_nick:
-                send_message(sock, prot.make_error("Malformed CHAT_REJECT"))
+        if isinstance(msg, bytes) and self.protocol_version >= prot.PROTOCOL_V2:
+            # The peer speaks v2, so answer in v2 as well
+            self.sock_versions[sock] = prot.PROTOCOL_V2
+        record = self._parse(msg)
+        if sock in self.unannounced:
+            self.unannounced.discard(sock)
+            if record.op == prot.OP_FILE_OFFER:
+                self._on_file_offer(addr, sock, record)
                 return
-            self.peer_nicknames[addr] = peer_nick
-            self._cb('on_chat_reject', addr, peer_nick)
-            return
-        elif prot.is_left_chat(msg):
-            peer_nick = prot.parse_left_chat(msg)
-            if not peer_nick:
-                send_message(sock, prot.make_error("Malformed LEFT_CHAT"))
-                return
-            self._cb('on_peer_left', addr, peer_nick)
-            return
-        elif prot.is_chat_msg(msg):
-            parsed = prot.parse_chat_msg(msg)
-            if parsed:
-                _, message = parsed
-                self._cb('on_peer_message', addr, message)
+            self._announce_peer(addr, sock)
+        self.peer_dispatcher.dispatch(record, addr, sock)
+
+    # --- Peer message handlers ---
+    def _on_chat_request(self, addr, sock, record):
+        peer_nick = record.nickname
+        self.peer_nicknames[addr] = peer_nick
+        def respond(accept):
+            timeout.cancel()
+            if accept:
+                self._send_peer(sock, prot.OP_CHAT_ACCEPT, self.nickname, prot.FLAG_KEEPALIVE)
+                self._cb('on_peer_accepted', addr, peer_nick)
             else:
-                send_message(sock, prot.make_error("Malformed CHAT_MSG"))
-            return
-        elif prot.is_error(msg):
-            self._cb('on_error', f"Peer error: {prot.parse_error(msg)}")
+                self._send_peer(sock, prot.OP_CHAT_REJECT, self.nickname)
+                self._cb('on_peer_rejected', addr, peer_nick)
+        def timed_out():
+            if self.peer_socks.get(addr) is not sock:
+                return  # the connection is already gone
+            self._cb('on_error', f"No response to chat request from {peer_nick} at {addr} (timeout)")
+            try:
+                self._send_peer(sock, prot.OP_ERROR, "No response to chat request (timeout)")
+            except:
+                pass
+            self._drop_peer(addr, sock)
+        # A timer wheel entry on the I/O loop instead of a thread per request
+        timeout = self.loop.call_later(10, timed_out)
+        self._cb('on_chat_request', addr, peer_nick, respond)
+
+    def _on_chat_accept(self, addr, sock, record):
+        self.peer_nicknames[addr] = record.nickname
+        self.pool.accepted(sock, record.caps)
+        self._cb('on_chat_accept', addr, record.nickname)
+
+    def _on_chat_reject(self, addr, sock, record):
+        self.peer_nicknames[addr] = record.nickname
+        self._cb('on_chat_reject', addr, record.nickname)
+
+    def _on_left_chat(self, addr, sock, record):
+        if self.pool.release(sock):
+            with self.lock:
+                if self.peer_socks.get(addr) is sock:
+                    self.peer_socks.pop(addr)
+        self._cb('on_peer_left', addr, record.nickname)
+
+    def _on_chat_msg(self, addr, sock, record):
+        if self.store is not None:
+            peer = self.get_peer_nickname(addr)
+            self.store.append(peer, peer, record.message)  # only queued, no disk I/O here
+        self._cb('on_peer_message', addr, record.message)
+
+    def _on_stream(self, addr, sock, record):
+        receiver = self.streams.get(sock)
+        if receiver is None:
+            receiver = self.streams[sock] = StreamReceiver(lambda op: self._open_stream_consumer(addr, op),
+                                                           self.max_message)
+        done = receiver.feed(record)
+        if done is None:
             return
+        op, data = done
+        if op == prot.OP_CHAT_MSG:
+            self._on_chat_msg(addr, sock, prot.ChatMsg(self.get_peer_nickname(addr), data.decode()))
         else:
-            send_message(sock, prot.make_error("Unknown or unexpected peer message"))
-            self._cb('on_error', f"Received unknown peer message: {msg}")
+            self._send_peer(sock, prot.OP_ERROR, f"Cannot stream {prot.OP_NAMES.get(op, 'message')}")
+
+    def _open_stream_consumer(self, addr, op):
+        factory = self.stream_consumers.get(op)
+        return factory(addr) if factory is not None else None
+
+    def set_stream_consumer(self, op, factory):
+        """Process streamed messages of type op incrementally instead of reassembling them.
+
+        factory(addr) is called for each such message and returns a generator
+        that receives the raw chunks via send() and None at the end (see
+        network.stream). It runs on the I/O loop thread. None removes it.
+        """
+        if factory is None:
+            self.stream_consumers.pop(op, None)
+        else:
+            self.stream_consumers[op] = factory
+
+    def _on_file_offer(self, addr, sock, record):
+        """A new connection that carries a file: hand it to a FileReceiver thread."""
+        self.loop.remove_reader(sock)
+        self._forget_sock(addr, sock)
+        # Report the transfer under the chat with that peer, not the side connection
+        chat_addr = next((a for a, n in list(self.peer_nicknames.items())
+                          if n == record.nickname and a in self.peer_socks), addr)
+        receiver = FileReceiver(self, chat_addr, sock, record, self.download_dir)
+        if not valid_offer(record):
+            self._cb('on_error', f"Declined {receiver.name} from {record.nickname}: invalid chunk size")
+            receiver.respond(False)
+            return
+        if 'on_file_offer' not in self.callbacks:
+            receiver.respond(False)
+            return
+        def respond(accept):
+            timeout.cancel()
+            receiver.respond(accept)
+        timeout = self.loop.call_later(90, receiver.respond, False)
+        self._cb('on_file_offer', chat_addr, record.nickname, receiver.name, record.size, respond)
+
+    def send_file(self, addr, path):
+        """Send a file to the peer of the chat at addr, on a separate connection. Returns right away."""
+        peer = self.peers.get(self.peer_nicknames.get(addr))
+        target = (peer[0], peer[2]) if peer and peer[2] else addr
+        FileSender(self, addr, target, path).start()
+
+    def _on_ping(self, addr, sock, record):
+        self._send_peer(sock, prot.OP_PONG)
+
+    def _on_peer_error(self, addr, sock, record):
+        self._cb('on_error', f"Peer error: {record.reason}")
+
+    def _on_malformed_peer_message(self, addr, sock, record):
+        self._send_peer(sock, prot.OP_ERROR, f"Malformed {prot.OP_NAMES.get(record.kind, 'message')}")
+
+    def _on_unknown_peer_message(self, addr, sock, record):
+        raw = getattr(record, 'raw', record)
+        self._send_peer(sock, prot.OP_ERROR, "Unknown or unexpected peer message")
+        self._cb('on_error', f"Received unknown peer message: {raw}")
 
     def start_udp_listener(self, on_message):
-        listen_for_udp(self.udp_port, on_message)
+        """Call on_message(addr, text) for every UDP message on our UDP port (from the I/O loop)."""
+        try:
+            self.udp = UdpTransport(self.udp_port)
+        except OSError as e:
+            self._cb('on_error', f"Failed to listen on UDP port {self.udp_port}: {e}")
+            return
+        self.udp.sock.setblocking(False)
+        self.rudp = ReliableUdp(self.udp, self._io(), self._on_rudp_message, self._on_rudp_closed)
+        def readable():
+            for addr, data in self.udp.recv_batch():
+                if data and data[0] == RUDP_MAGIC:
+                    self.rudp.receive(addr, data)
+                elif data:
+                    on_message(addr, data.decode(errors='replace'))
+            self.rudp.flush()  # one ack per channel for the whole batch
+        self._io().add_reader(self.udp.sock, readable)
+
+    def send_udp(self, nickname, message):
+        """Send a UDP message to a peer from our own UDP port (fragmented if it does not fit one datagram)."""
+        if self.udp is None or nickname not in self.peers:
+            return False
+        ip, udp_port, _ = self.peers[nickname]
+        try:
+            self.udp.send((ip, udp_port), message)
+            return True
+        except OSError as e:
+            self._cb('on_error', f"Failed to send UDP message to {nickname}: {e}")
+            return False
+
+    def start_discovery(self, **options):
+        """Find peers on the LAN over multicast, also when the server is unreachable."""
+        if self.discovery is None:
+            self.discovery = LanDiscovery(self, **options)
+            if not self.discovery.start():
+                self.discovery = None
+        return self.discovery
 
     def send_broadcast(self, message):
         if self.server_sock:
+            frame = prot.encode(self.server_version or prot.PROTOCOL_V1, prot.OP_BROADCAST, message)
+            if len(frame) > self.max_server_frame:
+                # The server would drop the connection instead
+                self._cb('on_error', f"Broadcast too long ({len(frame)} bytes, "
+                                     f"the server accepts at most {self.max_server_frame})")
+                return
             try:
-                send_message(self.server_sock, f"BROADCAST {message}")
+                self.server_sock.sendall(frame)
             except Exception as e:
-                self._cb('on_error', f"Failed to send broadcast: {e}")
\ No newline at end of file
+                self._cb('on_error', f"Failed to send broadcast: {e}")
+
+    def _send_room(self, op, room, *fields) -> bool:
+        """Send a ROOM_* message to the server. Rooms need a v2 server."""
+        if not self.server_sock:
+            return False
+        if self.server_version != prot.PROTOCOL_V2:
+            self._cb('on_error', "Rooms need a protocol v2 connection to the server")
+            return False
+        frame = prot.encode(prot.PROTOCOL_V2, op, room, self.nickname, *fields)
+        if len(frame) > self.max_server_frame:
+            self._cb('on_error', f"Message to room {room} too long ({len(frame)} bytes, "
+                                 f"the server accepts at most {self.max_server_frame})")
+            return False
+        try:
+            self.server_sock.sendall(frame)
+            return True
+        except OSError as e:
+            self._cb('on_error', f"Failed to send to room {room}: {e}")
+            return False
+
+    def join_room(self, room):
+        """Join a room; on_room_joined reports every member, ourselves last."""
+        return self._send_room(prot.OP_ROOM_JOIN, room)
+
+    def part_room(self, room):
+        return self._send_room(prot.OP_ROOM_PART, room)
+
+    def send_room_message(self, room, message):
+        """Send a message to everyone in the room; it comes back through on_room_message."""
+        return self._send_room(prot.OP_ROOM_MSG, room, message)
@@ -0,0 +1,219 @@
+"""
+Serverless peer discovery on the local network.
+
+Every client joins a UDP multicast group and announces its nickname and
+ports there (ANNOUNCE, see network/README.md). Announces start every
+min_interval seconds and back off exponentially to max_interval, so a
+quiet LAN costs one small datagram per peer per minute. Each announce
+carries a TTL; peers that stop announcing drop out of the roster when it
+runs out, and a clean shutdown announces TTL 0. When a new peer shows up
+the others answer it with their own announce by unicast, after a random
+delay (spread over a window that grows with the roster) and only if they
+did not multicast one since. A join therefore costs each other host one
+datagram at most and the LAN nothing, and newcomers still learn the LAN
+quickly without a burst of replies.
+
+Announces are sent from a socket of our own on an ephemeral port, not
+from the shared group port: several clients on one host bind that port
+with SO_REUSEPORT, and a unicast datagram to it reaches only one of
+them, not necessarily the one that announced. Answers go to the
+announcing socket, so they always reach the right instance.
+
+Discovered peers are fed to PeerClient like JOINED/LEFT from the server,
+so chats work when the server is down or slow.
+"""
+import math
+import os
+import random
+import socket
+import struct
+import time
+import network.protocol as prot
+from network.udp import UdpTransport
+
+DEFAULT_GROUP = '239.255.77.77'
+DEFAULT_PORT = 47477
+
+class LanDiscovery:
+    def __init__(self, client, group: str = DEFAULT_GROUP, port: int = DEFAULT_PORT,
+                 min_interval: float = 1.0, max_interval: float = 60.0, hops: int = 1):
+        self.client = client
+        self.group = group
+        self.port = port
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.hops = hops  # multicast TTL; 1 keeps announces on the local subnet
+        self.instance = int.from_bytes(os.urandom(4), 'big')
+        self.seq = 0
+        self.interval = min_interval
+        self.last_announce = 0.0
+        self.entries = {}  # nickname -> [instance, seq, expires, (ip, udp_port, tcp_port, flags)]
+        self.added = set()  # nicknames this discovery put into client.peers
+        self.transport = None  # bound to the group port; receives multicast announces
+        self.unicast = None    # our own port; sends every announce and receives the answers
+        self.timer = None        # next regular announce
+        self.reply_timer = None  # pending answer to newcomers
+        self.newcomers = {}  # address of a new peer's discovery socket -> time it was seen
+
+    def _socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)  # several clients per host
+            except OSError:
+                pass
+        try:
+            sock.bind(('', self.port))
+            membership = struct.pack('4s4s', socket.inet_aton(self.group), socket.inet_aton('0.0.0.0'))
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        except OSError:
+            sock.close()
+            raise
+        sock.setblocking(False)
+        return sock
+
+    def _unicast_socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        try:
+            sock.bind(('', 0))
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self.hops)
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        except OSError:
+            sock.close()
+            raise
+        sock.setblocking(False)
+        return sock
+
+    def start(self):
+        try:
+            self.transport = UdpTransport(sock=self._socket())
+            self.unicast = UdpTransport(sock=self._unicast_socket())
+        except OSError as e:
+            if self.transport is not None:
+                self.transport.close()
+                self.transport = None
+            self.client._cb('on_error', f"LAN discovery unavailable: {e}")
+            return False
+        loop = self.client._io()
+        for transport in (self.transport, self.unicast):
+            loop.add_reader(transport.sock, lambda transport=transport: self._on_readable(transport))
+        # A small random delay keeps clients started together from announcing in lockstep
+        self.timer = loop.call_later(random.uniform(0, self.min_interval / 4), self._announce)
+        loop.call_later(self.min_interval, self._expire)
+        return True
+
+    def stop(self):
+        """Announce that we leave (TTL 0) and close the socket."""
+        if self.transport is None:
+            return
+        for timer in (self.timer, self.reply_timer):
+            if timer is not None:
+                timer.cancel()
+        try:
+            self._send(0)
+        except OSError:
+            pass
+        for transport in (self.transport, self.unicast):
+            self.client.loop.remove_reader(transport.sock)
+            self.client.loop.call_soon(transport.close)
+        self.transport = self.unicast = None
+
+    # --- Announcing ---
+    def _send(self, ttl, addr=None):
+        """Multicast an announce, or send it to addr as an answer to a newcomer."""
+        self.seq += 1
+        client = self.client
+        flags = prot.FLAG_V2 | prot.FLAG_DATAGRAM if client.protocol_version >= prot.PROTOCOL_V2 else 0
+        if addr is not None:
+            flags |= prot.FLAG_REPLY
+        self.unicast.send(addr or (self.group, self.port), prot.pack(
+            prot.OP_ANNOUNCE, client.nickname, client.udp_port or 0, client.tcp_port or 0,
+            flags, self.instance, self.seq, ttl))
+        if addr is None:
+            self.last_announce = time.monotonic()
+
+    def _ttl(self):
+        # Outlives at least one lost announce, two once the interval stopped growing
+        return math.ceil(3 * min(self.interval * 2, self.max_interval))
+
+    def _announce(self):
+        if self.transport is None:
+            return
+        try:
+            self._send(self._ttl())
+        except OSError as e:
+            self.client._cb('on_error', f"LAN announce failed: {e}")
+        self.timer = self.client.loop.call_later(self.interval * random.uniform(0.9, 1.1), self._announce)
+        self.interval = min(self.interval * 2, self.max_interval)
+
+    def announce_now(self):
+        """Announce again soon and restart the backoff (e.g. after our ports changed)."""
+        if self.timer is not None:
+            self.timer.cancel()
+        self.interval = self.min_interval
+        self.timer = self.client._io().call_later(0, self._announce)
+
+    def _reply(self):
+        self.reply_timer = None
+        newcomers, self.newcomers = self.newcomers, {}
+        if self.transport is None:
+            return
+        for addr, seen in newcomers.items():
+            if self.last_announce < seen:  # else our multicast since then already reached it
+                try:
+                    self._send(self._ttl(), addr)
+                except OSError:
+                    pass
+
+    # --- Receiving ---
+    def _on_readable(self, transport):
+        if self.transport is None:
+            return
+        for addr, data in transport.recv_batch():
+            record = prot.parse(data)
+            if record.op == prot.OP_ANNOUNCE:
+                self._on_announce(addr, record)
+
+    def _on_announce(self, addr, record):
+        if record.instance == self.instance or record.nickname == self.client.nickname:
+            return
+        entry = self.entries.get(record.nickname)
+        if entry is not None and entry[0] == record.instance and record.seq <= entry[1]:
+            return  # duplicate (e.g. received on two interfaces) or reordered
+        if record.ttl == 0:
+            if entry is not None and entry[0] == record.instance:
+                self._remove(record.nickname)
+            return
+        flags = record.flags or 0
+        peer = (addr[0], record.udp_port, record.tcp_port, flags & ~prot.FLAG_REPLY)
+        expires = time.monotonic() + record.ttl
+        self.entries[record.nickname] = [record.instance, record.seq, expires, peer]
+        if (entry is None or entry[0] != record.instance) and not flags & prot.FLAG_REPLY:
+            self._answer_newcomer(addr)
+        if self.client.peers.get(record.nickname) != peer[:3]:
+            self.added.add(record.nickname)
+            self.client._on_joined(prot.Joined(record.nickname, *peer))
+
+    def _answer_newcomer(self, addr):
+        """Tell a new peer about us soon, by unicast to the socket it announced from (its own port)."""
+        self.newcomers[addr] = time.monotonic()
+        if self.reply_timer is not None:
+            return
+        window = max(self.min_interval, len(self.entries) * 0.01)
+        self.reply_timer = self.client.loop.call_later(random.uniform(0, window), self._reply)
+
+    def _remove(self, nickname):
+        entry = self.entries.pop(nickname, None)
+        if nickname in self.added:
+            self.added.discard(nickname)
+            if entry is not None and self.client.peers.get(nickname) == entry[3][:3]:
+                self.client._on_left(prot.Left(nickname))
+
+    def _expire(self):
+        if self.transport is None:
+            return
+        now = time.monotonic()
+        for nickname in [n for n, entry in self.entries.items() if entry[2] <= now]:
+            self._remove(nickname)
+        self.client.loop.call_later(self.min_interval, self._expire)
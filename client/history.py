@@ -0,0 +1,110 @@
+"""
+In-memory chat history for PeerChat clients.
+
+Every conversation (keyed by peer address) keeps its newest messages in a
+fixed-size ring buffer. Messages are addressed by their position in the
+conversation, counted from the first message ever added, so positions stay
+valid when old messages drop out of memory. A dropped message is handed
+to the spill hook (e.g. an on-disk store) instead of being lost.
+"""
+import sys
+
+# Display tags, stored as their index
+TAGS = ('user', 'peer', 'system', 'error', 'broadcast', 'left', 'accept', 'reject',
+        'connected', 'disconnected', 'udp')
+TAG_IDS = {name: i for i, name in enumerate(TAGS)}
+
+class Record:
+    """One message: receive time, interned sender, text and tag id."""
+    __slots__ = ('time', 'sender', 'message', 'tag')
+
+    def __init__(self, time, sender, message, tag):
+        self.time = time
+        self.sender = sender
+        self.message = message
+        self.tag = tag
+
+    def __iter__(self):
+        return iter((self.time, self.sender, self.message, TAGS[self.tag]))
+
+    def size(self) -> int:
+        """Bytes used by this record, not counting the shared sender string."""
+        return sys.getsizeof(self) + sys.getsizeof(self.time) + sys.getsizeof(self.message)
+
+class Conversation:
+    """Ring buffer of the newest `capacity` records of one conversation."""
+    __slots__ = ('buf', 'capacity', 'end')
+
+    def __init__(self, capacity: int):
+        self.buf = []  # grows up to capacity, then wraps around
+        self.capacity = capacity
+        self.end = 0   # position of the next record
+
+    @property
+    def start(self) -> int:
+        """Position of the oldest record still in memory."""
+        return max(0, self.end - self.capacity)
+
+    def __len__(self):
+        return self.end
+
+    def append(self, record):
+        """Add a record; returns the one it pushed out of memory, if any."""
+        dropped = None
+        if len(self.buf) < self.capacity:
+            self.buf.append(record)
+        else:
+            i = self.end % self.capacity
+            dropped, self.buf[i] = self.buf[i], record
+        self.end += 1
+        return dropped
+
+    def slice(self, start, stop):
+        """Records at positions [start, stop) that are still in memory."""
+        start, stop = max(start, self.start), min(stop, self.end)
+        n = self.capacity
+        return [self.buf[i % n] for i in range(start, stop)]
+
+class HistoryStore:
+    """Per-peer chat histories with a bounded number of records in memory each."""
+
+    def __init__(self, capacity: int = 10000, spill=None):
+        self.capacity = capacity
+        self.spill = spill  # spill(peer, record) for records that fall out of memory
+        self.conversations = {}
+        self.senders = set()
+        self.bytes = 0  # records and senders currently in memory
+
+    def get(self, peer):
+        conv = self.conversations.get(peer)
+        if conv is None:
+            conv = self.conversations[peer] = Conversation(self.capacity)
+        return conv
+
+    def __contains__(self, peer):
+        return peer in self.conversations
+
+    def add(self, peer, time, sender, message, tag) -> Record:
+        sender = sys.intern(sender)
+        if sender not in self.senders:
+            self.senders.add(sender)
+            self.bytes += sys.getsizeof(sender)
+        record = Record(time, sender, message, TAG_IDS.get(tag, TAG_IDS['peer']))
+        self.bytes += record.size()
+        dropped = self.get(peer).append(record)
+        if dropped is not None:
+            self.bytes -= dropped.size()
+            if self.spill is not None:
+                self.spill(peer, dropped)
+        return record
+
+    def memory(self) -> int:
+        """Approximate bytes held by all conversations."""
+        return self.bytes + sum(sys.getsizeof(c) + sys.getsizeof(c.buf) for c in self.conversations.values())
+
+    def stats(self) -> dict:
+        return {
+            'conversations': len(self.conversations),
+            'records': sum(len(c.buf) for c in self.conversations.values()),
+            'bytes': self.memory(),
+        }
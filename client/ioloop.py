@@ -0,0 +1,170 @@
+"""
+Single-threaded I/O loop for PeerClient.
+
+One thread waits on a selector for every socket the client has (server
+connection, peer listener, peer connections, UDP) and runs the handler of
+each socket that became readable. Timeouts are kept in a hashed timer
+wheel, so a pending chat request costs a list entry instead of a sleeping
+thread. Other threads hand work to the loop with call_soon.
+"""
+import math
+import selectors
+import socket
+import threading
+import time
+import traceback
+from collections import deque
+
+class Timer:
+    __slots__ = ('tick', 'fn', 'args', 'cancelled')
+
+    def __init__(self, tick, fn, args):
+        self.tick = tick
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """Safe to call from any thread; the wheel drops the timer when its slot comes up."""
+        self.cancelled = True
+
+class TimerWheel:
+    """Timers rounded up to `tick` seconds, hashed into a ring of slots.
+
+    Scheduling and cancelling are O(1); each tick only looks at one slot.
+    Timers further away than one revolution stay in their slot until their
+    round comes.
+    """
+
+    def __init__(self, tick: float = 0.05, slots: int = 256):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.origin = time.monotonic()
+        self.current = 0  # last tick that has been run
+        self.pending = 0  # timers in the slots, including cancelled ones
+
+    def _now_tick(self, now=None):
+        return int(((now if now is not None else time.monotonic()) - self.origin) / self.tick)
+
+    def schedule(self, delay: float, fn, *args) -> Timer:
+        return self.add(Timer(0, fn, args), delay)
+
+    def add(self, timer: Timer, delay: float) -> Timer:
+        if not self.pending:
+            self.current = self._now_tick()  # nothing was due while the wheel was empty
+        timer.tick = self.current + max(1, math.ceil(delay / self.tick))
+        self.slots[timer.tick % len(self.slots)].append(timer)
+        self.pending += 1
+        return timer
+
+    def expired(self, now=None) -> list:
+        """Remove and return the timers that are due."""
+        due, ready = self._now_tick(now), []
+        while self.current < due and self.pending:
+            self.current += 1
+            slot = self.slots[self.current % len(self.slots)]
+            if not slot:
+                continue
+            keep = []
+            for timer in slot:
+                if timer.tick > self.current:
+                    keep.append(timer)  # a later round
+                elif not timer.cancelled:
+                    ready.append(timer)
+            self.pending -= len(slot) - len(keep)
+            slot[:] = keep
+        return ready
+
+    def timeout(self):
+        """Seconds until the next tick, or None when no timer is pending."""
+        if not self.pending:
+            return None
+        return max(0.0, self.origin + (self.current + 1) * self.tick - time.monotonic())
+
+class IOLoop:
+    """Selector loop running in one daemon thread."""
+
+    def __init__(self, tick: float = 0.05):
+        self.selector = selectors.DefaultSelector()
+        self.wheel = TimerWheel(tick)
+        self.calls = deque()  # (fn, args) from other threads
+        self.thread = None
+        self.running = False
+        self.start_lock = threading.Lock()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self.selector.register(self._wake_r, selectors.EVENT_READ, self._drain_wakeup)
+
+    def start(self):
+        with self.start_lock:
+            if self.thread is None:
+                self.running = True
+                self.thread = threading.Thread(target=self.run, name='ioloop', daemon=True)
+                self.thread.start()
+        return self
+
+    def in_loop(self) -> bool:
+        return threading.current_thread() is self.thread
+
+    def call_soon(self, fn, *args):
+        """Run fn(*args) on the loop thread. Safe to call from any thread."""
+        self.calls.append((fn, args))
+        try:
+            self._wake_w.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass  # already woken (buffer full) or closed
+
+    def call_later(self, delay: float, fn, *args) -> Timer:
+        """Run fn(*args) on the loop thread after delay seconds; returns a cancellable Timer."""
+        timer = Timer(0, fn, args)
+        if self.in_loop():
+            self.wheel.add(timer, delay)
+        else:
+            self.call_soon(self.wheel.add, timer, delay)  # the wheel belongs to the loop thread
+        return timer
+
+    def add_reader(self, sock, handler):
+        """Call handler() whenever sock is readable."""
+        if self.in_loop():
+            self.selector.register(sock, selectors.EVENT_READ, handler)
+        else:
+            self.call_soon(self.selector.register, sock, selectors.EVENT_READ, handler)
+
+    def remove_reader(self, sock):
+        """Stop watching sock. Call before closing it."""
+        if not self.in_loop():
+            self.call_soon(self.remove_reader, sock)
+            return
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+
+    def _drain_wakeup(self):
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+    @staticmethod
+    def _run(fn, *args):
+        try:
+            fn(*args)
+        except Exception:
+            traceback.print_exc()  # like an uncaught exception in a thread, but the loop goes on
+
+    def run(self):
+        while self.running:
+            for key, _ in self.selector.select(self.wheel.timeout()):
+                self._run(key.data)
+            while self.calls:
+                fn, args = self.calls.popleft()
+                self._run(fn, *args)
+            for timer in self.wheel.expired():
+                self._run(timer.fn, *timer.args)
+
+    def stop(self):
+        self.running = False
+        self.call_soon(lambda: None)
@@ -0,0 +1,297 @@
+"""
+Persistent chat log for a PeerChat identity.
+
+Messages are appended to numbered segment files (NNNNNNNN.log, one JSON
+object per line) in a directory per identity; a segment is closed once it
+reaches segment_size and a new one is started. Next to every segment an
+.idx file holds one fixed-size entry (peer id, time, offset) per message,
+and peers.txt maps peer ids to peer names. Opening the log reads only the
+index files, so "last N messages with peer X" seeks straight to the
+messages, and search streams the segments newest first without loading
+them.
+
+append() only queues the message; a writer thread writes the queue in
+batches every flush_interval seconds and fsyncs every fsync_interval, so
+callers on the network receive path never wait for the disk. Messages
+become visible to queries once written (see flush()).
+"""
+import hashlib
+import json
+import os
+import re
+import struct
+import threading
+import time
+from array import array
+from collections import deque
+
+INDEX_ENTRY = struct.Struct('<IdI')  # peer id, time, offset in the segment
+PLAIN_NAME = re.compile(r'[A-Za-z0-9_.-]{1,64}')
+
+def identity_path(root, nickname) -> str:
+    """Directory under root for a nickname's data. Names that are not plain file names are hashed."""
+    if PLAIN_NAME.fullmatch(nickname) and nickname.strip('.'):
+        return os.path.join(root, nickname)
+    return os.path.join(root, 'id-' + hashlib.sha256(nickname.encode()).hexdigest()[:32])
+
+def _lines_reversed(f, block: int = 64 * 1024):
+    """Lines of a binary file from last to first, reading it backwards a block at a time."""
+    f.seek(0, os.SEEK_END)
+    pos, rest = f.tell(), b''
+    while pos > 0:
+        n = min(block, pos)
+        pos -= n
+        f.seek(pos)
+        lines = (f.read(n) + rest).split(b'\n')
+        rest = lines.pop(0)  # may continue in the block before
+        for line in reversed(lines):
+            if line:
+                yield line
+    if rest:
+        yield rest
+
+class MessageLog:
+    """Append-only, segmented message log with a per-peer index."""
+
+    def __init__(self, path, segment_size: int = 4 << 20, flush_interval: float = 0.2,
+                 fsync_interval: float = 2.0):
+        self.path = path
+        self.segment_size = segment_size
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        os.makedirs(path, exist_ok=True)
+        self.lock = threading.Lock()    # index and file handles
+        self.queue = deque()            # (peer, time, sender, message) not yet written
+        self.wakeup = threading.Event()
+        self.running = True
+        self.peer_ids = {}
+        self.peer_names = []
+        # peer id -> parallel arrays of times, segment numbers and offsets
+        self.index = {}
+        self._load()
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+
+    # --- Opening ---
+    def _segments(self):
+        return sorted(int(name[:-4]) for name in os.listdir(self.path)
+                      if name.endswith('.log') and name[:-4].isdigit())
+
+    def _file(self, segment, ext):
+        return os.path.join(self.path, f"{segment:08d}.{ext}")
+
+    def _load(self):
+        peers_file = os.path.join(self.path, 'peers.txt')
+        if os.path.exists(peers_file):
+            with open(peers_file, encoding='utf-8') as f:
+                for line in f:
+                    self._peer_id(json.loads(line), write=False)
+        self.peers_out = open(peers_file, 'a', encoding='utf-8')
+        segments = self._segments() or [1]
+        for segment in segments:
+            self._load_segment(segment)
+        self.segment = segments[-1]
+        self._open_segment(self.segment)
+
+    def _load_segment(self, segment):
+        """Read a segment's index, re-indexing messages the index missed (e.g. after a crash)."""
+        indexed_end, data = 0, b''
+        idx_file = self._file(segment, 'idx')
+        if os.path.exists(idx_file):
+            with open(idx_file, 'rb') as f:
+                data = f.read()
+            data = data[:len(data) - len(data) % INDEX_ENTRY.size]
+            for peer_id, t, offset in INDEX_ENTRY.iter_unpack(data):
+                self._index_add(peer_id, t, segment, offset)
+            if data:
+                indexed_end = offset
+            with open(idx_file, 'r+b') as f:
+                f.truncate(len(data))  # drop a torn entry
+        log_file = self._file(segment, 'log')
+        if not os.path.exists(log_file):
+            return
+        with open(log_file, 'r+b') as log, open(idx_file, 'ab') as idx:
+            log.seek(indexed_end)
+            if data:
+                log.readline()  # the last indexed message
+            while True:
+                offset = log.tell()
+                line = log.readline()
+                if not line.endswith(b'\n'):
+                    log.truncate(offset)  # torn write at the end
+                    break
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    continue
+                peer_id = self._peer_id(item['p'])
+                self._index_add(peer_id, item['t'], segment, offset)
+                idx.write(INDEX_ENTRY.pack(peer_id, item['t'], offset))
+
+    def _open_segment(self, segment):
+        self.log_out = open(self._file(segment, 'log'), 'ab')
+        self.idx_out = open(self._file(segment, 'idx'), 'ab')
+
+    def _peer_id(self, peer, write=True):
+        peer_id = self.peer_ids.get(peer)
+        if peer_id is None:
+            peer_id = self.peer_ids[peer] = len(self.peer_names)
+            self.peer_names.append(peer)
+            if write:
+                self.peers_out.write(json.dumps(peer) + '\n')
+                self.peers_out.flush()
+        return peer_id
+
+    def _index_add(self, peer_id, t, segment, offset):
+        entry = self.index.get(peer_id)
+        if entry is None:
+            entry = self.index[peer_id] = (array('d'), array('I'), array('Q'))
+        entry[0].append(t)
+        entry[1].append(segment)
+        entry[2].append(offset)
+
+    # --- Writing ---
+    def append(self, peer, sender, message, t=None):
+        """Queue a message for writing. Never blocks on the disk."""
+        self.queue.append((peer, time.time() if t is None else t, sender, message))
+
+    def _write_loop(self):
+        last_sync = time.monotonic()
+        while self.running:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self._write_batch()
+            if time.monotonic() - last_sync >= self.fsync_interval:
+                self._sync()
+                last_sync = time.monotonic()
+        self._write_batch()
+        self._sync()
+
+    def _write_batch(self):
+        with self.lock:
+            while self.queue:
+                lines, entries = [], []
+                offset = self.log_out.tell()
+                while self.queue and offset < self.segment_size:
+                    peer, t, sender, message = self.queue.popleft()
+                    item = {'p': peer, 't': t, 's': sender, 'm': message}
+                    line = (json.dumps(item, ensure_ascii=False) + '\n').encode('utf-8')
+                    entries.append((self._peer_id(peer), t, offset))
+                    lines.append(line)
+                    offset += len(line)
+                # One write per file for the whole batch
+                self.log_out.write(b''.join(lines))
+                self.log_out.flush()
+                self.idx_out.write(b''.join(INDEX_ENTRY.pack(*entry) for entry in entries))
+                self.idx_out.flush()
+                for peer_id, t, offset in entries:
+                    self._index_add(peer_id, t, self.segment, offset)
+                if self.log_out.tell() >= self.segment_size:
+                    self._sync_files()
+                    self.log_out.close()
+                    self.idx_out.close()
+                    self.segment += 1
+                    self._open_segment(self.segment)
+
+    def _sync_files(self):
+        for f in (self.log_out, self.idx_out, self.peers_out):
+            os.fsync(f.fileno())
+
+    def _sync(self):
+        with self.lock:
+            self._sync_files()
+
+    def flush(self):
+        """Write and fsync everything queued so far. Blocks; not for the receive path."""
+        self._write_batch()
+        self._sync()
+
+    def close(self):
+        self.running = False
+        self.wakeup.set()
+        self.writer.join()
+        with self.lock:
+            for f in (self.log_out, self.idx_out, self.peers_out):
+                f.close()
+
+    # --- Reading ---
+    def _read(self, locations):
+        """Messages at (segment, offset) locations, in the given order."""
+        messages, files = [], {}
+        try:
+            for segment, offset in locations:
+                f = files.get(segment)
+                if f is None:
+                    f = files[segment] = open(self._file(segment, 'log'), 'rb')
+                f.seek(offset)
+                item = json.loads(f.readline())
+                messages.append((item['t'], item['s'], item['m']))
+        finally:
+            for f in files.values():
+                f.close()
+        return messages
+
+    def last(self, peer, n: int = 50, before=None):
+        """The last n (time, sender, message) with peer, oldest first, optionally only before a time."""
+        with self.lock:
+            entry = self.index.get(self.peer_ids.get(peer))
+            if entry is None:
+                return []
+            times, segments, offsets = entry
+            if before is None:
+                start = max(0, len(times) - n)
+                locations = list(zip(segments[start:], offsets[start:]))
+            else:
+                # Appends from several threads are not in time order, so scan instead of bisecting
+                locations = []
+                for i in range(len(times) - 1, -1, -1):
+                    if len(locations) >= n:
+                        break
+                    if times[i] < before:
+                        locations.append((segments[i], offsets[i]))
+                locations.reverse()
+        return self._read(locations)
+
+    def count(self, peer) -> int:
+        with self.lock:
+            entry = self.index.get(self.peer_ids.get(peer))
+            return len(entry[0]) if entry is not None else 0
+
+    def recent_peers(self, n: int = 10):
+        """Peers with the newest messages first."""
+        with self.lock:
+            latest = sorted(((times[-1], pid) for pid, (times, _, _) in self.index.items() if times), reverse=True)
+            return [self.peer_names[pid] for _, pid in latest[:n]]
+
+    def peers(self):
+        with self.lock:
+            return list(self.peer_names)
+
+    def search(self, text, peer=None, limit: int = 100):
+        """Newest messages (peer, time, sender, message) whose text contains all words of text.
+
+        Reads the segments backwards from newest to oldest and stops after limit matches.
+        """
+        words = [w.lower() for w in text.split()]
+        raw_words = [json.dumps(w, ensure_ascii=False)[1:-1] for w in words]  # as they appear in the file
+        results = []
+        with self.lock:
+            segments = self._segments()
+        for segment in reversed(segments):
+            with open(self._file(segment, 'log'), 'rb') as f:
+                for line in _lines_reversed(f):
+                    lower = line.decode('utf-8', 'replace').lower()
+                    if not all(w in lower for w in raw_words):
+                        continue  # cheap check on the raw line before decoding
+                    try:
+                        item = json.loads(line)
+                    except ValueError:
+                        continue
+                    if peer is not None and item['p'] != peer:
+                        continue
+                    message = item['m'].lower()
+                    if all(w in message for w in words):
+                        results.append((item['p'], item['t'], item['s'], item['m']))
+                        if len(results) >= limit:
+                            return results
+        return results
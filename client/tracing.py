@@ -0,0 +1,125 @@
+"""
+Opt-in profiling of the client's message path.
+
+A Tracer times named spans (receiving, parsing, protocol handlers, client
+callbacks). Spans nest per thread, so every measurement is also booked
+under its call stack, e.g. "ioloop;peer;handle_peer_message;peer:_on_chat_msg;cb:on_peer_message".
+The tracer keeps per-span call counts, total time and recent durations for
+percentiles, and flags spans that run longer than a threshold on a network
+thread (any thread but the main/Tk thread), where a slow callback delays
+every socket served by that thread. Only the innermost slow span of a call
+chain is flagged, not each of its callers.
+
+dump_collapsed() writes the self time of each stack in microseconds in the
+collapsed format read by flamegraph.pl, inferno and speedscope.
+PeerClient.enable_tracing() installs a tracer; it costs nothing until then.
+"""
+import sys
+import threading
+import time
+from collections import deque
+
+class SpanStats:
+    __slots__ = ('count', 'total', 'max', 'recent', 'slow')
+
+    def __init__(self, window: int):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent = deque(maxlen=window)  # latest durations, for percentiles
+        self.slow = 0
+
+    def percentile(self, q) -> float:
+        durations = sorted(self.recent)
+        if not durations:
+            return 0.0
+        return durations[min(len(durations) - 1, int(q * len(durations)))]
+
+class Tracer:
+    def __init__(self, threshold: float = 0.05, on_slow=None, window: int = 1024):
+        self.threshold = threshold  # seconds a span may take on a network thread
+        self.on_slow = on_slow      # on_slow(stack, seconds, thread_name); default: a line on stderr
+        self.window = window
+        self.stats = {}   # span name -> SpanStats
+        self.stacks = {}  # "thread;outer;inner" -> self time in seconds
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def wrap(self, name, fn):
+        """Return fn timed as span name."""
+        def traced(*args, **kwargs):
+            return self.call(name, fn, *args, **kwargs)
+        traced.__wrapped__ = fn
+        return traced
+
+    def call(self, name, fn, *args, **kwargs):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = [threading.current_thread().name]
+            self.local.children = [0.0]
+            self.local.flagged = False  # a slow span was reported in the current call chain
+        children = self.local.children
+        stack.append(name)
+        children.append(0.0)
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            path = ';'.join(stack)
+            own = elapsed - children.pop()
+            stack.pop()
+            children[-1] += elapsed
+            slow = elapsed > self.threshold and not self.local.flagged \
+                and threading.current_thread() is not threading.main_thread()
+            if slow:
+                self.local.flagged = True
+            if len(stack) == 1:
+                self.local.flagged = False
+            self._record(name, path, elapsed, own, slow)
+
+    def _record(self, name, path, elapsed, own, slow):
+        with self.lock:
+            stats = self.stats.get(name)
+            if stats is None:
+                stats = self.stats[name] = SpanStats(self.window)
+            stats.count += 1
+            stats.total += elapsed
+            stats.recent.append(elapsed)
+            if elapsed > stats.max:
+                stats.max = elapsed
+            if slow:
+                stats.slow += 1
+            self.stacks[path] = self.stacks.get(path, 0.0) + own
+        if slow:
+            if self.on_slow is not None:
+                self.on_slow(path, elapsed, threading.current_thread().name)
+            else:
+                print(f"[trace] slow: {path} took {elapsed * 1e3:.1f} ms", file=sys.stderr)
+
+    def report(self) -> str:
+        """One line per span, slowest total first."""
+        with self.lock:
+            rows = [(name, s.count, s.total, s.percentile(0.5), s.percentile(0.99), s.max, s.slow)
+                    for name, s in self.stats.items()]
+        rows.sort(key=lambda row: row[2], reverse=True)
+        lines = [f"{'span':<40}{'calls':>8}{'total ms':>11}{'p50 us':>9}{'p99 us':>9}{'max us':>9}{'slow':>6}"]
+        for name, count, total, p50, p99, worst, slow in rows:
+            lines.append(f"{name:<40}{count:>8}{total * 1e3:>11.1f}{p50 * 1e6:>9.0f}{p99 * 1e6:>9.0f}"
+                         f"{worst * 1e6:>9.0f}{slow:>6}")
+        return '\n'.join(lines)
+
+    def collapsed(self) -> str:
+        """Self time per stack in microseconds, one "a;b;c <us>" line each."""
+        with self.lock:
+            stacks = sorted(self.stacks.items())
+        return ''.join(f"{path} {max(1, round(own * 1e6))}\n" for path, own in stacks)
+
+    def dump_collapsed(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(self.collapsed())
+
+    def reset(self):
+        with self.lock:
+            self.stats.clear()
+            self.stacks.clear()
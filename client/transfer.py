@@ -0,0 +1,190 @@
+"""
+Streamed file transfer between peers.
+
+A transfer runs on its own TCP connection to the receiver's peer port, in
+a thread per side, so chat messages on the chat connection never wait for
+it. The sender offers the file (FILE_OFFER), the receiver answers with the
+offset it already has (FILE_ACCEPT) or FILE_REJECT, and the sender then
+streams fixed-size chunks: a FILE_CHUNK frame with offset, length and
+CRC-32, followed by the raw bytes sent with socket.sendfile. Checksums are
+computed on a memory-mapped view of the file, so the sender never copies
+the file into Python objects.
+
+The receiver writes each chunk straight to a .part file through one small
+buffer (constant memory) and drops a chunk whose checksum does not match.
+Offering the same file again resumes after the last complete chunk; the
+sender retries a failed connection a few times by itself. When the file
+is complete it is renamed and FILE_DONE is sent back.
+"""
+import mmap
+import os
+import socket
+import threading
+import time
+import zlib
+import network.protocol as prot
+from network.tcp import recv_message
+
+CHUNK_SIZE = 256 * 1024
+CHUNK_SIZE_MAX = 16 * 1024 * 1024  # largest chunk a receiver accepts in an offer
+
+def transfer_id(nickname, path, st) -> int:
+    """Stable id for a file, so a later offer of the same file resumes."""
+    return zlib.crc32(f"{nickname}\0{os.path.abspath(path)}\0{st.st_size}\0{st.st_mtime_ns}".encode())
+
+def safe_filename(name) -> str:
+    name = os.path.basename(name.replace('\\', '/')).strip()
+    return name if name not in ('', '.', '..') else 'file'
+
+def valid_offer(offer) -> bool:
+    return 0 < offer.chunk_size <= CHUNK_SIZE_MAX
+
+def _send(sock, op, *fields):
+    sock.sendall(prot.encode(prot.PROTOCOL_V2, op, *fields))
+
+class FileSender:
+    def __init__(self, client, addr, target, path, chunk_size: int = CHUNK_SIZE, retries: int = 3,
+                 accept_timeout: float = 120.0):
+        self.client = client
+        self.addr = addr      # chat address, used in callbacks
+        self.target = target  # (ip, tcp_port) of the receiver's peer port
+        self.path = path
+        self.name = os.path.basename(path)
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.accept_timeout = accept_timeout  # time the receiver may take to answer the offer
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(min(2 ** attempt, 10))
+            try:
+                self._transfer()
+                return
+            except _Rejected:
+                self.client._cb('on_info', f"[{self.name} was declined]")
+                return
+            except (OSError, ValueError) as e:
+                error = e  # the next offer resumes where this one stopped
+        self.client._cb('on_error', f"File transfer of {self.name} failed: {error}")
+
+    def _transfer(self):
+        st = os.stat(self.path)
+        size = st.st_size
+        with socket.create_connection(self.target, timeout=30) as sock, open(self.path, 'rb') as f:
+            _send(sock, prot.OP_FILE_OFFER, self.client.nickname, transfer_id(self.client.nickname, self.path, st),
+                  self.name, size, self.chunk_size)
+            sock.settimeout(self.accept_timeout)
+            reply = prot.parse(recv_message(sock))
+            if reply.op == prot.OP_FILE_REJECT:
+                raise _Rejected()
+            if reply.op != prot.OP_FILE_ACCEPT or not 0 <= reply.offset <= size:
+                raise ValueError(f"Unexpected answer to file offer: {reply}")
+            sock.settimeout(30)
+            offset = reply.offset
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+            try:
+                with memoryview(mm if mm is not None else b'') as view:
+                    while offset < size:
+                        n = min(self.chunk_size, size - offset)
+                        _send(sock, prot.OP_FILE_CHUNK, offset, n, zlib.crc32(view[offset:offset + n]))
+                        sock.sendfile(f, offset, n)  # zero-copy where the OS supports it
+                        offset += n
+                        self.client._cb('on_file_progress', self.addr, self.name, offset, size)
+            finally:
+                if mm is not None:
+                    mm.close()
+            done = prot.parse(recv_message(sock))
+            if done.op != prot.OP_FILE_DONE or done.size != size:
+                raise ValueError(f"Receiver did not confirm the file: {done}")
+        self.client._cb('on_file_sent', self.addr, self.name, size)
+
+class _Rejected(Exception):
+    pass
+
+class FileReceiver:
+    """Receives one offered file into directory, on the accepted side connection."""
+
+    def __init__(self, client, addr, sock, offer, directory, bufsize: int = 64 * 1024):
+        self.client = client
+        self.addr = addr
+        self.sock = sock
+        self.offer = offer
+        self.directory = directory
+        self.name = safe_filename(offer.filename)
+        self.part = os.path.join(directory, f".{self.name}.{offer.transfer:08x}.part")
+        self.buf = bytearray(bufsize)
+        self.view = memoryview(self.buf)
+        self.answered = False
+
+    def respond(self, accept):
+        """Accept or decline the offer. Safe to call from any thread, once."""
+        if self.answered:
+            return
+        self.answered = True
+        if accept:
+            threading.Thread(target=self.run, daemon=True).start()
+            return
+        try:
+            _send(self.sock, prot.OP_FILE_REJECT, self.offer.transfer)
+        except OSError:
+            pass
+        self.sock.close()
+
+    def run(self):
+        offer = self.offer
+        try:
+            if not valid_offer(offer):
+                raise ValueError(f"Invalid chunk size {offer.chunk_size}")
+            self.sock.settimeout(30)
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self.part, 'ab') as f:
+                # Resume after the last complete chunk; a crash may have left half a chunk
+                have = f.tell()
+                offset = min(have - have % offer.chunk_size, offer.size)
+                f.truncate(offset)
+            with open(self.part, 'r+b') as f:
+                f.seek(offset)
+                _send(self.sock, prot.OP_FILE_ACCEPT, offer.transfer, offset)
+                while offset < offer.size:
+                    chunk = prot.parse(recv_message(self.sock))
+                    if chunk.op != prot.OP_FILE_CHUNK or chunk.offset != offset \
+                            or not 0 < chunk.length <= offer.chunk_size:
+                        raise ValueError(f"Unexpected file data: {chunk}")
+                    if not self._receive_chunk(f, chunk):
+                        f.truncate(offset)  # the sender resumes here with a new offer
+                        raise ValueError(f"Checksum mismatch at offset {offset}")
+                    offset += chunk.length
+                    self.client._cb('on_file_progress', self.addr, self.name, offset, offer.size)
+            path = self._final_path()
+            os.replace(self.part, path)
+            _send(self.sock, prot.OP_FILE_DONE, offer.transfer, offer.size)
+            self.client._cb('on_file_received', self.addr, self.name, path)
+        except (OSError, ValueError) as e:
+            self.client._cb('on_error', f"Receiving {self.name} failed: {e}")
+        finally:
+            self.sock.close()
+
+    def _receive_chunk(self, f, chunk) -> bool:
+        """Copy chunk.length bytes from the socket to f through the fixed buffer; check the CRC."""
+        remaining, crc = chunk.length, 0
+        while remaining:
+            n = self.sock.recv_into(self.view[:min(remaining, len(self.buf))])
+            if not n:
+                raise ConnectionError("Connection closed during file transfer")
+            crc = zlib.crc32(self.view[:n], crc)
+            f.write(self.view[:n])
+            remaining -= n
+        return crc == chunk.crc
+
+    def _final_path(self):
+        base, ext = os.path.splitext(self.name)
+        path, n = os.path.join(self.directory, self.name), 1
+        while os.path.exists(path):
+            path = os.path.join(self.directory, f"{base} ({n}){ext}")
+            n += 1
+        return path
@@ -2,11 +2,15 @@ import tkinter as tk
 from tkinter import ttk, messagebox, simpledialog
 import threading
 import time
+import os
+from client.store import MessageLog, identity_path
 from theme.colors import COLORS
 from gui.components.peer_list import PeerList
 from gui.components.chat_area import ChatArea
 from gui.components.message_entry import MessageEntry
 from gui.components.broadcast_box import BroadcastBox
+from gui.components.room_pane import RoomPane
+from gui.ui_queue import UiQueue
 
 class ChatFrame(ttk.Frame):
     def __init__(self, master, client, nickname, on_logout):
@@ -18,21 +22,33 @@ class ChatFrame(ttk.Frame):
         self.active_peer = None
         self.closed_chats = set()
         self.closing = False
+        self.ui = UiQueue(self)
+        self.data_dir = identity_path(os.path.join(os.path.expanduser("~"), ".peerchat"), nickname)
+        # PEERCHAT_TRACE=1 profiles the message path; Ctrl+Shift+T writes a flamegraph file
+        self.tracer = self.client.enable_tracing() if os.environ.get("PEERCHAT_TRACE") else None
+        # Chat messages are saved per nickname and shown again in later sessions
+        self.client.store = MessageLog(self.data_dir)
+        self.client.download_dir = os.path.join(self.data_dir, "files")
+        self.file_progress = {}  # (addr, filename) -> last reported quarter
+        for peer in reversed(self.client.store.recent_peers(self.client.pool.prewarm_count)):
+            self.client.pool.use(peer)  # pre-warmed once they show up in the roster
 
         self._setup_callbacks()
         self._build_ui()
+        self.ui.start()
 
-        # Start client threads
+        # Register in the background (blocking connect); the listeners run on the client's I/O loop
         threading.Thread(target=self.client.register, daemon=True).start()
-        threading.Thread(target=self.client.start_peer_server, args=(self.client.tcp_port,), daemon=True).start()
-        threading.Thread(target=self.client.start_udp_listener, args=(self._handle_udp_msg,), daemon=True).start()
+        self.client.start_peer_server(self.client.tcp_port)
+        self.client.start_udp_listener(self.ui.wrap(self._handle_udp_msg))
+        self.client.start_discovery()
 
         # Set window close handler
         self.master.protocol("WM_DELETE_WINDOW", self._on_close)
 
     def _setup_callbacks(self):
-        """Set up all client callbacks"""
-        self.client.set_callbacks(
+        """Set up all client callbacks (run on the Tk thread via the UI queue)"""
+        callbacks = dict(
             on_peer_message=self._on_peer_message,
             on_peer_connected=self._on_peer_connected,
             on_peer_disconnected=self._on_peer_disconnected,
@@ -49,8 +65,28 @@ class ChatFrame(ttk.Frame):
             on_broadcast=self._on_broadcast,
             on_peer_list=self._on_peer_list,
             on_nickname_taken=self._on_nickname_taken,
-            on_file_received=self._on_file_received
+            on_file_received=self._on_file_received,
+            on_file_offer=self._on_file_offer,
+            on_file_progress=self._on_file_progress,
+            on_file_sent=self._on_file_sent,
+            on_room_joined=self._on_room_joined,
+            on_room_left=self._on_room_left,
+            on_room_message=self._on_room_message
         )
+        if self.tracer is not None:
+            # Also time the callbacks where they really run, on the Tk thread
+            callbacks = {name: self.tracer.wrap(f"gui:{name}", cb) for name, cb in callbacks.items()}
+            self.master.bind("<Control-T>", self._dump_trace)
+        self.client.set_callbacks(**{name: self.ui.wrap(cb) for name, cb in callbacks.items()})
+
+    def _dump_trace(self, event=None):
+        """Write the collected profile as collapsed stacks (for flamegraph.pl, speedscope)"""
+        path = os.path.join(self.data_dir, time.strftime("trace-%Y%m%d-%H%M%S.folded"))
+        try:
+            self.tracer.dump_collapsed(path)
+            self._on_info(f"Trace written to {path}")
+        except OSError as e:
+            self._on_error(f"Could not write trace: {e}")
 
     def _build_ui(self):
         """Build the main UI layout"""
@@ -73,6 +109,10 @@ class ChatFrame(ttk.Frame):
         self.broadcast_box = BroadcastBox(self.left_frame, self.client)
         self.broadcast_box.pack(fill='x', padx=2, pady=(0,8))
 
+        # Group rooms component
+        self.room_pane = RoomPane(self.left_frame, self.client)
+        self.room_pane.pack(fill='x', padx=2, pady=(0,8))
+
         # Chat area component
         self.chat_area = ChatArea(self, self.client, self.nickname)
         self.chat_area.grid(row=0, column=1, sticky="nsew", pady=5, padx=(2,2))
@@ -111,6 +151,7 @@ class ChatFrame(ttk.Frame):
         """Handle incoming chat request"""
         if messagebox.askyesno("Chat Request", f"{peer_nick} wants to chat. Accept?"):
             respond(True)
+            self.closed_chats.discard(addr)  # a pooled connection may be reused for a new chat
             self.chat_area.append_chat("System", f"[Chat accepted with {peer_nick} {addr}]", color=COLORS['chat_accept'], peer=addr)
             self.active_peer = addr
             self.chat_area.active_peer = addr
@@ -128,6 +169,7 @@ class ChatFrame(ttk.Frame):
     def _on_chat_accept(self, addr, peer_nick):
         """Handle chat request acceptance"""
         self.client.peer_nicknames[addr] = peer_nick
+        self.closed_chats.discard(addr)
         self.chat_area.append_chat("System", f"[Chat accepted by {peer_nick} {addr}]", color=COLORS['chat_accept'], peer=addr)
         self.active_peer = addr
         self.chat_area.active_peer = addr
@@ -194,6 +236,15 @@ class ChatFrame(ttk.Frame):
             # This is a system broadcast (join/leave)
             self.broadcast_box.append_message(f"System: {nickname}")
 
+    def _on_room_joined(self, room, nickname):
+        self.room_pane.room_joined(room, nickname)
+
+    def _on_room_left(self, room, nickname):
+        self.room_pane.room_left(room, nickname)
+
+    def _on_room_message(self, room, nickname, msg):
+        self.room_pane.room_message(room, nickname, msg)
+
     def _handle_udp_msg(self, addr, msg):
         """Handle incoming UDP message"""
         self.chat_area.append_chat("System", f"[UDP from {addr}]: {msg}", color=COLORS['chat_udp'], peer=addr)
@@ -242,8 +293,10 @@ class ChatFrame(ttk.Frame):
                 self.chat_area.show_chat_history(peer_addr)
                 self.message_entry.set_state('normal')
             else:
-                sock = self.client.send_tcp_to_peer(peer_ip, tcp_port)
-                if sock:
+                # Reuses a pooled connection to this peer if there is one
+                peer_addr = self.client.chat_with(nickname)
+                if peer_addr:
+                    self.closed_chats.discard(peer_addr)
                     self.active_peer = peer_addr
                     self.chat_area.active_peer = peer_addr
                     self.chat_area.show_chat_history(peer_addr)
@@ -256,13 +309,25 @@ class ChatFrame(ttk.Frame):
         except Exception as e:
             messagebox.showinfo("Connection failed", f"Could not connect to {nickname}: {e}")
 
+    def destroy(self):
+        self.ui.stop()
+        if self.tracer is not None:
+            self.master.unbind("<Control-T>")
+        if self.client.store is not None:
+            self.client.store.close()
+            self.client.store = None
+        super().destroy()
+
     def _on_close(self):
         """Handle window closing"""
         self.closing = True
+        self.ui.stop()
         # Close all chats and notify peers
         if self.client:
             for addr in list(self.client.peer_socks.keys()):
                 self.client.close_chat(addr)
+            if self.client.discovery:
+                self.client.discovery.stop()
         self.master.destroy()
 
     def _on_peer_list(self, peers):
@@ -274,8 +339,31 @@ class ChatFrame(ttk.Frame):
         messagebox.showerror("Error", "Nickname already taken")
         self.on_logout()
 
-    def _on_file_received(self, addr, filename, data):
-        """Handle received file"""
-        self.chat_area.append_chat("System", f"[File received from {addr}: {filename}]",
+    def _on_file_received(self, addr, filename, path):
+        """Handle received file (already saved to path)"""
+        self.file_progress.pop((addr, filename), None)
+        self.chat_area.append_chat("System", f"[File received from {addr}: {filename} -> {path}]",
                                  color=COLORS['system_info'],
-                                 peer=addr)
\ No newline at end of file
+                                 peer=addr)
+
+    def _on_file_offer(self, addr, peer_nick, filename, size, respond):
+        """Ask whether to accept an offered file"""
+        accept = messagebox.askyesno("File Transfer", f"{peer_nick} wants to send you {filename} ({size:,} bytes). Accept?")
+        respond(accept)
+        if accept:
+            self.chat_area.append_chat("System", f"[Receiving {filename} from {peer_nick}]",
+                                     color=COLORS['system_info'], peer=addr)
+
+    def _on_file_progress(self, addr, filename, done, size):
+        """Report transfer progress in steps of 25%"""
+        quarter = done * 4 // size if size else 4
+        if quarter > self.file_progress.get((addr, filename), 0) and quarter < 4:
+            self.chat_area.append_chat("System", f"[{filename}: {quarter * 25}%]",
+                                     color=COLORS['system_info'], peer=addr)
+        self.file_progress[(addr, filename)] = quarter
+
+    def _on_file_sent(self, addr, filename, size):
+        """Handle a completed upload"""
+        self.file_progress.pop((addr, filename), None)
+        self.chat_area.append_chat("System", f"[File sent: {filename} ({size:,} bytes)]",
+                                 color=COLORS['system_info'], peer=addr)
\ No newline at end of file
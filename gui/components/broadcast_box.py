@@ -8,6 +8,8 @@ class BroadcastBox(ttk.Frame):
     def __init__(self, master, client):
         super().__init__(master)
         self.client = client
+        self.pending = []  # text, tag, ... not yet in the widget
+        self.flush_id = None
 
         # Configure frame to fill horizontally
         self.pack(fill='x', expand=True)
@@ -67,16 +69,26 @@ class BroadcastBox(ttk.Frame):
             message: The message to display
             is_error: Whether this is an error message
         """
-        self.text.configure(state="normal")
         timestamp = time.strftime("%H:%M:%S")
         tag = 'error' if is_error else 'broadcast'
-        self.text.insert(tk.END, f"[{timestamp}] ", 'timestamp')
-        self.text.insert(tk.END, f"{message}\n", tag)
+        self.pending += (f"[{timestamp}] ", 'timestamp', f"{message}\n", tag)
+        if self.flush_id is None:
+            self.flush_id = self.after_idle(self.flush)
+
+    def flush(self):
+        """Insert all pending messages with a single insert call"""
+        self.flush_id = None
+        if not self.pending:
+            return
+        chunks, self.pending = self.pending, []
+        self.text.configure(state="normal")
+        self.text.insert(tk.END, *chunks)
         self.text.configure(state="disabled")
         self.text.see(tk.END)
 
     def clear(self):
         """Clear the broadcast box"""
+        self.pending = []
         self.text.configure(state="normal")
         self.text.delete(1.0, tk.END)
         self.text.configure(state="disabled")
\ No newline at end of file
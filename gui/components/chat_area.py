@@ -2,15 +2,41 @@ import tkinter as tk
 from tkinter import ttk
 from theme.colors import COLORS
 from gui.theme import Theme
+from client.history import HistoryStore
 import time
 
 class ChatArea(ttk.Frame):
-    def __init__(self, master, client, nickname):
+    """Chat display that renders only a window of the active conversation.
+
+    Every conversation is kept in a bounded HistoryStore and messages are
+    addressed by position. The text widget shows positions [first, last): switching
+    peers renders just the newest `window` records, older ones are loaded a
+    `page` at a time when the view is scrolled to the top, and the widget is
+    trimmed to `max_messages` records on the side away from the view.
+
+    Messages saved in earlier sessions (client.store) sit at negative
+    positions before the conversation. The newest `window` of them are read
+    once the peer's nickname is known, and older ones a `page` at a time
+    when scrolling reaches the top.
+    """
+
+    def __init__(self, master, client, nickname, window: int = 200, page: int = 100, max_messages: int = 600,
+                 history: HistoryStore = None):
         super().__init__(master)
         self.client = client
         self.nickname = nickname
         self.active_peer = None
-        self.chat_history = {}
+        self.history = history or HistoryStore()  # keyed by peer address (None: no chat open)
+        self.window = window
+        self.page = page
+        self.max_messages = max_messages
+        self.first = self.last = 0  # rendered slice of the active history
+        self.rendered_lines = []    # text lines of each rendered record
+        self.flush_id = None
+        self.load_id = None
+        self.started = time.time()  # saved messages from before this are from earlier sessions
+        self.saved = {}  # peer address -> saved (time, sender, message, tag), oldest first
+        self.saved_done = set()  # peers whose saved messages are all loaded
 
         # Chat text area
         self.text = tk.Text(self, wrap=tk.WORD, state="disabled",
@@ -42,7 +68,31 @@ class ChatArea(ttk.Frame):
         # Create scrollbar
         scrollbar = ttk.Scrollbar(self, orient='vertical', command=self.text.yview)
         scrollbar.pack(side='right', fill='y')
-        self.text['yscrollcommand'] = scrollbar.set
+        self.scrollbar = scrollbar
+        self.text['yscrollcommand'] = self._on_scroll
+
+    def _tag(self, sender, color):
+        if not color:
+            if sender == self.nickname:
+                return 'user'
+            if sender == "System":
+                return 'system'
+            return 'peer'
+        # Map color to tag if possible
+        tag_map = {
+            COLORS['user_text']: 'user',
+            COLORS['peer_text']: 'peer',
+            COLORS['system_info']: 'system',
+            COLORS['system_error']: 'error',
+            COLORS['broadcast']: 'broadcast',
+            COLORS['chat_left']: 'left',
+            COLORS['chat_accept']: 'accept',
+            COLORS['chat_reject']: 'reject',
+            COLORS['chat_connected']: 'connected',
+            COLORS['chat_disconnected']: 'disconnected',
+            COLORS['chat_udp']: 'udp',
+        }
+        return tag_map.get(color, 'peer')
 
     def append_chat(self, sender, message, color=None, peer=None):
         """Add a message to the chat display
@@ -53,72 +103,143 @@ class ChatArea(ttk.Frame):
             color: Optional color override for the message
             peer: Optional peer address for storing in specific chat history
         """
-        if not color:
-            if sender == self.nickname:
-                tag = 'user'
-                color = COLORS['user_text']
-            elif sender == "System":
-                tag = 'system'
-                color = COLORS['system_info']
-            else:
-                tag = 'peer'
-                color = COLORS['peer_text']
-        else:
-            # Map color to tag if possible
-            tag_map = {
-                COLORS['user_text']: 'user',
-                COLORS['peer_text']: 'peer',
-                COLORS['system_info']: 'system',
-                COLORS['system_error']: 'error',
-                COLORS['broadcast']: 'broadcast',
-                COLORS['chat_left']: 'left',
-                COLORS['chat_accept']: 'accept',
-                COLORS['chat_reject']: 'reject',
-                COLORS['chat_connected']: 'connected',
-                COLORS['chat_disconnected']: 'disconnected',
-                COLORS['chat_udp']: 'udp',
-            }
-            tag = tag_map.get(color, 'peer')
-
-        self.text.configure(state="normal")
-        timestamp = time.strftime("%H:%M:%S")
-        self.text.insert(tk.END, f"[{timestamp}] ", 'timestamp')
-        self.text.insert(tk.END, f"{sender}: ", tag)
-        self.text.insert(tk.END, f"{message}\n", tag)
-        self.text.configure(state="disabled")
-        self.text.see(tk.END)
-
-        # Store in chat history
         target_peer = peer if peer is not None else self.active_peer
-        if target_peer:
-            if target_peer not in self.chat_history:
-                self.chat_history[target_peer] = []
-            self.chat_history[target_peer].append((sender, message, color))
+        if target_peer not in self.saved:
+            self._load_saved(target_peer)
+        self.history.add(target_peer, time.time(), sender, message, self._tag(sender, color))
+        # Rendered on the next idle callback together with everything else appended until then
+        if target_peer == self.active_peer and self.flush_id is None:
+            self.flush_id = self.after_idle(self.flush)
 
     def show_chat_history(self, peer_addr):
-        """Display chat history for the given peer"""
+        """Display chat history for the given peer (newest messages only, older ones load on scroll)"""
         self.active_peer = peer_addr
+        if peer_addr not in self.saved:
+            self._load_saved(peer_addr)
+        self.first = self.last = max(self._oldest(), len(self.history.get(peer_addr)) - self.window)
+        self.rendered_lines = []
         self.text.configure(state="normal")
         self.text.delete(1.0, tk.END)
+        self.text.configure(state="disabled")
+        self.flush()
+
+    def _load_saved(self, peer_addr):
+        """Start a conversation with the newest messages saved in earlier sessions"""
+        if getattr(self.client, 'store', None) is None or peer_addr is None:
+            return
+        if self.client.peer_nicknames.get(peer_addr) is None:
+            return  # not known before the chat is accepted; tried again with the next message
+        self.saved[peer_addr] = []
+        self._read_saved(peer_addr, self.window)
+
+    def _read_saved(self, peer_addr, n):
+        """Read up to n saved messages older than those already loaded"""
+        saved = self.saved[peer_addr]
+        before = saved[0][0] if saved else self.started
+        older = self.client.store.last(self.client.peer_nicknames.get(peer_addr), n, before=before)
+        if len(older) < n:
+            self.saved_done.add(peer_addr)
+        saved[:0] = [(timestamp, sender, message, 'user' if sender == self.nickname else 'peer')
+                     for timestamp, sender, message in older]
+
+    def _oldest(self):
+        """Position of the oldest loaded record of the active conversation"""
+        history = self.history.get(self.active_peer)
+        if history.start:
+            return history.start  # older records left memory; saved ones would not follow on
+        return -len(self.saved.get(self.active_peer, ()))
+
+    def _more_saved(self):
+        peer = self.active_peer
+        return peer in self.saved and peer not in self.saved_done and not self.history.get(peer).start
+
+    def _records(self, start, stop):
+        """Records at positions [start, stop) of the active conversation, saved ones included"""
+        records = []
+        if start < 0:
+            saved = self.saved.get(self.active_peer, [])
+            records = saved[max(0, len(saved) + start):len(saved) + min(stop, 0)]
+        return records + self.history.get(self.active_peer).slice(max(start, 0), stop)
 
-        if peer_addr in self.chat_history:
-            for sender, message, color in self.chat_history[peer_addr]:
-                if sender == self.nickname:
-                    tag = 'user'
-                elif sender == "System":
-                    tag = 'system'
-                else:
-                    tag = 'peer'
-                timestamp = time.strftime("%H:%M:%S")
-                self.text.insert(tk.END, f"[{timestamp}] ", 'timestamp')
-                self.text.insert(tk.END, f"{sender}: ", tag)
-                self.text.insert(tk.END, f"{message}\n", tag)
+    def _render(self, records):
+        """Text/tag chunks for a single insert call, and the line count of each record."""
+        chunks, lines = [], []
+        for timestamp, sender, message, tag in records:
+            line = f"{sender}: {message}\n"
+            chunks += (time.strftime("[%H:%M:%S] ", time.localtime(timestamp)), 'timestamp', line, tag)
+            lines.append(line.count("\n"))
+        return chunks, lines
 
+    def flush(self):
+        """Insert all messages added since the last flush with a single insert call"""
+        self.flush_id = None
+        history = self.history.get(self.active_peer)
+        if self.last >= len(history):
+            return
+        top, bottom = self.text.yview()
+        if self.last > self.first and bottom < 1.0:
+            return  # the user scrolled up; newer messages load when they scroll back down
+        if len(history) - self.last > self.max_messages:
+            self.show_chat_history(self.active_peer)  # more new messages than fit: start over
+            return
+        chunks, lines = self._render(self._records(self.last, len(history)))
+        self.last = len(history)
+        self.rendered_lines += lines
+        self.text.configure(state="normal")
+        self.text.insert(tk.END, *chunks)
+        self._trim_top()
         self.text.configure(state="disabled")
         self.text.see(tk.END)
 
+    def _trim_top(self):
+        excess = len(self.rendered_lines) - self.max_messages
+        if excess > 0:
+            count = sum(self.rendered_lines[:excess])
+            self.text.delete("1.0", f"{count + 1}.0")
+            del self.rendered_lines[:excess]
+            self.first += excess
+
+    def _trim_bottom(self):
+        excess = len(self.rendered_lines) - self.max_messages
+        if excess > 0:
+            count = sum(self.rendered_lines[-excess:])
+            total = int(self.text.index("end-1c").split(".")[0]) - 1
+            self.text.delete(f"{total - count + 1}.0", "end-1c")
+            del self.rendered_lines[-excess:]
+            self.last -= excess
+
+    def _on_scroll(self, top, bottom):
+        self.scrollbar.set(top, bottom)
+        history = self.history.get(self.active_peer)
+        if self.load_id is None and ((float(top) <= 0.0 and (self.first > self._oldest() or self._more_saved())) or
+                                     (float(bottom) >= 1.0 and self.last < len(history))):
+            self.load_id = self.after_idle(self._load_more)
+
+    def _load_more(self):
+        """Load older messages at the top or newer ones at the bottom, keeping the visible text in place"""
+        self.load_id = None
+        top, bottom = self.text.yview()
+        if top <= 0.0 and self.first - self.page < self._oldest() and self._more_saved():
+            self._read_saved(self.active_peer, self.page)
+        oldest = self._oldest()
+        if top <= 0.0 and self.first > oldest:
+            start = max(oldest, self.first - self.page)
+            chunks, lines = self._render(self._records(start, self.first))
+            visible = self.text.index("@0,0")
+            self.text.configure(state="normal")
+            self.text.insert("1.0", *chunks)
+            self.rendered_lines[:0] = lines
+            self.first = start
+            self._trim_bottom()
+            self.text.configure(state="disabled")
+            self.text.yview(self.text.index(f"{visible} + {sum(lines)} lines"))
+        elif bottom >= 1.0:
+            self.flush()
+
     def clear(self):
         """Clear the chat area"""
+        self.first = self.last = len(self.history.get(self.active_peer))
+        self.rendered_lines = []
         self.text.configure(state="normal")
         self.text.delete(1.0, tk.END)
-        self.text.configure(state="disabled")
\ No newline at end of file
+        self.text.configure(state="disabled")
@@ -1,5 +1,6 @@
+import os
 import tkinter as tk
-from tkinter import ttk
+from tkinter import ttk, filedialog
 from theme.colors import COLORS
 from gui.theme import Theme
 
@@ -33,6 +34,18 @@ class MessageEntry(ttk.Frame):
                                 highlightbackground=COLORS['accent'])
         self.send_btn.grid(row=0, column=1, padx=(0,8))
 
+        # Send file button
+        self.file_btn = tk.Button(self, text="Send File", command=self._on_send_file,
+                                 font=Theme.get_button_font(),
+                                 bg=COLORS['button_bg'],
+                                 fg=COLORS['button_text'],
+                                 activebackground=COLORS['button_hover'],
+                                 activeforeground=COLORS['button_text'],
+                                 borderwidth=0, relief='flat',
+                                 highlightthickness=2,
+                                 highlightbackground=COLORS['accent'])
+        self.file_btn.grid(row=0, column=2, padx=(0,8))
+
         # Close chat button
         self.close_chat_btn = tk.Button(self, text="Close Chat", command=self._on_close_chat,
                                        font=Theme.get_button_font(),
@@ -43,7 +56,7 @@ class MessageEntry(ttk.Frame):
                                        borderwidth=0, relief='flat',
                                        highlightthickness=2,
                                        highlightbackground=COLORS['accent'])
-        self.close_chat_btn.grid(row=0, column=2)
+        self.close_chat_btn.grid(row=0, column=3)
 
         # Initially disable controls
         self.set_state('disabled')
@@ -69,6 +82,16 @@ class MessageEntry(ttk.Frame):
         except Exception as e:
             self.chat_area.append_chat("System", f"[Error] Failed to send message: {str(e)}", color=COLORS['system_error'])
 
+    def _on_send_file(self):
+        """Stream a file to the active peer (in the background)"""
+        peer = self.chat_area.active_peer
+        if not peer or peer not in self.client.peer_socks:
+            return
+        path = filedialog.askopenfilename(parent=self, title="Send File")
+        if path:
+            self.client.send_file(peer, path)
+            self.chat_area.append_chat("System", f"[Sending file {os.path.basename(path)}]", color=COLORS['system_info'])
+
     def _on_close_chat(self):
         """Handle chat closing"""
         if self.chat_area.active_peer:
@@ -86,4 +109,5 @@ class MessageEntry(ttk.Frame):
         else:
             self.entry.config(bg=COLORS['entry_bg'], fg=COLORS['chat_input'])
         self.send_btn.config(state=state)
+        self.file_btn.config(state=state)
         self.close_chat_btn.config(state=state)
\ No newline at end of file
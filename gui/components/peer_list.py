@@ -7,6 +7,8 @@ class PeerList(ttk.Frame):
     def __init__(self, master, client):
         super().__init__(master)
         self.client = client
+        self.local_nickname = None
+        self.redraw_id = None
 
         # Peer list label
         self.peer_list_label = tk.Label(self, text="Peer list",
@@ -49,12 +51,19 @@ class PeerList(ttk.Frame):
         self.logged_in_label.pack(anchor='w', pady=(0,8))
 
     def refresh_peers(self, peers, local_nickname):
-        """Update the peer list display"""
+        """Update the peer list display (once per batch of roster changes)"""
+        self.local_nickname = local_nickname
+        if self.redraw_id is None:
+            self.redraw_id = self.after_idle(self._redraw)
+
+    def _redraw(self):
+        self.redraw_id = None
+        local_nickname = self.local_nickname
         self.listbox.delete(0, tk.END)
 
         # Create a list of nicknames from peers
         nicknames = []
-        for nickname, peer_info in self.client.peers.items():
+        for nickname, peer_info in list(self.client.peers.items()):
             # Skip own nickname
             if nickname == local_nickname:
                 continue
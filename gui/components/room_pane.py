@@ -0,0 +1,159 @@
+import tkinter as tk
+from tkinter import ttk, simpledialog
+from collections import deque
+from theme.colors import COLORS
+from gui.theme import Theme
+import time
+
+class RoomPane(ttk.Frame):
+    """Joined group rooms and the messages of the selected one"""
+
+    def __init__(self, master, client, history: int = 500):
+        super().__init__(master)
+        self.client = client
+        self.history = history
+        self.rooms = []     # joined rooms in listbox order
+        self.lines = {}     # room -> deque of (text, tag)
+        self.active = None  # room shown in the text area
+        self.pending = []   # text, tag, ... of the active room not yet in the widget
+        self.flush_id = None
+
+        # Rooms label
+        self.rooms_label = tk.Label(self, text="Rooms",
+                                    font=Theme.get_header_font(),
+                                    bg=COLORS['background'],
+                                    fg=COLORS['text'],
+                                    anchor='w')
+        self.rooms_label.pack(fill='x', padx=2, pady=(0,2))
+
+        # Joined rooms
+        self.listbox = tk.Listbox(self, height=4, width=20,
+                                  font=Theme.get_text_font(),
+                                  bg=COLORS['chat_bg'],
+                                  fg=COLORS['button_text'],
+                                  highlightbackground=COLORS['border'],
+                                  highlightthickness=1,
+                                  selectbackground=COLORS['button_hover'],
+                                  selectforeground=COLORS['button_text'],
+                                  exportselection=False,
+                                  borderwidth=1, relief='solid')
+        self.listbox.pack(fill='x', padx=2, pady=(0,4))
+        self.listbox.bind("<<ListboxSelect>>", self._on_select)
+
+        # Messages of the selected room
+        self.text = tk.Text(self, wrap=tk.WORD, state="disabled",
+                            font=Theme.get_text_font(),
+                            width=1, height=6,
+                            bg=COLORS['chat_bg'],
+                            fg=COLORS['text'],
+                            insertbackground=COLORS['accent'],
+                            borderwidth=1, relief='solid',
+                            highlightbackground=COLORS['border'],
+                            highlightthickness=1)
+        self.text.pack(fill='x', padx=2, pady=(0,4))
+        self.text.tag_config('timestamp', foreground=COLORS['timestamp'])
+        self.text.tag_config('own', foreground=COLORS['user_text'])
+        self.text.tag_config('member', foreground=COLORS['peer_text'])
+        self.text.tag_config('info', foreground=COLORS['system_info'])
+
+        # Join / Message / Leave buttons
+        buttons = ttk.Frame(self)
+        buttons.pack(fill='x', padx=2, pady=(0,8))
+        for column, (label, command) in enumerate((("Join", self._on_join), ("Message", self._on_send),
+                                                   ("Leave", self._on_leave))):
+            buttons.columnconfigure(column, weight=1)
+            tk.Button(buttons, text=label, command=command,
+                      font=Theme.get_button_font(),
+                      bg=COLORS['button_bg'],
+                      fg=COLORS['button_text'],
+                      activebackground=COLORS['button_hover'],
+                      activeforeground=COLORS['button_text'],
+                      borderwidth=0, relief='flat',
+                      highlightthickness=2,
+                      highlightbackground=COLORS['accent']).grid(row=0, column=column, sticky="ew",
+                                                                 padx=(0 if column == 0 else 4, 0))
+
+    def _on_join(self):
+        room = simpledialog.askstring("Join Room", "Room name:", parent=self)
+        if room and room.strip():
+            self.client.join_room(room.strip())
+
+    def _on_send(self):
+        if self.active is None:
+            return
+        msg = simpledialog.askstring("Room Message", f"Message to {self.active}:", parent=self)
+        if msg and msg.strip():
+            self.client.send_room_message(self.active, msg.strip())  # shown when the server echoes it
+
+    def _on_leave(self):
+        if self.active is not None:
+            self.client.part_room(self.active)
+
+    def _on_select(self, event=None):
+        selection = self.listbox.curselection()
+        if selection:
+            self._show(self.rooms[selection[0]])
+
+    def _show(self, room):
+        """Display the history of room"""
+        self.active = room
+        self.pending = []
+        chunks = []
+        for text, tag in self.lines.get(room, ()):
+            chunks += (text[:11], 'timestamp', text[11:], tag)
+        self.text.configure(state="normal")
+        self.text.delete(1.0, tk.END)
+        if chunks:
+            self.text.insert(tk.END, *chunks)
+        self.text.configure(state="disabled")
+        self.text.see(tk.END)
+
+    def _append(self, room, line, tag):
+        text = f"[{time.strftime('%H:%M:%S')}] {line}\n"
+        self.lines.setdefault(room, deque(maxlen=self.history)).append((text, tag))
+        if room == self.active:
+            self.pending += (text[:11], 'timestamp', text[11:], tag)
+            if self.flush_id is None:
+                self.flush_id = self.after_idle(self.flush)
+
+    def flush(self):
+        """Insert all pending lines of the active room with a single insert call"""
+        self.flush_id = None
+        if not self.pending:
+            return
+        chunks, self.pending = self.pending, []
+        self.text.configure(state="normal")
+        self.text.insert(tk.END, *chunks)
+        self.text.configure(state="disabled")
+        self.text.see(tk.END)
+
+    def room_joined(self, room, nickname):
+        if nickname != self.client.nickname:
+            self._append(room, f"{nickname} joined", 'info')
+            return
+        if room not in self.rooms:
+            self.rooms.append(room)
+            self.listbox.insert(tk.END, room)
+        self._append(room, "You joined", 'info')
+        self.listbox.selection_clear(0, tk.END)
+        self.listbox.selection_set(self.rooms.index(room))
+        self._show(room)
+
+    def room_left(self, room, nickname):
+        if nickname != self.client.nickname:
+            self._append(room, f"{nickname} left", 'info')
+            return
+        if room in self.rooms:
+            self.listbox.delete(self.rooms.index(room))
+            self.rooms.remove(room)
+        self.lines.pop(room, None)
+        if room == self.active:
+            self.active = None
+            self.pending = []
+            self.text.configure(state="normal")
+            self.text.delete(1.0, tk.END)
+            self.text.configure(state="disabled")
+
+    def room_message(self, room, nickname, message):
+        own = nickname == self.client.nickname
+        self._append(room, f"{'You' if own else nickname}: {message}", 'own' if own else 'member')
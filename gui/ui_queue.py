@@ -0,0 +1,49 @@
+import time
+from collections import deque
+
+class UiQueue:
+    """Hands client callbacks from network threads to the Tk main loop.
+
+    Network threads only append to a deque (thread-safe); the Tk thread
+    drains it on an `after` timer and runs the callbacks there. Widgets
+    buffer what those callbacks add and redraw once per drain, so a flood
+    of messages costs one insert per frame instead of one per message.
+    """
+
+    def __init__(self, widget, interval: int = 16, budget: float = 0.02):
+        self.widget = widget
+        self.interval = interval  # ms between drains
+        self.budget = budget      # max seconds of callbacks per drain, keeps input responsive
+        self.events = deque()
+        self.after_id = None
+
+    def post(self, fn, *args, **kwargs):
+        """Run fn(*args, **kwargs) on the Tk thread. Safe to call from any thread."""
+        self.events.append((fn, args, kwargs))
+
+    def wrap(self, fn):
+        """Return a callback that posts fn instead of calling it."""
+        def posted(*args, **kwargs):
+            self.post(fn, *args, **kwargs)
+        return posted
+
+    def start(self):
+        if self.after_id is None:
+            self.after_id = self.widget.after(self.interval, self._drain)
+
+    def stop(self):
+        if self.after_id is not None:
+            self.widget.after_cancel(self.after_id)
+            self.after_id = None
+
+    def _drain(self):
+        self.after_id = None
+        deadline = time.monotonic() + self.budget
+        try:
+            while self.events and time.monotonic() < deadline:
+                fn, args, kwargs = self.events.popleft()
+                fn(*args, **kwargs)
+        finally:
+            # A callback may have destroyed the window (e.g. logout)
+            if self.widget.winfo_exists():
+                self.after_id = self.widget.after(self.interval, self._drain)
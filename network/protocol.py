@@ -1,33 +1,99 @@
 """
 Protocol message formats and parsing utilities for PeerChat.
 """
+import socket
+from typing import NamedTuple
+from network.tcp import encode_message, encode_frame_v2, encode_varint, decode_varint
+
+# --- Text body parsers (the part after the command word) ---
+def _register_body(content: str):
+    # Accepts: "nickname with spaces" <udp_port>  or  nickname <udp_port>
+    content = content.strip()
+    if content.startswith('"'):
+        end_quote = content.find('"', 1)
+        if end_quote == -1:
+            return None
+        nickname = content[1:end_quote]
+        rest = content[end_quote+1:].strip()
+        try:
+            udp_port = int(rest)
+            return nickname, udp_port
+        except Exception:
+            return None
+    # fallback for old format (no quotes)
+    parts = content.rsplit(' ', 1)
+    if len(parts) == 2:
+        nickname, port_str = parts
+        try:
+            return nickname, int(port_str)
+        except ValueError:
+            return None
+    return None
+
+def _joined_body(content: str):
+    # Accepts: "nickname with spaces" <ip> <udp_port> <tcp_port>  or  nickname <ip> <udp_port> <tcp_port>
+    content = content.strip()
+    if content.startswith('"'):
+        end_quote = content.find('"', 1)
+        if end_quote == -1:
+            return None
+        nickname = content[1:end_quote]
+        rest = content[end_quote+1:].strip().split()
+        if len(rest) == 3:
+            ip, udp_str, tcp_str = rest
+            try:
+                return nickname, ip, int(udp_str), int(tcp_str)
+            except ValueError:
+                return None
+        return None
+    parts = content.split()
+    if len(parts) == 4:
+        nickname, ip, udp_str, tcp_str = parts
+        try:
+            return nickname, ip, int(udp_str), int(tcp_str)
+        except ValueError:
+            return None
+    return None
+
+def _port_body(content: str):
+    # Accepts: <nickname_with_spaces> <tcp_port>
+    parts = content.strip().rsplit(' ', 1)
+    if len(parts) == 2:
+        nickname, port_str = parts
+        try:
+            return nickname, int(port_str)
+        except ValueError:
+            return None
+    return None
+
+def _chat_msg_body(content: str):
+    # Accepts: "<nickname_with_spaces>" <message_content>
+    content = content.strip()
+    if not content.startswith('"'):
+        # Fallback for old format or unquoted nickname (treat first word as nick)
+        parts = content.split(' ', 1)
+        if len(parts) == 2:
+            return parts[0], parts[1]
+        elif len(parts) == 1: # Nickname only, empty message
+            return parts[0], ""
+        return None
+    end_quote_idx = content.find('"', 1)
+    if end_quote_idx == -1:
+        return None # Malformed, no closing quote
+    nickname = content[1:end_quote_idx]
+    message = content[end_quote_idx+1:].lstrip() # +1 to skip quote, lstrip for space after quote
+    return nickname, message
+
+def _nickname_body(content: str):
+    nickname = content.strip()
+    return nickname if nickname else None
 
 # --- Client-Server Protocol ---
 def parse_register(msg: str):
     # Accepts: REGISTER "nickname with spaces" <udp_port>
     prefix = "REGISTER "
     if msg.startswith(prefix):
-        content = msg[len(prefix):].strip()
-        if content.startswith('"'):
-            end_quote = content.find('"', 1)
-            if end_quote == -1:
-                return None
-            nickname = content[1:end_quote]
-            rest = content[end_quote+1:].strip()
-            try:
-                udp_port = int(rest)
-                return nickname, udp_port
-            except Exception:
-                return None
-        else:
-            # fallback for old format (no quotes)
-            parts = content.rsplit(' ', 1)
-            if len(parts) == 2:
-                nickname, port_str = parts
-                try:
-                    return nickname, int(port_str)
-                except ValueError:
-                    return None
+        return _register_body(msg[len(prefix):])
     return None
 
 def make_register(nickname: str, udp_port: int) -> str:
@@ -42,28 +108,7 @@ def parse_joined(msg: str):
     # Accepts: JOINED "nickname with spaces" <ip> <udp_port> <tcp_port>
     prefix = "JOINED "
     if msg.startswith(prefix):
-        content = msg[len(prefix):].strip()
-        if content.startswith('"'):
-            end_quote = content.find('"', 1)
-            if end_quote == -1:
-                return None
-            nickname = content[1:end_quote]
-            rest = content[end_quote+1:].strip().split()
-            if len(rest) == 3:
-                ip, udp_str, tcp_str = rest
-                try:
-                    return nickname, ip, int(udp_str), int(tcp_str)
-                except ValueError:
-                    return None
-        else:
-            # Fallback for unquoted nickname: parts = nickname ip udp tcp
-            parts = content.split()
-            if len(parts) == 4:
-                nickname, ip, udp_str, tcp_str = parts
-                try:
-                    return nickname, ip, int(udp_str), int(tcp_str)
-                except ValueError:
-                    return None
+        return _joined_body(msg[len(prefix):])
     return None
 
 def make_left(nickname: str) -> str:
@@ -76,14 +121,7 @@ def parse_port(msg: str):
     # Message format: PORT <nickname_with_spaces> <tcp_port>
     prefix = "PORT "
     if msg.startswith(prefix):
-        content = msg[len(prefix):].strip()
-        parts = content.rsplit(' ', 1)
-        if len(parts) == 2:
-            nickname, port_str = parts
-            try:
-                return nickname, int(port_str)
-            except ValueError:
-                return None
+        return _port_body(msg[len(prefix):])
     return None
 
 def make_port(nickname: str, tcp_port: int) -> str:
@@ -99,8 +137,7 @@ def is_chat_request(msg: str):
 def parse_chat_request(msg: str):
     prefix = "CHAT_REQUEST "
     if msg.startswith(prefix):
-        nickname = msg[len(prefix):].strip()
-        return nickname if nickname else None
+        return _nickname_body(msg[len(prefix):])
     return None
 
 def make_chat_accept(nickname: str) -> str:
@@ -112,8 +149,7 @@ def is_chat_accept(msg: str):
 def parse_chat_accept(msg: str):
     prefix = "CHAT_ACCEPT "
     if msg.startswith(prefix):
-        nickname = msg[len(prefix):].strip()
-        return nickname if nickname else None
+        return _nickname_body(msg[len(prefix):])
     return None
 
 def make_chat_reject(nickname: str) -> str:
@@ -125,8 +161,7 @@ def is_chat_reject(msg: str):
 def parse_chat_reject(msg: str):
     prefix = "CHAT_REJECT "
     if msg.startswith(prefix):
-        nickname = msg[len(prefix):].strip()
-        return nickname if nickname else None
+        return _nickname_body(msg[len(prefix):])
     return None
 
 def make_left_chat(nickname: str) -> str:
@@ -138,8 +173,7 @@ def is_left_chat(msg: str):
 def parse_left_chat(msg: str):
     prefix = "LEFT_CHAT "
     if msg.startswith(prefix):
-        nickname = msg[len(prefix):].strip()
-        return nickname if nickname else None
+        return _nickname_body(msg[len(prefix):])
     return None
 
 def make_chat_msg(nickname: str, message: str) -> str:
@@ -153,25 +187,7 @@ def parse_chat_msg(msg: str):
     prefix = "CHAT_MSG "
     if not msg.startswith(prefix):
         return None
-    content = msg[len(prefix):].strip()
-
-    if not content.startswith('"'):
-        # Fallback for old format or unquoted nickname (treat first word as nick)
-        # This part can be removed if strict quoting is enforced everywhere
-        parts = content.split(' ', 1)
-        if len(parts) == 2:
-            return parts[0], parts[1]
-        elif len(parts) == 1: # Nickname only, empty message
-             return parts[0], ""
-        return None
-
-    end_quote_idx = content.find('"', 1)
-    if end_quote_idx == -1:
-        return None # Malformed, no closing quote
-
-    nickname = content[1:end_quote_idx]
-    message = content[end_quote_idx+1:].lstrip() # +1 to skip quote, lstrip for space after quote
-    return nickname, message
+    return _chat_msg_body(msg[len(prefix):])
 
 # --- Error/Conflict Protocol ---
 def make_error(reason: str) -> str:
@@ -188,4 +204,483 @@ def make_nickname_taken() -> str:
     return "NICKNAME_TAKEN"
 
 def is_nickname_taken(msg: str):
-    return msg.strip() == "NICKNAME_TAKEN"
\ No newline at end of file
+    return msg.strip() == "NICKNAME_TAKEN"
+
+# --- Binary Protocol v2 ---
+# Frame: V2_MAGIC, varint payload length, payload (see network/tcp.py).
+# Payload: one opcode byte followed by the fields listed in V2_SCHEMAS:
+#   's' varint length + UTF-8 string    'a' 1-byte length + packed IP address
+#   'H' unsigned 16-bit big-endian      'B' unsigned 8-bit
+#   'I' unsigned 32-bit big-endian      'V' varint
+#   'R' varint count + roster entries   'D' varint count + roster changes
+#   'b' varint length + raw bytes
+# Fields missing at the end of a payload decode as None, so later versions
+# can append fields without breaking older receivers.
+PROTOCOL_V1 = 1  # text protocol
+PROTOCOL_V2 = 2  # binary protocol
+
+OP_REGISTER = 0x01
+OP_WELCOME = 0x02
+OP_PORT = 0x03
+OP_JOINED = 0x04
+OP_LEFT = 0x05
+OP_BROADCAST = 0x06
+OP_NICKNAME_TAKEN = 0x07
+OP_ERROR = 0x08
+OP_ROSTER = 0x09
+OP_ROSTER_DELTA = 0x0A
+OP_SYNC = 0x0B
+OP_ROOM_JOIN = 0x0C  # group rooms, v2 only
+OP_ROOM_PART = 0x0D
+OP_ROOM_MSG = 0x0E
+OP_CHAT_REQUEST = 0x10
+OP_CHAT_ACCEPT = 0x11
+OP_CHAT_REJECT = 0x12
+OP_LEFT_CHAT = 0x13
+OP_CHAT_MSG = 0x14
+OP_PING = 0x15  # peer keepalive, v2 only
+OP_PONG = 0x16
+OP_ANNOUNCE = 0x17  # LAN discovery datagram (multicast), v2 only
+OP_FILE_OFFER = 0x18  # file transfer on a side connection, v2 only
+OP_FILE_ACCEPT = 0x19
+OP_FILE_REJECT = 0x1A
+OP_FILE_CHUNK = 0x1B  # followed by `length` raw bytes
+OP_FILE_DONE = 0x1C
+OP_STREAM = 0x1D  # one chunk of a message sent in several frames, v2 only
+OP_NODE_HELLO = 0x20  # server <-> server links
+OP_NODE_EVENT = 0x21
+# Local pseudo-opcodes for input that could not be parsed (never sent)
+OP_UNKNOWN = 0x100
+OP_MALFORMED = 0x101
+
+FLAG_V2 = 0x01      # REGISTER caps / JOINED flags: the peer speaks protocol v2
+FLAG_ROSTER = 0x02  # REGISTER caps: send ROSTER/ROSTER_DELTA instead of JOINED/LEFT
+FLAG_KEEPALIVE = 0x04  # CHAT_REQUEST/CHAT_ACCEPT caps: the peer answers PING with PONG
+FLAG_DATAGRAM = 0x08  # REGISTER caps / JOINED and ANNOUNCE flags: accepts reliable UDP chats (network/rudp.py)
+FLAG_REPLY = 0x10  # ANNOUNCE flags: unicast answer to a newcomer, not answered again
+STREAM_END = 0x01  # STREAM flags: last chunk of the message
+
+# Roster change kinds inside ROSTER_DELTA, each followed by its fields
+CHANGE_JOIN = 1   # nickname, ip, udp_port, tcp_port, flags (insert or replace)
+CHANGE_LEAVE = 2  # nickname
+CHANGE_PORT = 3   # nickname, tcp_port
+ROSTER_ENTRY = 'saHHB'
+CHANGE_SCHEMAS = {CHANGE_JOIN: ROSTER_ENTRY, CHANGE_LEAVE: 's', CHANGE_PORT: 'sH'}
+
+V2_SCHEMAS = {
+    OP_REGISTER: 'sHHBIV',   # nickname, udp_port, tcp_port, caps, roster epoch, roster version
+    OP_WELCOME: 'B',         # protocol version
+    OP_PORT: 'sH',           # nickname, tcp_port
+    OP_JOINED: ROSTER_ENTRY, # nickname, ip, udp_port, tcp_port, flags
+    OP_LEFT: 's',            # nickname
+    OP_BROADCAST: 's',       # message
+    OP_NICKNAME_TAKEN: '',
+    OP_ERROR: 's',           # reason
+    OP_ROSTER: 'IVR',        # epoch, version, entries
+    OP_ROSTER_DELTA: 'IVVD', # epoch, base version, new version, changes
+    OP_SYNC: 'IV',           # epoch, version the client already has
+    OP_ROOM_JOIN: 'ss',      # room, nickname of the member
+    OP_ROOM_PART: 'ss',      # room, nickname of the member
+    OP_ROOM_MSG: 'sss',      # room, nickname of the sender, message
+    OP_CHAT_REQUEST: 'sB',   # nickname, caps
+    OP_CHAT_ACCEPT: 'sB',    # nickname, caps
+    OP_CHAT_REJECT: 's',     # nickname
+    OP_LEFT_CHAT: 's',       # nickname
+    OP_CHAT_MSG: 'ss',       # nickname, message
+    OP_PING: '',
+    OP_PONG: '',
+    OP_ANNOUNCE: 'sHHBIVH',  # nickname, udp_port, tcp_port, flags, instance, sequence number, ttl seconds
+    OP_FILE_OFFER: 'sIsVV',  # nickname, transfer id, filename, size, chunk size
+    OP_FILE_ACCEPT: 'IV',    # transfer id, offset to start at
+    OP_FILE_REJECT: 'I',     # transfer id
+    OP_FILE_CHUNK: 'VVI',    # offset, length, crc32 of the raw bytes that follow
+    OP_FILE_DONE: 'IV',      # transfer id, size
+    OP_STREAM: 'IBBb',       # stream id, flags, opcode of the streamed message, chunk of its last field
+    OP_NODE_HELLO: 'IsB',    # node id, node name, 1 if a HELLO is expected back
+    OP_NODE_EVENT: 'IVIb',   # origin node, sequence number, owner node, JOINED/LEFT/PORT/BROADCAST payload
+}
+
+def _pack_fields(out: bytearray, schema: str, fields):
+    for kind, value in zip(schema, fields):
+        if kind in 'sb':
+            data = value.encode() if kind == 's' else value
+            out += encode_varint(len(data))
+            out += data
+        elif kind == 'a':
+            data = socket.inet_pton(socket.AF_INET6 if ':' in value else socket.AF_INET, value)
+            out.append(len(data))
+            out += data
+        elif kind == 'H':
+            out += value.to_bytes(2, 'big')
+        elif kind == 'I':
+            out += value.to_bytes(4, 'big')
+        elif kind == 'V':
+            out += encode_varint(value)
+        elif kind == 'R':
+            out += encode_varint(len(value))
+            for entry in value:
+                _pack_fields(out, ROSTER_ENTRY, entry)
+        elif kind == 'D':
+            out += encode_varint(len(value))
+            for change in value:
+                out.append(change[0])
+                _pack_fields(out, CHANGE_SCHEMAS[change[0]], change[1:])
+        else:
+            out.append(value)
+
+def _unpack_fields(payload: bytes, pos: int, schema: str, fields: list) -> int:
+    end = len(payload)
+    for kind in schema:
+        if pos >= end:
+            fields.append(None)
+            continue
+        if kind in 'sb':
+            strlen, pos = decode_varint(payload, pos)
+            if pos + strlen > end:
+                raise ValueError("Truncated string field")
+            data = bytes(payload[pos:pos + strlen])
+            fields.append(data.decode() if kind == 's' else data)
+            pos += strlen
+        elif kind == 'a':
+            alen = payload[pos]
+            family = socket.AF_INET6 if alen == 16 else socket.AF_INET
+            fields.append(socket.inet_ntop(family, payload[pos + 1:pos + 1 + alen]))
+            pos += 1 + alen
+        elif kind == 'H':
+            fields.append(int.from_bytes(payload[pos:pos + 2], 'big'))
+            pos += 2
+        elif kind == 'I':
+            fields.append(int.from_bytes(payload[pos:pos + 4], 'big'))
+            pos += 4
+        elif kind == 'V':
+            value, pos = decode_varint(payload, pos)
+            fields.append(value)
+        elif kind in 'RD':
+            count, pos = decode_varint(payload, pos)
+            items = []
+            for _ in range(count):
+                if kind == 'R':
+                    item = []
+                    pos = _unpack_fields(payload, pos, ROSTER_ENTRY, item)
+                else:
+                    item = [payload[pos]]
+                    pos = _unpack_fields(payload, pos + 1, CHANGE_SCHEMAS[item[0]], item)
+                if None in item or pos > end:
+                    raise ValueError("Truncated roster field")
+                items.append(tuple(item))
+            fields.append(items)
+        else:
+            fields.append(payload[pos])
+            pos += 1
+    return pos
+
+def pack(op: int, *fields) -> bytes:
+    """Encode a v2 payload (opcode and fields, without framing)."""
+    out = bytearray((op,))
+    _pack_fields(out, V2_SCHEMAS[op], fields)
+    return bytes(out)
+
+def unpack(payload: bytes):
+    """Decode a v2 payload into (opcode, fields). Raises ValueError if malformed."""
+    if not payload:
+        raise ValueError("Empty v2 frame")
+    op = payload[0]
+    schema = V2_SCHEMAS.get(op)
+    if schema is None:
+        raise ValueError(f"Unknown v2 opcode {op:#x}")
+    fields = []
+    try:
+        _unpack_fields(payload, 1, schema, fields)
+    except (TypeError, IndexError, KeyError, UnicodeDecodeError, OSError) as e:
+        raise ValueError(f"Malformed v2 frame: {e}")
+    return op, tuple(fields)
+
+# --- Typed message records ---
+# parse() classifies a message once and returns one of these records; each
+# record class carries its opcode so handlers can be looked up in a dict.
+class Register(NamedTuple):
+    nickname: str
+    udp_port: int
+    tcp_port: int = None  # v2 only; text clients send PORT afterwards
+    caps: int = 0
+    roster_epoch: int = None    # roster the client already has, if any,
+    roster_version: int = None  # so only the changes since then are sent
+    op = OP_REGISTER
+
+class Welcome(NamedTuple):
+    version: int
+    op = OP_WELCOME
+
+class Port(NamedTuple):
+    nickname: str
+    tcp_port: int
+    op = OP_PORT
+
+class Joined(NamedTuple):
+    nickname: str
+    ip: str
+    udp_port: int
+    tcp_port: int
+    flags: int = 0
+    op = OP_JOINED
+
+class Left(NamedTuple):
+    nickname: str
+    op = OP_LEFT
+
+class Broadcast(NamedTuple):
+    message: str
+    op = OP_BROADCAST
+
+class NicknameTaken(NamedTuple):
+    op = OP_NICKNAME_TAKEN
+
+class Error(NamedTuple):
+    reason: str = None
+    op = OP_ERROR
+
+class Roster(NamedTuple):
+    epoch: int
+    version: int
+    entries: list  # [(nickname, ip, udp_port, tcp_port, flags)]
+    op = OP_ROSTER
+
+class RosterDelta(NamedTuple):
+    epoch: int
+    base: int      # version the changes apply to
+    version: int   # version after applying them
+    changes: list  # [(CHANGE_*, *fields)] in order
+    op = OP_ROSTER_DELTA
+
+class Sync(NamedTuple):
+    epoch: int
+    version: int
+    op = OP_SYNC
+
+class RoomJoin(NamedTuple):
+    room: str
+    nickname: str  # the member; set by the server
+    op = OP_ROOM_JOIN
+
+class RoomPart(NamedTuple):
+    room: str
+    nickname: str
+    op = OP_ROOM_PART
+
+class RoomMsg(NamedTuple):
+    room: str
+    nickname: str  # the sender; set by the server
+    message: str
+    op = OP_ROOM_MSG
+
+class ChatRequest(NamedTuple):
+    nickname: str
+    caps: int = 0  # FLAG_KEEPALIVE; missing from text and older v2 peers
+    op = OP_CHAT_REQUEST
+
+class ChatAccept(NamedTuple):
+    nickname: str
+    caps: int = 0
+    op = OP_CHAT_ACCEPT
+
+class ChatReject(NamedTuple):
+    nickname: str
+    op = OP_CHAT_REJECT
+
+class LeftChat(NamedTuple):
+    nickname: str
+    op = OP_LEFT_CHAT
+
+class ChatMsg(NamedTuple):
+    nickname: str
+    message: str
+    op = OP_CHAT_MSG
+
+class Ping(NamedTuple):
+    op = OP_PING
+
+class Pong(NamedTuple):
+    op = OP_PONG
+
+class Announce(NamedTuple):
+    nickname: str
+    udp_port: int
+    tcp_port: int
+    flags: int = 0
+    instance: int = 0  # random per client run, tells restarts and duplicates apart
+    seq: int = 0
+    ttl: int = 0       # seconds the entry stays valid; 0 means the peer is leaving
+    op = OP_ANNOUNCE
+
+class FileOffer(NamedTuple):
+    nickname: str
+    transfer: int  # stable per file, so a repeated offer resumes
+    filename: str
+    size: int
+    chunk_size: int
+    op = OP_FILE_OFFER
+
+class FileAccept(NamedTuple):
+    transfer: int
+    offset: int
+    op = OP_FILE_ACCEPT
+
+class FileReject(NamedTuple):
+    transfer: int
+    op = OP_FILE_REJECT
+
+class FileChunk(NamedTuple):
+    offset: int
+    length: int
+    crc: int
+    op = OP_FILE_CHUNK
+
+class FileDone(NamedTuple):
+    transfer: int
+    size: int
+    op = OP_FILE_DONE
+
+class Stream(NamedTuple):
+    stream: int  # chosen by the sender, unique per connection while the stream is open
+    flags: int   # STREAM_END
+    kind: int    # opcode of the message the chunks belong to
+    data: bytes
+    op = OP_STREAM
+
+class NodeHello(NamedTuple):
+    node: int
+    name: str = ''
+    reply: int = 0
+    op = OP_NODE_HELLO
+
+class NodeEvent(NamedTuple):
+    origin: int    # node that created the event
+    seq: int       # (origin, seq) identifies the event for deduplication
+    owner: int     # node the user is connected to
+    payload: bytes # v2 payload of a JOINED, LEFT, PORT or BROADCAST
+    op = OP_NODE_EVENT
+
+class Unknown(NamedTuple):
+    raw: object  # the original message
+    op = OP_UNKNOWN
+
+class Malformed(NamedTuple):
+    kind: int  # opcode the message claimed to be
+    raw: object
+    op = OP_MALFORMED
+
+RECORDS = {cls.op: cls for cls in (
+    Register, Welcome, Port, Joined, Left, Broadcast, NicknameTaken, Error,
+    Roster, RosterDelta, Sync, RoomJoin, RoomPart, RoomMsg, ChatRequest, ChatAccept, ChatReject, LeftChat, ChatMsg,
+    Ping, Pong, Announce, FileOffer, FileAccept, FileReject, FileChunk, FileDone, Stream, NodeHello, NodeEvent,
+)}
+
+OP_NAMES = {op: name for name, op in (
+    ("REGISTER", OP_REGISTER), ("WELCOME", OP_WELCOME), ("PORT", OP_PORT),
+    ("JOINED", OP_JOINED), ("LEFT", OP_LEFT), ("BROADCAST", OP_BROADCAST),
+    ("NICKNAME_TAKEN", OP_NICKNAME_TAKEN), ("ERROR", OP_ERROR),
+    ("ROSTER", OP_ROSTER), ("ROSTER_DELTA", OP_ROSTER_DELTA), ("SYNC", OP_SYNC),
+    ("ROOM_JOIN", OP_ROOM_JOIN), ("ROOM_PART", OP_ROOM_PART), ("ROOM_MSG", OP_ROOM_MSG),
+    ("CHAT_REQUEST", OP_CHAT_REQUEST), ("CHAT_ACCEPT", OP_CHAT_ACCEPT),
+    ("CHAT_REJECT", OP_CHAT_REJECT), ("LEFT_CHAT", OP_LEFT_CHAT), ("CHAT_MSG", OP_CHAT_MSG),
+    ("PING", OP_PING), ("PONG", OP_PONG), ("ANNOUNCE", OP_ANNOUNCE),
+    ("FILE_OFFER", OP_FILE_OFFER), ("FILE_ACCEPT", OP_FILE_ACCEPT), ("FILE_REJECT", OP_FILE_REJECT),
+    ("FILE_CHUNK", OP_FILE_CHUNK), ("FILE_DONE", OP_FILE_DONE), ("STREAM", OP_STREAM),
+    ("NODE_HELLO", OP_NODE_HELLO), ("NODE_EVENT", OP_NODE_EVENT),
+)}
+
+def _single(body_parser):
+    # Adapt a body parser returning one value to the tuple shape of the others
+    def parse_body(content):
+        value = body_parser(content)
+        return None if value is None else (value,)
+    return parse_body
+
+# Command word -> (opcode, body parser returning the record fields or None)
+TEXT_PARSERS = {
+    "REGISTER": (OP_REGISTER, _register_body),
+    "PORT": (OP_PORT, _port_body),
+    "JOINED": (OP_JOINED, _joined_body),
+    "LEFT": (OP_LEFT, _single(_nickname_body)),
+    "BROADCAST": (OP_BROADCAST, lambda content: (content,)),
+    "NICKNAME_TAKEN": (OP_NICKNAME_TAKEN, lambda content: () if not content.strip() else None),
+    "ERROR": (OP_ERROR, lambda content: (content.strip() or None,)),
+    "CHAT_REQUEST": (OP_CHAT_REQUEST, _single(_nickname_body)),
+    "CHAT_ACCEPT": (OP_CHAT_ACCEPT, _single(_nickname_body)),
+    "CHAT_REJECT": (OP_CHAT_REJECT, _single(_nickname_body)),
+    "LEFT_CHAT": (OP_LEFT_CHAT, _single(_nickname_body)),
+    "CHAT_MSG": (OP_CHAT_MSG, _chat_msg_body),
+}
+
+def parse(msg):
+    """Classify a text message or v2 payload once and return its typed record.
+
+    Unrecognised input yields Unknown, recognised but invalid input yields
+    Malformed; parse never raises for bad input.
+    """
+    if isinstance(msg, bytes):
+        try:
+            op, fields = unpack(msg)
+        except ValueError:
+            op = msg[0] if msg else None
+            if op in RECORDS:
+                return Malformed(op, msg)
+            return Unknown(msg)
+    else:
+        command, sep, content = msg.partition(' ')
+        entry = TEXT_PARSERS.get(command)
+        if entry is None or not sep and command != "NICKNAME_TAKEN":
+            return Unknown(msg)  # commands other than NICKNAME_TAKEN need the space before their body
+        op, body_parser = entry
+        fields = body_parser(content)
+        if fields is None:
+            return Malformed(op, msg)
+    cls = RECORDS[op]
+    required = len(cls._fields) - len(cls._field_defaults)
+    if None in fields[:required]:
+        return Malformed(op, msg)
+    return cls(*fields)
+
+class Dispatcher:
+    """Routes parsed records to handlers registered per opcode.
+
+    Lookup is a single dict access, so the cost per message does not grow
+    with the number of commands. Handlers are called as handler(*args, record).
+    """
+
+    def __init__(self, default=None):
+        self.handlers = {}
+        self.default = default
+
+    def register(self, op, handler):
+        self.handlers[op] = handler
+
+    def dispatch(self, record, *args):
+        handler = self.handlers.get(record.op, self.default)
+        if handler is not None:
+            return handler(*args, record)
+        return None
+
+# Text (v1) form of each opcode, taking the same fields as V2_SCHEMAS.
+# ROSTER, ROSTER_DELTA, SYNC, ROOM_*, PING/PONG, ANNOUNCE, FILE_*, STREAM and the NODE_* messages only exist in v2.
+TEXT_FORMS = {
+    OP_REGISTER: lambda nickname, udp_port, tcp_port=0, caps=0, *since: make_register(nickname, udp_port),
+    OP_PORT: make_port,
+    # Old clients split JOINED on whitespace, so the nickname stays unquoted
+    OP_JOINED: lambda nickname, ip, udp_port, tcp_port, flags=0: f"JOINED {nickname} {ip} {udp_port} {tcp_port}",
+    OP_LEFT: make_left,
+    OP_BROADCAST: make_broadcast,
+    OP_NICKNAME_TAKEN: make_nickname_taken,
+    OP_ERROR: make_error,
+    OP_CHAT_REQUEST: lambda nickname, caps=0: make_chat_request(nickname),
+    OP_CHAT_ACCEPT: lambda nickname, caps=0: make_chat_accept(nickname),
+    OP_CHAT_REJECT: make_chat_reject,
+    OP_LEFT_CHAT: make_left_chat,
+    OP_CHAT_MSG: make_chat_msg,
+}
+
+def encode(version: int, op: int, *fields) -> bytes:
+    """Encode a complete wire frame for a connection speaking the given version."""
+    if version >= PROTOCOL_V2:
+        return encode_frame_v2(pack(op, *fields))
+    return encode_message(TEXT_FORMS[op](*fields))
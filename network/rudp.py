@@ -0,0 +1,385 @@
+"""
+Reliable, ordered messages over UDP (peer chats without a TCP connection).
+
+A ReliableUdp endpoint shares the client's UdpTransport and keeps one
+ReliableChannel per peer address. Channels behave like the blocking peer
+sockets as far as PeerClient is concerned: sendall() queues one message,
+close() ends the channel once everything sent has been acknowledged.
+
+Messages are cut into segments of at most mss bytes, numbered per channel.
+The receiver delivers them in order and acknowledges with the next
+expected sequence number plus up to 8 ranges received beyond a gap
+(selective acks). The sender measures the round-trip time of segments
+that were sent once (Karn), derives the retransmission timeout like TCP
+(RFC 6298), retransmits a segment once three later ones were acked, and
+limits segments in flight with a congestion window (slow start, halved
+on loss). Segments are paced over the round-trip time instead of being
+sent in one burst. See network/README.md for the packet format.
+"""
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict, deque
+
+RUDP_MAGIC = 0xB4  # first byte of every packet; plain UDP text never starts with it
+DATA, ACK, CLOSE = 1, 2, 3
+FLAG_END = 0x01    # DATA: last segment of a message
+
+DATA_HEADER = struct.Struct('!BBIIB')  # magic, type, connection id, sequence number, flags
+ACK_HEADER = struct.Struct('!BBIIB')   # magic, type, connection id, next expected, number of ranges
+SACK_RANGE = struct.Struct('!II')      # [start, end) received after a gap
+CLOSE_PACKET = struct.Struct('!BBI')   # magic, type, connection id
+MAX_SACK = 8
+WINDOW = 1024       # segments a receiver buffers beyond a gap
+MAX_TIMEOUTS = 8    # consecutive retransmission timeouts before the peer is given up
+
+def _new_conn_id():
+    return int.from_bytes(os.urandom(4), 'big')
+
+class Segment:
+    __slots__ = ('seq', 'packet', 'sent', 'retransmitted', 'sacked', 'in_flight', 'lost')
+
+    def __init__(self, seq, packet):
+        self.seq = seq
+        self.packet = packet
+        self.sent = 0.0
+        self.retransmitted = False
+        self.sacked = False
+        self.in_flight = False
+        self.lost = False
+
+class ReliableChannel:
+    """One peer's reliable message stream in both directions.
+
+    All state belongs to the I/O loop thread; sendall and close may be
+    called from any thread.
+    """
+
+    def __init__(self, endpoint, addr):
+        self.endpoint = endpoint
+        self.addr = addr
+        self.closed = False    # close() was called
+        self.finished = False  # removed from the endpoint
+        # Sending
+        self.send_conn = _new_conn_id()
+        self.outbox = deque()  # messages from sendall, not yet cut into segments
+        self.pending = deque() # segments not sent yet
+        self.unacked = OrderedDict()  # seq -> Segment, sent and not cumulatively acked
+        self.lost = deque()    # segments to retransmit
+        self.next_seq = 0
+        self.acked = 0         # highest cumulative ack seen
+        self.in_flight = 0
+        self.cwnd = 4.0
+        self.ssthresh = 64.0
+        self.recovery = 0      # no further window cut until this seq is acked
+        self.srtt = None
+        self.rttvar = 0.0
+        self.rto = 1.0
+        self.timeouts = 0
+        self.rto_timer = None
+        self.pace_timer = None
+        self.next_send = 0.0
+        # Receiving
+        self.recv_conn = None
+        self.expected = 0
+        self.out_of_order = {}  # seq -> (flags, payload)
+        self.parts = []         # segments of the message being received
+
+    # --- Socket-like interface ---
+    def sendall(self, data: bytes):
+        if self.closed:
+            raise OSError("Channel closed")
+        self.outbox.append(data)
+        self.endpoint.call(self._pump)
+
+    def close(self):
+        """Close after everything queued so far was delivered."""
+        if not self.closed:
+            self.closed = True
+            self.endpoint.call(self._pump)
+
+    # --- Sending ---
+    def _segment(self):
+        mss = self.endpoint.mss
+        while self.outbox:
+            data = self.outbox.popleft()
+            for start in range(0, max(len(data), 1), mss):
+                end = start + mss
+                flags = FLAG_END if end >= len(data) else 0
+                packet = DATA_HEADER.pack(RUDP_MAGIC, DATA, self.send_conn, self.next_seq, flags) + data[start:end]
+                self.pending.append(Segment(self.next_seq, packet))
+                self.next_seq += 1
+
+    def _pump(self):
+        if self.finished:
+            return
+        self._segment()
+        now = time.monotonic()
+        while (self.lost or self.pending) and self.in_flight < self.cwnd:
+            if self.srtt is not None and self.next_send > now:
+                if self.pace_timer is None:
+                    self.pace_timer = self.endpoint.loop.call_later(self.next_send - now, self._paced)
+                break
+            if self.lost:
+                seg = self.lost.popleft()
+                if seg.sacked or seg.seq < self.acked or not seg.lost:
+                    continue
+                seg.lost = False
+                seg.retransmitted = True
+            else:
+                seg = self.pending.popleft()
+                self.unacked[seg.seq] = seg
+            self._transmit(seg, now)
+            if self.srtt is not None:
+                # Spread a window over one round trip; catch up at most one timer tick
+                self.next_send = max(self.next_send, now - self.endpoint.tick) + self.srtt / self.cwnd
+        if self.closed and not (self.outbox or self.pending or self.unacked):
+            self._finish(send_close=True)
+
+    def _paced(self):
+        self.pace_timer = None
+        self._pump()
+
+    def _transmit(self, seg, now):
+        self.endpoint.send(self.addr, seg.packet)
+        seg.sent = now
+        if not seg.in_flight:
+            seg.in_flight = True
+            self.in_flight += 1
+        if self.rto_timer is None:
+            self.rto_timer = self.endpoint.loop.call_later(self.rto, self._on_rto)
+
+    def _restart_rto(self):
+        if self.rto_timer is not None:
+            self.rto_timer.cancel()
+            self.rto_timer = None
+        if self.in_flight:
+            self.rto_timer = self.endpoint.loop.call_later(self.rto, self._on_rto)
+
+    def _mark_lost(self, seg):
+        if seg.in_flight:
+            seg.in_flight = False
+            self.in_flight -= 1
+        if not seg.lost:
+            seg.lost = True
+            self.lost.append(seg)
+
+    def _on_rto(self):
+        self.rto_timer = None
+        if self.finished or not self.unacked:
+            return
+        self.timeouts += 1
+        if self.timeouts > MAX_TIMEOUTS:
+            self._finish(send_close=False, reason="Peer stopped answering")
+            return
+        # Everything in flight counts as lost; start over with one segment
+        self.ssthresh = max(self.cwnd / 2, 2.0)
+        self.cwnd = 1.0
+        self.rto = min(self.rto * 2, 10.0)
+        self.recovery = self.next_seq
+        self.lost.clear()
+        for seg in self.unacked.values():
+            seg.lost = False
+            if not seg.sacked:
+                self._mark_lost(seg)
+        self.next_send = 0.0
+        self._pump()
+        self._restart_rto()
+
+    def _on_ack(self, conn, cumulative, ranges):
+        if conn != self.send_conn:
+            return
+        if cumulative < self.acked:
+            # Reordered or duplicated: an older ACK adds nothing. A peer that lost the
+            # stream (restarted) answers our DATA with CLOSE instead (see _on_data).
+            return
+        now, sample, newly_acked = time.monotonic(), None, 0
+        while self.unacked:
+            seq, seg = next(iter(self.unacked.items()))
+            if seq >= cumulative:
+                break
+            del self.unacked[seq]
+            if seg.in_flight:
+                self.in_flight -= 1
+            if not seg.sacked:
+                newly_acked += 1
+                if not seg.retransmitted:
+                    sample = now - seg.sent
+        self.acked = max(self.acked, cumulative)
+        highest = None
+        for start, end in ranges:
+            for seq in range(max(start, cumulative), min(end, self.next_seq, cumulative + WINDOW)):
+                seg = self.unacked.get(seq)
+                if seg is None or seg.sacked:
+                    continue
+                seg.sacked = True
+                seg.lost = False
+                if seg.in_flight:
+                    seg.in_flight = False
+                    self.in_flight -= 1
+                newly_acked += 1
+                if not seg.retransmitted:
+                    sample = now - seg.sent
+                highest = seq if highest is None else max(highest, seq)
+        if highest is not None:
+            self._detect_loss(highest)
+        if sample is not None:
+            self._update_rtt(sample)
+        if newly_acked:
+            self.timeouts = 0
+            if self.cwnd < self.ssthresh:
+                self.cwnd += newly_acked
+            else:
+                self.cwnd += newly_acked / self.cwnd
+            self.cwnd = min(self.cwnd, float(WINDOW))
+            self._restart_rto()
+        self._pump()
+
+    def _detect_loss(self, highest):
+        """Segments with three acked segments after them are lost (fast retransmit)."""
+        later, lost_any = 0, False
+        for seq in reversed(self.unacked):
+            if seq > highest:
+                continue
+            seg = self.unacked[seq]
+            if seg.sacked:
+                later += 1
+            elif later >= 3 and seg.in_flight:
+                self._mark_lost(seg)
+                lost_any = True
+        if lost_any and self.acked >= self.recovery:
+            self.ssthresh = max(self.cwnd / 2, 2.0)
+            self.cwnd = self.ssthresh
+            self.recovery = self.next_seq
+
+    def _update_rtt(self, sample):
+        if self.srtt is None:
+            self.srtt, self.rttvar = sample, sample / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - sample)
+            self.srtt = 0.875 * self.srtt + 0.125 * sample
+        self.rto = min(max(self.srtt + max(self.endpoint.tick, 4 * self.rttvar), 0.2), 10.0)
+
+    # --- Receiving ---
+    def _on_data(self, conn, seq, flags, payload):
+        if conn != self.recv_conn:
+            if seq >= WINDOW:
+                self.endpoint.send(self.addr, CLOSE_PACKET.pack(RUDP_MAGIC, CLOSE, conn))
+                return  # the middle of a stream we do not know: reset it
+            self.recv_conn = conn  # a new stream from the peer
+            self.expected = 0
+            self.out_of_order.clear()
+            self.parts = []
+        self.endpoint.ack_due.add(self)
+        if seq < self.expected or seq >= self.expected + WINDOW or seq in self.out_of_order:
+            return
+        self.out_of_order[seq] = (flags, payload)
+        while self.expected in self.out_of_order:
+            flags, payload = self.out_of_order.pop(self.expected)
+            self.expected += 1
+            self.parts.append(payload)
+            if flags & FLAG_END:
+                message, self.parts = b''.join(self.parts), []
+                if not self.closed:
+                    self.endpoint.on_message(self.addr, self, message)
+
+    def _send_ack(self):
+        ranges, start = [], None
+        for seq in sorted(self.out_of_order):
+            if start is not None and seq == end:
+                end += 1
+                continue
+            if start is not None:
+                ranges.append((start, end))
+            start, end = seq, seq + 1
+        if start is not None:
+            ranges.append((start, end))
+        ranges = ranges[:MAX_SACK]
+        packet = ACK_HEADER.pack(RUDP_MAGIC, ACK, self.recv_conn or 0, self.expected, len(ranges))
+        self.endpoint.send(self.addr, packet + b''.join(SACK_RANGE.pack(*r) for r in ranges))
+
+    def _finish(self, send_close, reason=None):
+        if self.finished:
+            return
+        self.finished = True
+        for timer in (self.rto_timer, self.pace_timer):
+            if timer is not None:
+                timer.cancel()
+        self.endpoint.remove(self)
+        if send_close:
+            self.endpoint.send(self.addr, CLOSE_PACKET.pack(RUDP_MAGIC, CLOSE, self.send_conn))
+        if not self.closed:
+            self.closed = True
+            self.endpoint.on_close(self.addr, self, reason)
+
+class ReliableUdp:
+    """Reliable channels over a shared UdpTransport, driven by an IOLoop."""
+
+    def __init__(self, transport, loop, on_message, on_close, mss: int = 1200, tick: float = 0.05):
+        self.transport = transport
+        self.loop = loop
+        self.on_message = on_message  # on_message(addr, channel, message bytes)
+        self.on_close = on_close      # on_close(addr, channel, reason) when the peer closed or vanished
+        self.mss = mss                # payload bytes per segment, keeps packets below the path MTU
+        self.tick = tick
+        self.channels = {}  # addr -> ReliableChannel
+        self.ack_due = set()
+        self.lock = threading.Lock()
+
+    def call(self, fn):
+        if self.loop.in_loop():
+            fn()
+        else:
+            self.loop.call_soon(fn)
+
+    def channel(self, addr) -> ReliableChannel:
+        """The open channel to addr, created if needed."""
+        with self.lock:
+            channel = self.channels.get(addr)
+            if channel is None:
+                channel = self.channels[addr] = ReliableChannel(self, addr)
+            return channel
+
+    def remove(self, channel):
+        with self.lock:
+            if self.channels.get(channel.addr) is channel:
+                del self.channels[channel.addr]
+        self.ack_due.discard(channel)
+
+    def send(self, addr, packet):
+        try:
+            self.transport.sock.sendto(packet, addr)
+        except (BlockingIOError, InterruptedError):
+            pass  # like a lost packet; retransmission covers it
+        except OSError:
+            pass  # e.g. ICMP unreachable reported on the shared socket
+
+    def receive(self, addr, packet):
+        """Handle one packet starting with RUDP_MAGIC (on the loop thread)."""
+        try:
+            kind = packet[1]
+            if kind == DATA:
+                _, _, conn, seq, flags = DATA_HEADER.unpack_from(packet)
+                self.channel(addr)._on_data(conn, seq, flags, packet[DATA_HEADER.size:])
+            elif kind == ACK:
+                _, _, conn, cumulative, count = ACK_HEADER.unpack_from(packet)
+                ranges = [SACK_RANGE.unpack_from(packet, ACK_HEADER.size + i * SACK_RANGE.size)
+                          for i in range(min(count, MAX_SACK))]
+                channel = self.channels.get(addr)
+                if channel is not None:
+                    channel._on_ack(conn, cumulative, ranges)
+            elif kind == CLOSE:
+                _, _, conn = CLOSE_PACKET.unpack_from(packet)
+                channel = self.channels.get(addr)
+                if channel is not None and conn in (channel.send_conn, channel.recv_conn):
+                    channel._finish(send_close=False, reason="Peer closed the connection")
+        except (IndexError, struct.error):
+            pass  # truncated packet
+
+    def flush(self):
+        """Send the acknowledgements owed for the packets handled since the last flush."""
+        for channel in self.ack_due:
+            if not channel.finished:
+                channel._send_ack()
+        self.ack_due.clear()
@@ -0,0 +1,134 @@
+"""
+Messages sent as a stream of frames (STREAM, protocol v2).
+
+A message too large for one frame is cut into chunks of at most
+STREAM_CHUNK bytes; each chunk travels in its own STREAM frame carrying
+the stream id, the opcode of the message and STREAM_END on the last one.
+The chunks together form the message's last field (the text of a
+CHAT_MSG); its other fields follow from the connection.
+
+FrameWriter serializes all writers of one socket and lets single frames
+(keepalives, errors, short chat messages) go ahead of the next chunk, so
+they wait for at most one chunk instead of the whole message.
+StreamReceiver collects the chunks arriving on one connection: a message
+is either handed chunk by chunk to a generator registered for its opcode,
+so it is never held in memory, or reassembled up to max_message bytes.
+"""
+import itertools
+import threading
+import network.protocol as prot
+from network.tcp import FrameTooLarge
+
+STREAM_CHUNK = 16 * 1024
+MAX_MESSAGE = 16 * 1024 * 1024  # largest streamed message that is reassembled in memory
+MAX_STREAMS = 8                 # open streams per connection
+
+def chunks_of(data, size: int = STREAM_CHUNK):
+    """Split bytes into memoryview slices of at most size bytes, without copying."""
+    view = memoryview(data)
+    for start in range(0, len(view), size):
+        yield view[start:start + size]
+
+class FrameWriter:
+    """Writes frames to one socket from any thread; single frames go before stream chunks."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.cond = threading.Condition()
+        self.busy = False  # a frame is being written
+        self.waiting = 0   # single frames waiting for the socket
+        self.ids = itertools.count(1)
+
+    def _acquire(self, urgent: bool):
+        with self.cond:
+            if urgent:
+                self.waiting += 1
+                while self.busy:
+                    self.cond.wait()
+                self.waiting -= 1
+            else:
+                while self.busy or self.waiting:
+                    self.cond.wait()
+            self.busy = True
+
+    def _release(self):
+        with self.cond:
+            self.busy = False
+            self.cond.notify_all()
+
+    def send(self, frame):
+        self._acquire(True)
+        try:
+            self.sock.sendall(frame)
+        finally:
+            self._release()
+
+    def send_stream(self, op: int, chunks):
+        """Send an iterable of byte chunks as one message of type op. Blocks until all are written."""
+        stream = next(self.ids) & 0xFFFFFFFF
+        pending = None
+        for chunk in itertools.chain(chunks, (None,)):
+            if pending is not None or chunk is None:
+                last = chunk is None
+                frame = prot.encode(prot.PROTOCOL_V2, prot.OP_STREAM, stream,
+                                    prot.STREAM_END if last else 0, op, pending if pending is not None else b'')
+                self._acquire(False)
+                try:
+                    self.sock.sendall(frame)
+                finally:
+                    self._release()
+            pending = chunk
+
+class StreamReceiver:
+    """Collects the STREAM frames of one connection.
+
+    open_consumer(op) may return a generator for a message of that type;
+    it is sent every chunk as it arrives, then None once the message is
+    complete, and closed if the connection ends first. Without one the
+    chunks are reassembled.
+    """
+
+    def __init__(self, open_consumer=None, max_message: int = MAX_MESSAGE, max_streams: int = MAX_STREAMS):
+        self.open_consumer = open_consumer
+        self.max_message = max_message
+        self.max_streams = max_streams
+        self.streams = {}  # stream id -> [op, consumer or None, bytearray]
+
+    def feed(self, record):
+        """Take one Stream record. Returns (op, bytes) when a reassembled message is complete, else None.
+
+        Raises FrameTooLarge or ValueError if the sender exceeds the limits.
+        """
+        entry = self.streams.get(record.stream)
+        if entry is None:
+            if len(self.streams) >= self.max_streams:
+                raise ValueError(f"More than {self.max_streams} open streams")
+            consumer = self.open_consumer(record.kind) if self.open_consumer else None
+            if consumer is not None:
+                next(consumer)  # run it up to its first yield
+            entry = self.streams[record.stream] = [record.kind, consumer, bytearray()]
+        op, consumer, buf = entry
+        end = record.flags & prot.STREAM_END
+        if end:
+            del self.streams[record.stream]
+        if consumer is not None:
+            try:
+                if record.data:
+                    consumer.send(record.data)
+                if end:
+                    consumer.send(None)
+            except StopIteration:
+                pass  # the consumer is done early; the rest of the message is ignored
+            return None
+        if len(buf) + len(record.data) > self.max_message:
+            self.streams.pop(record.stream, None)
+            raise FrameTooLarge(f"Streamed message exceeds the limit of {self.max_message} bytes")
+        buf += record.data
+        return (op, bytes(buf)) if end else None
+
+    def close(self):
+        """Abort all open streams (the connection ended)."""
+        for _, consumer, _ in self.streams.values():
+            if consumer is not None:
+                consumer.close()
+        self.streams.clear()
@@ -1,21 +1,231 @@
 import socket
 from typing import Tuple
 
+HEADER_LEN = 10  # space-padded decimal length prefix
+V2_MAGIC = 0xB2  # first byte of a binary (v2) frame; text frames start with a digit
+MAX_VARINT_LEN = 5
+MAX_FRAME_SIZE = 16 * 1024 * 1024  # default limit for one received frame; larger messages are streamed
+
+class FrameTooLarge(ValueError):
+    """A frame announced more bytes than the receiver accepts."""
+
+def check_frame_size(msglen: int, max_frame: int):
+    if msglen < 0:
+        raise ValueError(f"Malformed frame length {msglen}")
+    if msglen > max_frame:
+        raise FrameTooLarge(f"Frame of {msglen} bytes exceeds the limit of {max_frame} bytes")
+
+def encode_varint(value: int) -> bytes:
+    """Encode a non-negative integer as an unsigned LEB128 varint."""
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+def decode_varint(buf, pos: int = 0, end: int = None):
+    """Decode a varint from buf[pos:end]. Returns (value, next_pos) or None if incomplete."""
+    if end is None:
+        end = len(buf)
+    value = shift = 0
+    for _ in range(MAX_VARINT_LEN):
+        if pos >= end:
+            return None
+        b = buf[pos]
+        pos += 1
+        value |= (b & 0x7F) << shift
+        if b < 0x80:
+            return value, pos
+        shift += 7
+    raise ValueError("Malformed varint length")
+
+def encode_frame_v2(payload: bytes) -> bytes:
+    """Frame a binary payload: magic byte, varint length, payload."""
+    return bytes((V2_MAGIC,)) + encode_varint(len(payload)) + payload
+
+def decode_frame(data: bytes):
+    """Decode one complete frame the way FramedReader returns it. Raises ValueError if malformed."""
+    try:
+        if data[0] == V2_MAGIC:
+            msglen, start = decode_varint(data, 1)
+            if start + msglen != len(data):
+                raise ValueError("Frame length mismatch")
+            return bytes(data[start:])
+        msglen = int(data[:HEADER_LEN])
+        if msglen < 0 or HEADER_LEN + msglen != len(data):
+            raise ValueError("Frame length mismatch")
+        return str(data[HEADER_LEN:], 'utf-8')
+    except (IndexError, TypeError, UnicodeDecodeError) as e:
+        raise ValueError(f"Malformed frame: {e}")
+
+class FramedReader:
+    """Buffered reader that extracts length-prefixed frames from a socket.
+
+    Data is received with recv_into into one reusable bytearray, so a
+    single syscall can deliver many frames and large payloads are never
+    rebuilt by concatenation. The buffer is compacted in place and only
+    grows when a single frame does not fit.
+
+    Text frames are returned as str, binary v2 frames as their bytes
+    payload; the format is detected per frame from the first byte. A frame
+    longer than max_frame raises FrameTooLarge as soon as its header is
+    read, before any memory is reserved for it.
+    """
+
+    def __init__(self, conn: socket.socket, bufsize: int = 65536, max_frame: int = MAX_FRAME_SIZE):
+        self.conn = conn
+        self.bufsize = bufsize
+        self.max_frame = max_frame
+        self.buf = bytearray(bufsize)
+        self.view = memoryview(self.buf)
+        self.start = 0  # first unconsumed byte
+        self.end = 0    # end of received data
+
+    def _next_frame(self):
+        """Return the next complete message in the buffer, or None."""
+        avail = self.end - self.start
+        if not avail:
+            return None
+        if self.buf[self.start] == V2_MAGIC:
+            header = decode_varint(self.buf, self.start + 1, self.end)
+            if header is None:
+                return None
+            msglen, hlen = header[0], header[1] - self.start
+            check_frame_size(msglen, self.max_frame)
+            if avail < hlen + msglen:
+                self._reserve(hlen + msglen)
+                return None
+            start = self.start + hlen
+            msg = bytes(self.view[start:start + msglen])
+        else:
+            if avail < HEADER_LEN:
+                return None
+            start = self.start + HEADER_LEN
+            msglen = int(self.view[self.start:start])
+            check_frame_size(msglen, self.max_frame)
+            if avail < HEADER_LEN + msglen:
+                self._reserve(HEADER_LEN + msglen)
+                return None
+            msg = str(self.view[start:start + msglen], 'utf-8')
+        self.start = start + msglen
+        if self.start == self.end:
+            self.start = self.end = 0
+            if len(self.buf) > 4 * self.bufsize:
+                # Give back the memory of an unusually large frame
+                self.view.release()
+                self.buf = bytearray(self.bufsize)
+                self.view = memoryview(self.buf)
+        return msg
+
+    def _reserve(self, size: int):
+        """Make sure a frame of size bytes fits between start and the buffer end."""
+        if self.start + size <= len(self.buf):
+            return
+        pending = self.end - self.start
+        if size > len(self.buf):
+            buf = bytearray(max(size, 2 * len(self.buf)))
+            buf[:pending] = self.view[self.start:self.end]
+            self.view.release()
+            self.buf = buf
+            self.view = memoryview(buf)
+        else:
+            self.buf[:pending] = self.buf[self.start:self.end]
+        self.start, self.end = 0, pending
+
+    def _fill(self) -> int:
+        """Receive as many bytes as the kernel has ready (one recv_into call)."""
+        if self.end == len(self.buf):
+            self._reserve(len(self.buf) - self.start + 1)
+        n = self.conn.recv_into(self.view[self.end:])
+        if not n:
+            raise ConnectionError("Connection closed before message complete")
+        self.end += n
+        return n
+
+    def read_frames(self) -> list:
+        """Receive once and return every complete message now buffered."""
+        self._fill()
+        frames = []
+        msg = self._next_frame()
+        while msg is not None:
+            frames.append(msg)
+            msg = self._next_frame()
+        return frames
+
+    def recv(self):
+        """Return the next message, receiving more data only when needed."""
+        msg = self._next_frame()
+        while msg is None:
+            self._fill()
+            msg = self._next_frame()
+        return msg
+
+    def __iter__(self):
+        """Yield messages until the connection closes (raises ConnectionError)."""
+        while True:
+            yield self.recv()
+
 def recv_all(conn: socket.socket, length: int) -> bytes:
-    data = b''
-    while len(data) < length:
-        more = conn.recv(length - len(data))
+    data = bytearray(length)
+    view = memoryview(data)
+    received = 0
+    while received < length:
+        more = conn.recv_into(view[received:])
         if not more:
             raise ConnectionError("Connection closed before message complete")
-        data += more
-    return data
+        received += more
+    return bytes(data)
 
-def recv_message(conn: socket.socket) -> str:
-    raw_len = recv_all(conn, 10)
+def recv_message(conn: socket.socket, max_frame: int = MAX_FRAME_SIZE):
+    """Read exactly one message (compatibility wrapper, no read-ahead)."""
+    first = recv_all(conn, 1)
+    if first[0] == V2_MAGIC:
+        msglen = _read_varint(lambda: recv_all(conn, 1)[0])
+        check_frame_size(msglen, max_frame)
+        return recv_all(conn, msglen)
+    raw_len = first + recv_all(conn, HEADER_LEN - 1)
     msglen = int(raw_len.decode().strip())
+    check_frame_size(msglen, max_frame)
     return recv_all(conn, msglen).decode()
 
+def _read_varint(read_byte) -> int:
+    value = shift = 0
+    for _ in range(MAX_VARINT_LEN):
+        b = read_byte()
+        value |= (b & 0x7F) << shift
+        if b < 0x80:
+            return value
+        shift += 7
+    raise ValueError("Malformed varint length")
+
+def encode_message(msg: str) -> bytes:
+    """Encode a message with its 10-byte length prefix."""
+    data = msg.encode()
+    return f"{len(data):<10}".encode() + data
+
 def send_message(conn: socket.socket, msg: str):
-    msg = msg.encode()
-    msg_len = f"{len(msg):<10}".encode()  # length prefix (10 bytes)
-    conn.sendall(msg_len + msg)
\ No newline at end of file
+    conn.sendall(encode_message(msg))
+
+# --- asyncio stream variants (used by server.aio) ---
+async def recv_message_async(reader, max_frame: int = MAX_FRAME_SIZE):
+    """asyncio counterpart of recv_message for a StreamReader."""
+    first = await reader.readexactly(1)
+    if first[0] == V2_MAGIC:
+        value = shift = 0
+        for _ in range(MAX_VARINT_LEN):
+            b = (await reader.readexactly(1))[0]
+            value |= (b & 0x7F) << shift
+            if b < 0x80:
+                check_frame_size(value, max_frame)
+                return await reader.readexactly(value)
+            shift += 7
+        raise ValueError("Malformed varint length")
+    raw_len = first + await reader.readexactly(HEADER_LEN - 1)
+    msglen = int(raw_len.decode().strip())
+    check_frame_size(msglen, max_frame)
+    return (await reader.readexactly(msglen)).decode()
+
+def send_message_async(writer, msg: str):
+    """Queue a message on an asyncio StreamWriter (does not wait for drain)."""
+    writer.write(encode_message(msg))
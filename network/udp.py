@@ -1,18 +1,175 @@
+import os
 import socket
+import struct
+import threading
+import time
+from collections import OrderedDict
 from typing import Callable
 
+# Messages longer than one datagram are split into fragments, each starting
+# with this header. 0xB3 cannot start valid UTF-8 text, so a receiver tells
+# fragments from plain (unfragmented) text datagrams by the first byte.
+FRAGMENT_MAGIC = 0xB3
+FRAGMENT_HEADER = struct.Struct('!BIHH')  # magic, message id, index, count
+MAX_UDP_PAYLOAD = 65507
+
+class UdpTransport:
+    """One long-lived UDP socket for sending and receiving.
+
+    Datagrams are received with recvfrom_into into one preallocated buffer,
+    and every readable event drains all queued datagrams (recvmmsg-style
+    batching done as a loop, since Python does not expose recvmmsg/sendmmsg).
+    Messages up to `mtu` bytes go out as a single plain datagram, exactly as
+    before; longer ones are fragmented and reassembled on the other side.
+    """
+
+    def __init__(self, port: int = 0, host: str = '', mtu: int = 1400, reassembly_timeout: float = 5.0,
+                 max_pending: int = 4 << 20, sock=None):
+        if sock is None:  # else an already bound socket, e.g. one joined to a multicast group
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind((host, port))
+        self.sock = sock
+        self.mtu = mtu  # bytes per datagram; keep below the path MTU minus IP/UDP headers
+        self.reassembly_timeout = reassembly_timeout
+        self.max_pending = max_pending  # bytes of incomplete messages kept at most
+        self.buf = bytearray(MAX_UDP_PAYLOAD)
+        self.view = memoryview(self.buf)
+        self.next_id = int.from_bytes(os.urandom(4), 'big')
+        self.partial = {}  # (addr, message id) -> [deadline, fragments, received, bytes]
+        self.pending_bytes = 0
+        self.completed = OrderedDict()  # recently reassembled keys, so late duplicates are ignored
+        self.send_lock = threading.Lock()
+
+    @property
+    def port(self) -> int:
+        return self.sock.getsockname()[1]
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        self.sock.close()
+
+    # --- Sending ---
+    def _datagrams(self, data: bytes):
+        if len(data) <= self.mtu:
+            return [data]
+        chunk = self.mtu - FRAGMENT_HEADER.size
+        count = -(-len(data) // chunk)
+        if count > 0xFFFF:
+            raise ValueError("Message too large for UDP fragmentation")
+        with self.send_lock:
+            self.next_id = (self.next_id + 1) & 0xFFFFFFFF
+            message_id = self.next_id
+        return [FRAGMENT_HEADER.pack(FRAGMENT_MAGIC, message_id, i, count) + data[i * chunk:(i + 1) * chunk]
+                for i in range(count)]
+
+    def send(self, addr, message):
+        """Send a str or bytes message to addr, fragmenting it if needed."""
+        data = message.encode() if isinstance(message, str) else message
+        for datagram in self._datagrams(data):
+            self.sock.sendto(datagram, addr)
+
+    def send_many(self, items):
+        """Send [(addr, message)] in one batch (the sendmmsg fallback is one sendto per datagram)."""
+        sendto = self.sock.sendto
+        for addr, message in items:
+            data = message.encode() if isinstance(message, str) else message
+            for datagram in self._datagrams(data):
+                sendto(datagram, addr)
+
+    # --- Receiving ---
+    def recv_batch(self, limit: int = 256):
+        """Read every datagram already queued (up to limit) without blocking.
+
+        Returns [(addr, bytes)] of complete messages.
+        """
+        messages = []
+        blocking = self.sock.getblocking()
+        if blocking:
+            self.sock.setblocking(False)
+        try:
+            for _ in range(limit):
+                try:
+                    n, addr = self.sock.recvfrom_into(self.buf)
+                except (BlockingIOError, InterruptedError):
+                    break
+                message = self._complete(addr, n)
+                if message is not None:
+                    messages.append((addr, message))
+        finally:
+            if blocking:
+                self.sock.setblocking(True)
+        if self.partial:
+            self._expire()
+        return messages
+
+    def recv(self):
+        """Block until one complete message arrives; returns (addr, bytes)."""
+        while True:
+            n, addr = self.sock.recvfrom_into(self.buf)
+            message = self._complete(addr, n)
+            if message is not None:
+                return addr, message
+
+    def _complete(self, addr, n):
+        """The message a datagram of n bytes completes, or None while fragments are missing."""
+        if n < FRAGMENT_HEADER.size or self.buf[0] != FRAGMENT_MAGIC:
+            return bytes(self.view[:n])
+        _, message_id, index, count = FRAGMENT_HEADER.unpack_from(self.buf)
+        if index >= count:
+            return None
+        key = (addr, message_id)
+        entry = self.partial.get(key)
+        if entry is None:
+            if key in self.completed:
+                return None
+            entry = self.partial[key] = [time.monotonic() + self.reassembly_timeout, [None] * count, 0, 0]
+        fragments = entry[1]
+        if len(fragments) != count or fragments[index] is not None:
+            return None  # duplicate or inconsistent fragment
+        fragment = bytes(self.view[FRAGMENT_HEADER.size:n])
+        fragments[index] = fragment
+        entry[2] += 1
+        entry[3] += len(fragment)
+        self.pending_bytes += len(fragment)
+        if entry[2] == count:
+            del self.partial[key]
+            self.pending_bytes -= entry[3]
+            self.completed[key] = None
+            if len(self.completed) > 1024:
+                self.completed.popitem(last=False)
+            return b''.join(fragments)
+        if self.pending_bytes > self.max_pending:
+            self._expire(force=True)
+        return None
+
+    def _expire(self, force=False):
+        """Drop incomplete messages that timed out (or the oldest ones when over max_pending)."""
+        now = time.monotonic()
+        for key, entry in sorted(self.partial.items(), key=lambda item: item[1][0]):
+            if entry[0] > now and not (force and self.pending_bytes > self.max_pending):
+                break
+            del self.partial[key]
+            self.pending_bytes -= entry[3]
+
 def listen_for_udp(port: int, on_message: Callable):
+    transport = UdpTransport(port)
     def udp_server():
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-            sock.bind(('', port))
-            while True:
-                data, addr = sock.recvfrom(1024)
-                if data:
-                    message = data.decode()
-                    on_message(addr, message)
-    import threading
+        while True:
+            addr, data = transport.recv()
+            if data:
+                on_message(addr, data.decode())
     threading.Thread(target=udp_server, daemon=True).start()
+    return transport
+
+_shared = None
+_shared_lock = threading.Lock()
 
 def send_udp(target_ip: str, target_port: int, message: str):
-    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-        sock.sendto(message.encode(), (target_ip, target_port))
\ No newline at end of file
+    """Send through one shared socket instead of a new socket per datagram."""
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = UdpTransport()
+    _shared.send((target_ip, target_port), message)
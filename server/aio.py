@@ -0,0 +1,77 @@
+import asyncio
+import threading
+import network.protocol as prot
+from network.tcp import recv_message_async, FrameTooLarge
+from server.core import PeerServer
+from server.outbound import AsyncConnection, DROP_OLDEST
+
+class AsyncPeerServer(PeerServer):
+    """asyncio server engine with the same protocol semantics as PeerServer.
+
+    Every client is served by a coroutine on a single event loop instead of
+    a dedicated OS thread, so idle registered clients only cost a socket and
+    a small stream buffer. Message handling is inherited from PeerServer and
+    always runs on the loop thread, so the registry locks are never contended.
+    """
+
+    def __init__(self, host: str, port: int, queue_size: int = 1024, slow_policy: str = DROP_OLDEST,
+                 roster_window: float = 0.05, backlog: int = 4096, **options):
+        super().__init__(host, port, queue_size, slow_policy, roster_window, **options)
+        self.backlog = backlog
+        self.loop = None
+
+    async def handle_client(self, reader, writer):
+        """Handle communication with a connected client."""
+        conn = AsyncConnection(writer, self.queue_size, self.slow_policy, self.metrics)
+        self.metrics.connected(1)
+        reason = 'server'
+        try:
+            while self.running:
+                keep = self.on_message(conn, await recv_message_async(reader, self.max_frame))
+                if asyncio.iscoroutine(keep):
+                    keep = await keep  # a handler that waits, e.g. for a cluster nickname claim
+                if not keep:
+                    reason = 'protocol'
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, OSError):
+            reason = 'closed'
+        except FrameTooLarge as e:
+            reason = 'oversized'
+            self.send(conn, prot.OP_ERROR, str(e))
+        except Exception as e:
+            reason = 'error'
+            self.metrics.errors.inc(type(e).__name__)
+            self.send(conn, prot.OP_ERROR, f"Server exception: {e}")
+        finally:
+            self.on_disconnect(conn)
+            conn.close()
+            self.metrics.connected(-1)
+            self.metrics.disconnects.inc('slow' if conn.overflowed else reason)
+
+    def _schedule_flush(self):
+        # Runs on the loop thread, so a loop timer replaces the flush thread
+        if self.flush_timer is None:
+            self.flush_timer = self.loop.call_later(self.roster_window, self._flush_roster)
+
+    def _schedule_broadcasts(self):
+        if self.broadcast_timer is None:
+            self.broadcast_timer = self.loop.call_later(self.broadcast_tick, self._flush_broadcasts)
+
+    def console_broadcast(self, msg):
+        # Called from the console thread; connections belong to the loop
+        self.loop.call_soon_threadsafe(super().console_broadcast, msg)
+
+    async def serve(self):
+        """Accept clients on the running event loop until stopped."""
+        self.loop = asyncio.get_running_loop()
+        server = await asyncio.start_server(self.handle_client, self.host, self.port, backlog=self.backlog,
+                                            reuse_port=self.reuse_port or None)
+        self.start_metrics()
+        threading.Thread(target=self.input_thread, daemon=True).start()
+        async with server:
+            while self.running:
+                await asyncio.sleep(1.0)
+
+    def start(self):
+        """Start the asyncio TCP server and block until it is stopped."""
+        asyncio.run(self.serve())
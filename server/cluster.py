@@ -0,0 +1,306 @@
+"""
+Multi-process PeerChat server (Unix only).
+
+The parent process runs a small hub and forks N workers that all accept on
+the same port via SO_REUSEPORT. Workers talk to the hub over a Unix domain
+socket (the bus):
+
+- before registering a nickname a worker claims it at the hub, which keeps
+  nicknames unique across all workers;
+- joins, leaves, port changes and broadcasts are published on the bus and
+  relayed to every other worker, which applies them to its own registry and
+  roster so its clients see users of other workers like local ones.
+
+Bus messages are tuples sent with multiprocessing.connection:
+    ('claim', request_id, nickname)        worker -> hub
+    ('claimed', request_id, ok)            hub -> worker
+    ('release', request_id, nickname)      the claim timed out: undo it unless it already joined
+    ('join', nickname, ip, udp_port, tcp_port, flags)
+    ('leave', nickname)                    also releases a claim
+    ('port', nickname, tcp_port)
+    ('broadcast', message)
+"""
+import asyncio
+import itertools
+import multiprocessing
+import os
+import shutil
+import socket
+import tempfile
+import threading
+from multiprocessing.connection import Listener, Client
+import network.protocol as prot
+from server.core import PeerServer
+from server.outbound import RemoteConnection
+
+class Hub:
+    """Owns the cluster-wide nickname set and relays bus messages between workers."""
+
+    def __init__(self, address):
+        self.listener = Listener(address, family='AF_UNIX')
+        self.lock = threading.Lock()
+        self.workers = []  # bus connections
+        self.owners = {}   # nickname -> bus connection of the worker that claimed it
+        self.claim_ids = {}  # nickname -> request id of its claim, until it joined
+        self.joined = {}   # nickname -> 'join' message, replayed to new workers
+
+    def serve(self):
+        while True:
+            bus = self.listener.accept()
+            threading.Thread(target=self._serve_worker, args=(bus,), daemon=True).start()
+
+    def _relay(self, msg, origin=None):
+        # Caller holds the lock, so every worker sees the same order
+        for bus in self.workers:
+            if bus is not origin:
+                try:
+                    bus.send(msg)
+                except OSError:
+                    pass
+
+    def broadcast(self, message):
+        with self.lock:
+            self._relay(('broadcast', message))
+
+    def _serve_worker(self, bus):
+        with self.lock:
+            for msg in self.joined.values():
+                bus.send(msg)
+            self.workers.append(bus)
+        try:
+            while True:
+                msg = bus.recv()
+                kind = msg[0]
+                with self.lock:
+                    if kind == 'claim':
+                        request_id, nickname = msg[1:]
+                        ok = nickname not in self.owners
+                        if ok:
+                            self.owners[nickname] = bus
+                            self.claim_ids[nickname] = request_id
+                        bus.send(('claimed', request_id, ok))
+                        continue
+                    if kind == 'release':
+                        request_id, nickname = msg[1:]
+                        if self.owners.get(nickname) is bus and self.claim_ids.get(nickname) == request_id:
+                            del self.owners[nickname]
+                            del self.claim_ids[nickname]
+                        continue
+                    nickname = msg[1]
+                    if kind == 'join':
+                        self.joined[nickname] = msg
+                        self.claim_ids.pop(nickname, None)
+                    elif kind == 'leave':
+                        if self.owners.get(nickname) is not bus:
+                            continue
+                        del self.owners[nickname]
+                        self.claim_ids.pop(nickname, None)
+                        if self.joined.pop(nickname, None) is None:
+                            continue  # released a claim nobody heard about
+                    elif kind == 'port' and nickname in self.joined:
+                        joined = self.joined[nickname]
+                        self.joined[nickname] = joined[:4] + (msg[2],) + joined[5:]
+                    self._relay(msg, bus)
+        except (EOFError, OSError):
+            pass
+        finally:
+            # The worker died: its users are gone
+            with self.lock:
+                self.workers.remove(bus)
+                for nickname in [n for n, owner in self.owners.items() if owner is bus]:
+                    del self.owners[nickname]
+                    self.claim_ids.pop(nickname, None)
+                    if self.joined.pop(nickname, None) is not None:
+                        self._relay(('leave', nickname))
+
+class BusClient:
+    """A worker's connection to the hub."""
+
+    def __init__(self, address, on_event):
+        self.conn = Client(address, family='AF_UNIX')
+        self.on_event = on_event
+        self.send_lock = threading.Lock()
+        self.request_ids = itertools.count(1)
+        self.replies = {}  # request_id -> on_reply(ok), until the hub answered or the claim timed out
+        threading.Thread(target=self._read_loop, daemon=True).start()
+
+    def send(self, *msg):
+        with self.send_lock:
+            self.conn.send(msg)
+
+    def claim(self, nickname, timeout: float = 5.0) -> bool:
+        """Reserve a nickname cluster-wide. Blocks for one round trip to the hub."""
+        done, result = threading.Event(), []
+        request_id = self._request_claim(nickname, lambda ok: (result.append(ok), done.set()))
+        if not done.wait(timeout):
+            self._release_claim(request_id, nickname)
+            return False
+        return result[0]
+
+    async def claim_async(self, nickname, timeout: float = 5.0) -> bool:
+        """claim() for a worker on an asyncio loop: waits for the hub without blocking the loop."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        def on_reply(ok):
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(ok))
+        request_id = self._request_claim(nickname, on_reply)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self._release_claim(request_id, nickname)
+            return False
+
+    def _request_claim(self, nickname, on_reply) -> int:
+        request_id = next(self.request_ids)
+        self.replies[request_id] = on_reply
+        self.send('claim', request_id, nickname)
+        return request_id
+
+    def _release_claim(self, request_id, nickname):
+        # The hub may still grant the claim (or just did); nobody will use it
+        self.replies.pop(request_id, None)
+        self.send('release', request_id, nickname)
+
+    def _read_loop(self):
+        try:
+            while True:
+                msg = self.conn.recv()
+                if msg[0] == 'claimed':
+                    on_reply = self.replies.pop(msg[1], None)
+                    if on_reply is not None:
+                        on_reply(msg[2])
+                else:
+                    self.on_event(msg)
+        except (EOFError, OSError):
+            os._exit(1)  # lost the hub; the parent is gone
+
+class ClusterWorker:
+    """Mixin for PeerServer engines that share their users over the bus."""
+    bus = None
+
+    def connect_bus(self, address):
+        self.bus = BusClient(address, self._on_bus_event)
+
+    def _on_bus_event(self, msg):
+        # Bus events arrive on the reader thread; apply them where clients are handled
+        loop = getattr(self, 'loop', None)
+        if loop is not None:
+            loop.call_soon_threadsafe(self._apply_bus_event, msg)
+        else:
+            self._apply_bus_event(msg)
+
+    def _apply_bus_event(self, msg):
+        kind = msg[0]
+        if kind == 'join':
+            nickname, ip, udp_port, tcp_port, flags = msg[1:]
+            self.add_remote(RemoteConnection(nickname, ip, flags), udp_port, tcp_port)
+        elif kind == 'leave':
+            entry = self.clients.get(msg[1])
+            if entry is not None and isinstance(entry[3], RemoteConnection):
+                PeerServer.on_disconnect(self, entry[3])
+        elif kind == 'port':
+            entry = self.clients.get(msg[1])
+            if entry is not None and isinstance(entry[3], RemoteConnection):
+                self.update_remote_port(entry[3], msg[2])
+        elif kind == 'broadcast':
+            PeerServer.console_broadcast(self, msg[1])
+
+    def _complete_registration(self, conn, nickname, udp_port, tcp_port, since=(None, None)) -> bool:
+        return self._register_claimed(self.bus.claim(nickname), conn, nickname, udp_port, tcp_port, since)
+
+    def _register_claimed(self, claimed, conn, nickname, udp_port, tcp_port, since) -> bool:
+        if not claimed:
+            self.send(conn, prot.OP_NICKNAME_TAKEN)
+            return False
+        if not super()._complete_registration(conn, nickname, udp_port, tcp_port, since):
+            self.bus.send('leave', nickname)
+            return False
+        self.bus.send('join', *self._joined_fields(nickname, self.clients.get(nickname)))
+        return True
+
+    def on_disconnect(self, conn) -> bool:
+        removed = super().on_disconnect(conn)
+        if removed:
+            self.bus.send('leave', conn.nickname)
+        return removed
+
+    def _on_port(self, conn, record):
+        super()._on_port(conn, record)
+        if record.nickname == conn.nickname:
+            self.bus.send('port', record.nickname, record.tcp_port)
+
+    def _on_broadcast(self, conn, record):
+        super()._on_broadcast(conn, record)
+        self.bus.send('broadcast', record.message)
+
+    def input_thread(self):
+        pass  # the parent process owns the console
+
+class ThreadedWorker(ClusterWorker, PeerServer):
+    pass
+
+def _async_worker_class():
+    from server.aio import AsyncPeerServer
+
+    class AsyncWorker(ClusterWorker, AsyncPeerServer):
+        async def serve(self):
+            self.loop = asyncio.get_running_loop()
+            self.connect_bus(self.bus_address)
+            await super().serve()
+
+        def _complete_registration(self, conn, nickname, udp_port, tcp_port, since=(None, None)):
+            # A coroutine, awaited by handle_client: other clients are served during the claim
+            return self._claim_and_register(conn, nickname, udp_port, tcp_port, since)
+
+        async def _claim_and_register(self, conn, nickname, udp_port, tcp_port, since):
+            claimed = await self.bus.claim_async(nickname)
+            return self._register_claimed(claimed, conn, nickname, udp_port, tcp_port, since)
+
+    return AsyncWorker
+
+def _run_worker(engine, bus_address, args, kwargs):
+    if engine == "asyncio":
+        server = _async_worker_class()(*args, **kwargs)
+        server.bus_address = bus_address
+    else:
+        server = ThreadedWorker(*args, **kwargs)
+        server.connect_bus(bus_address)
+    server.reuse_port = True
+    server.start()
+
+def run_cluster(workers: int, engine: str, *args, **kwargs):
+    """Run the hub in this process and `workers` server processes on the same port."""
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        raise SystemExit("--workers needs SO_REUSEPORT and Unix domain sockets (Linux, BSD, macOS)")
+    bus_dir = tempfile.mkdtemp(prefix="peerchat-")
+    bus_address = os.path.join(bus_dir, "bus.sock")
+    # Listen before forking so workers can connect right away, but start
+    # the hub threads only afterwards: fork() does not copy threads
+    hub = Hub(bus_address)
+    ctx = multiprocessing.get_context("fork")
+    # Every worker has its own metrics; with --metrics-port P they are served on P, P+1, ...
+    metrics_port = kwargs.pop('metrics_port', 0)
+    procs = [ctx.Process(target=_run_worker, daemon=True,
+                         args=(engine, bus_address, args, dict(kwargs, metrics_port=metrics_port and metrics_port + i)))
+             for i in range(workers)]
+    for proc in procs:
+        proc.start()
+    threading.Thread(target=hub.serve, daemon=True).start()
+    try:
+        # Same console commands as a single server: 'q' quits, 'broadcast <msg>' broadcasts
+        while True:
+            try:
+                cmd = input().strip()
+            except EOFError:
+                threading.Event().wait()  # no console: run until killed
+            if cmd.lower() == 'q':
+                break
+            elif cmd.lower().startswith('broadcast '):
+                hub.broadcast(cmd[len('broadcast '):])
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for proc in procs:
+            proc.terminate()
+        hub.listener.close()
+        shutil.rmtree(bus_dir, ignore_errors=True)
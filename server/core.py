@@ -1,127 +1,442 @@
 import socket
 import threading
-from network.tcp import recv_message, send_message
-from network.protocol import (
-    parse_register, make_joined, make_left, make_broadcast, parse_port,
-    make_error, make_nickname_taken
-)
+import time
+import network.protocol as prot
+from network.tcp import FramedReader, FrameTooLarge
+from server.metrics import Metrics
+from server.outbound import ThreadedConnection, SocketWriter, TokenBucket, DROP_OLDEST
+from server.registry import Registry
+from server.rooms import Rooms, valid_room_name, MAX_ROOMS_PER_CLIENT
+from server.roster import Roster
+from server.scheduler import Scheduler
 
 class PeerServer:
-    def __init__(self, host: str, port: int):
+    def __init__(self, host: str, port: int, queue_size: int = 1024, slow_policy: str = DROP_OLDEST,
+                 roster_window: float = 0.05, shards: int = 16, metrics_port: int = 0,
+                 metrics_interval: float = 0, broadcast_tick: float = 0.02, broadcast_rate: float = 20.0,
+                 broadcast_burst: float = 40.0, max_frame: int = 1024 * 1024):
         self.host = host
         self.port = port
-        self.clients = {}  # nickname: (ip, udp_port, tcp_port, conn)
-        self.lock = threading.Lock()
+        self.queue_size = queue_size
+        self.slow_policy = slow_policy
+        self.max_frame = max_frame  # bytes; a client announcing a longer frame is disconnected before it is read
+        self.clients = Registry(shards)  # nickname: (ip, udp_port, tcp_port, conn)
         self.running = True
+        self.reuse_port = False  # set by cluster workers sharing one port
+        # Counters are always collected; metrics_port serves them over HTTP on
+        # localhost and metrics_interval logs a summary line (0 disables either)
+        self.metrics = Metrics()
+        self.metrics_port = metrics_port
+        self.metrics_interval = metrics_interval
+        self.metrics.gauge('clients', 'Registered users (including users on other workers/nodes)',
+                           lambda: len(self.clients))
+        self.metrics.gauge('queued_frames', 'Frames waiting in all outbound queues',
+                           lambda: sum(self._queue_depths()))
+        self.metrics.gauge('queued_frames_max', 'Longest outbound queue', lambda: max(self._queue_depths(), default=0))
+        # Roster changes are batched for roster_window seconds before being published.
+        # roster_lock guards the roster, its subscribers and the flush timer only.
+        self.roster = Roster()
+        self.roster_lock = self.metrics.timed_lock()
+        self.subscribers = set()  # connections receiving ROSTER_DELTA
+        self.roster_window = roster_window
+        self.scheduler = Scheduler()  # one thread for the roster flush and broadcast ticks
+        self.socket_writer = SocketWriter() if SocketWriter.supported else None  # threaded engine only
+        self.flush_timer = None
+        self.flush_lock = threading.Lock()
+        # Broadcasts are collected for broadcast_tick seconds and sent to every client
+        # as one write; each client may broadcast broadcast_rate messages per second
+        # (bursts up to broadcast_burst). A tick or rate of 0 disables either.
+        self.broadcast_tick = broadcast_tick
+        self.broadcast_rate = broadcast_rate
+        self.broadcast_burst = broadcast_burst
+        self.pending_broadcasts = []
+        self.broadcast_timer = None
+        self.broadcast_lock = threading.Lock()
+        self.rate_limited = self.metrics.counter('broadcasts_rate_limited_total',
+                                                 'Broadcasts and room messages refused by the per-client rate limit')
+        # Group rooms of this server process, indexed room -> member connections
+        self.rooms = Rooms()
+        self.metrics.gauge('rooms', 'Rooms with at least one member', lambda: len(self.rooms))
+        # Handlers for registered clients, keyed by opcode
+        self.dispatcher = prot.Dispatcher(default=self._on_unexpected)
+        self.dispatcher.register(prot.OP_BROADCAST, self._on_rate_limited_broadcast)
+        self.dispatcher.register(prot.OP_PORT, self._on_port)
+        self.dispatcher.register(prot.OP_REGISTER, self._on_register_again)
+        self.dispatcher.register(prot.OP_JOINED, self._on_server_only)
+        self.dispatcher.register(prot.OP_LEFT, self._on_server_only)
+        self.dispatcher.register(prot.OP_ERROR, self._on_client_error)
+        self.dispatcher.register(prot.OP_NICKNAME_TAKEN, self._on_client_error)
+        self.dispatcher.register(prot.OP_MALFORMED, self._on_malformed)
+        self.dispatcher.register(prot.OP_SYNC, self._on_sync)
+        self.dispatcher.register(prot.OP_ROOM_JOIN, self._on_room_join)
+        self.dispatcher.register(prot.OP_ROOM_PART, self._on_room_part)
+        self.dispatcher.register(prot.OP_ROOM_MSG, self._on_room_msg)
 
-    def broadcast(self, msg, exclude_nick=None):
-        """Send a message to all connected clients except exclude_nick."""
-        with self.lock:
-            for nick, (ip, udp_port, tcp_port, conn) in list(self.clients.items()):
-                if exclude_nick and nick == exclude_nick:
-                    continue
-                try:
-                    send_message(conn, msg)
-                except Exception:
-                    pass
+    def send(self, conn, op, *fields, key=None):
+        """Encode a message in the client's protocol version and enqueue it."""
+        conn.send(prot.encode(conn.version, op, *fields), key)
+        self.metrics.sent.inc(op)
+
+    def broadcast(self, op, *fields, exclude_nick=None, key=None, only=None):
+        """Send a message to all connected clients except exclude_nick.
+
+        The frame is encoded once per protocol version and enqueued on every
+        client's outbound queue. The registry snapshot is immutable, so no
+        lock is taken and registrations are never blocked.
+        If given, only(conn) selects the receiving clients.
+        """
+        self._fan_out(lambda version: prot.encode(version, op, *fields), op, 1, exclude_nick, key, only)
+
+    def broadcast_many(self, op, messages):
+        """Send several messages (field tuples) of one opcode to all clients, as one write per client."""
+        self._fan_out(lambda version: b''.join(prot.encode(version, op, *fields) for fields in messages),
+                      op, len(messages))
+
+    def _fan_out(self, encode, op, count, exclude_nick=None, key=None, only=None):
+        start = time.perf_counter()
+        frames = {}
+        sent = 0
+        for nick, entry in self.clients.snapshot():
+            conn = entry[3]
+            if nick == exclude_nick or (only is not None and not only(conn)):
+                continue
+            frame = frames.get(conn.version)
+            if frame is None:
+                frame = frames[conn.version] = encode(conn.version)
+            conn.send(frame, key)
+            sent += 1
+        if sent:
+            self.metrics.sent.inc(op, amount=sent * count)
+        self.metrics.broadcast_fanout.observe(sent)
+        self.metrics.broadcast_latency.observe(time.perf_counter() - start)
+
+    def room_cast(self, members, op, *fields):
+        """Send a v2 message to the given room members only (encoded once)."""
+        frame = prot.encode(prot.PROTOCOL_V2, op, *fields)
+        for conn in members:
+            conn.send(frame)
+        if members:
+            self.metrics.sent.inc(op, amount=len(members))
+
+    def queue_broadcast(self, message):
+        """Broadcast a chat message with the next tick."""
+        if self.broadcast_tick <= 0:
+            self.broadcast(prot.OP_BROADCAST, message)
+            return
+        with self.broadcast_lock:
+            self.pending_broadcasts.append((message,))
+        self._schedule_broadcasts()
+
+    def _schedule_broadcasts(self):
+        with self.broadcast_lock:
+            if self.broadcast_timer is None:
+                self.broadcast_timer = self.scheduler.call_later(self.broadcast_tick, self._flush_broadcasts)
+
+    def _flush_broadcasts(self):
+        with self.broadcast_lock:
+            self.broadcast_timer = None
+            messages, self.pending_broadcasts = self.pending_broadcasts, []
+        if messages:
+            self.broadcast_many(prot.OP_BROADCAST, messages)
+
+    def _allow_broadcast(self, conn) -> bool:
+        """Charge one broadcast to the client's token bucket."""
+        if self.broadcast_rate <= 0:
+            return True
+        bucket = conn.bucket
+        if bucket is None:
+            bucket = conn.bucket = TokenBucket(self.broadcast_rate, max(1.0, self.broadcast_burst))
+        if bucket.take():
+            bucket.limited = False
+            return True
+        self.rate_limited.inc()
+        if not bucket.limited:
+            bucket.limited = True  # one ERROR per burst of refused messages
+            self.send(conn, prot.OP_ERROR, "Rate limit exceeded, message dropped")
+        return False
+
+    def _queue_depths(self):
+        for _, entry in self.clients.snapshot():
+            queue = getattr(entry[3], 'queue', None)
+            if queue is not None:
+                yield len(queue)
+
+    @staticmethod
+    def _wants_roster(conn) -> bool:
+        """True for clients that receive ROSTER/ROSTER_DELTA instead of JOINED/LEFT."""
+        return conn.version >= prot.PROTOCOL_V2 and bool(conn.caps & prot.FLAG_ROSTER)
+
+    def _is_legacy(self, conn) -> bool:
+        return not self._wants_roster(conn)
+
+    @staticmethod
+    def _joined_fields(nickname, entry):
+        ip, udp_port, tcp_port, conn = entry
+        flags = prot.FLAG_V2 if conn.version >= prot.PROTOCOL_V2 else 0
+        flags |= conn.caps & prot.FLAG_DATAGRAM  # a client capability other clients need to know
+        return nickname, ip, udp_port, tcp_port, flags
+
+    def on_message(self, conn, msg) -> bool:
+        """Handle one frame from a client. Returns False to close the connection."""
+        if isinstance(msg, bytes):
+            if conn.nickname is None:
+                conn.version = prot.PROTOCOL_V2
+        elif not msg:
+            return False
+        record = prot.parse(msg)
+        self.metrics.received.inc(record.op)
+        self.metrics.received_bytes.inc(amount=len(msg))
+        if conn.nickname is None:
+            return self._on_handshake(conn, record)
+        return self.dispatcher.dispatch(record, conn) is not False
+
+    def _on_rate_limited_broadcast(self, conn, record):
+        if record.message and self._allow_broadcast(conn):  # empty broadcasts are dropped
+            self._on_broadcast(conn, record)
+
+    def _on_broadcast(self, conn, record):
+        self.queue_broadcast(record.message)
+
+    def _on_port(self, conn, record):
+        if record.nickname != conn.nickname:
+            self.send(conn, prot.OP_ERROR, "Malformed PORT message or nickname mismatch")
+            return
+        if not self.clients.update(conn.nickname, conn, tcp_port=record.tcp_port):
+            return
+        with self.roster_lock:
+            self.roster.port(conn.nickname, record.tcp_port)
+        self._schedule_flush()
+
+    def _on_sync(self, conn, record):
+        with self.roster_lock:
+            self._send_roster(conn, record.epoch, record.version)
+
+    def _on_room_join(self, conn, record):
+        if not valid_room_name(record.room):
+            self.send(conn, prot.OP_ERROR, "Invalid room name")
+            return
+        if record.room not in conn.rooms and len(conn.rooms) >= MAX_ROOMS_PER_CLIENT:
+            self.send(conn, prot.OP_ERROR, f"Cannot join more than {MAX_ROOMS_PER_CLIENT} rooms")
+            return
+        before = self.rooms.join(record.room, conn)
+        if before is None:
+            return  # already a member
+        # The new member learns who is there, then everyone (itself included) sees it join
+        for member in before:
+            self.send(conn, prot.OP_ROOM_JOIN, record.room, member.nickname)
+        self.room_cast(before | {conn}, prot.OP_ROOM_JOIN, record.room, conn.nickname)
+
+    def _on_room_part(self, conn, record):
+        if not valid_room_name(record.room):
+            self.send(conn, prot.OP_ERROR, "Invalid room name")
+            return
+        remaining = self.rooms.part(record.room, conn)
+        if remaining is not None:
+            self.room_cast(remaining | {conn}, prot.OP_ROOM_PART, record.room, conn.nickname)
+
+    def _on_room_msg(self, conn, record):
+        members = self.rooms.get(record.room)
+        if not valid_room_name(record.room):
+            self.send(conn, prot.OP_ERROR, "Invalid room name")
+        elif conn not in members:
+            self.send(conn, prot.OP_ERROR, f"Not a member of room {record.room}")
+        elif self._allow_broadcast(conn):
+            self.room_cast(members, prot.OP_ROOM_MSG, record.room, conn.nickname, record.message)
+
+    def _on_register_again(self, conn, record):
+        self.send(conn, prot.OP_ERROR, "Already registered")
 
-    def handle_client(self, conn, addr):
+    def _on_server_only(self, conn, record):
+        self.send(conn, prot.OP_ERROR, "JOINED/LEFT messages are server-generated only")
+
+    def _on_client_error(self, conn, record):
+        self.send(conn, prot.OP_ERROR, "Client cannot send error or conflict messages")
+
+    def _on_malformed(self, conn, record):
+        if record.kind == prot.OP_PORT:
+            self.send(conn, prot.OP_ERROR, "Malformed PORT message or nickname mismatch")
+        elif record.kind == prot.OP_REGISTER:
+            self.send(conn, prot.OP_ERROR, "Already registered")
+        else:
+            self.send(conn, prot.OP_ERROR, f"Malformed {prot.OP_NAMES.get(record.kind, 'unknown')} message")
+
+    def _on_unexpected(self, conn, record):
+        self.send(conn, prot.OP_ERROR, "Unknown or unexpected command")
+
+    def _on_handshake(self, conn, record) -> bool:
+        """REGISTER (v1: followed by PORT; v2: carries the TCP port itself)."""
+        if conn.pending is None:
+            if record.op != prot.OP_REGISTER:
+                self.send(conn, prot.OP_ERROR, "Invalid REGISTER format")
+                return False
+            nickname = record.nickname
+            if nickname in self.clients:
+                self.send(conn, prot.OP_NICKNAME_TAKEN)
+                return False
+            conn.caps = record.caps or 0
+            since = (record.roster_epoch, record.roster_version)
+            if conn.version >= prot.PROTOCOL_V2:
+                self.send(conn, prot.OP_WELCOME, prot.PROTOCOL_V2)
+            if record.tcp_port:
+                return self._complete_registration(conn, nickname, record.udp_port, record.tcp_port, since)
+            conn.pending = (nickname, record.udp_port, since)
+            return True
+        nickname, udp_port, since = conn.pending
+        if record.op == prot.OP_PORT and record.nickname == nickname:
+            return self._complete_registration(conn, nickname, udp_port, record.tcp_port, since)
+        self.send(conn, prot.OP_ERROR, "Invalid PORT message or nickname mismatch")
+        return False
+
+    def _complete_registration(self, conn, nickname, udp_port, tcp_port, since=(None, None)) -> bool:
+        entry = (conn.addr[0], udp_port, tcp_port, conn)
+        # The nickname may have been taken while we waited for PORT
+        if not self.clients.add(nickname, entry):
+            self.send(conn, prot.OP_NICKNAME_TAKEN)
+            return False
+        conn.nickname = nickname
+        conn.pending = None
+        with self.roster_lock:
+            self.roster.join(self._joined_fields(nickname, entry), conn)
+            if self._wants_roster(conn):
+                # Sent and subscribed under the lock so no delta can overtake it
+                self._send_roster(conn, *since)
+                self.subscribers.add(conn)
+        if not self._wants_roster(conn):
+            # Send all current users to the new client
+            for n, e in self.clients.snapshot():
+                if n != nickname:
+                    self.send(conn, prot.OP_JOINED, *self._joined_fields(n, e), key=n)
+        self.broadcast(prot.OP_JOINED, *self._joined_fields(nickname, entry), exclude_nick=nickname,
+                       key=nickname, only=self._is_legacy)
+        self._schedule_flush()
+        return True
+
+    def add_remote(self, conn, udp_port, tcp_port) -> bool:
+        """Register a user served elsewhere (a RemoteConnection) and announce it locally."""
+        nickname = conn.nickname
+        entry = (conn.addr[0], udp_port, tcp_port, conn)
+        if not self.clients.add(nickname, entry):
+            return False
+        with self.roster_lock:
+            self.roster.join(self._joined_fields(nickname, entry), conn)
+        self.broadcast(prot.OP_JOINED, *self._joined_fields(nickname, entry), key=nickname, only=self._is_legacy)
+        self._schedule_flush()
+        return True
+
+    def update_remote_port(self, conn, tcp_port) -> bool:
+        if not self.clients.update(conn.nickname, conn, tcp_port=tcp_port):
+            return False
+        with self.roster_lock:
+            self.roster.port(conn.nickname, tcp_port)
+        self._schedule_flush()
+        return True
+
+    def _send_roster(self, conn, epoch, version):
+        """Send the changes since (epoch, version), or the whole roster. Caller holds roster_lock."""
+        changes = self.roster.since(epoch, version)
+        if changes is None:
+            self.send(conn, prot.OP_ROSTER, *self.roster.snapshot())
+        else:
+            self.send(conn, prot.OP_ROSTER_DELTA, self.roster.epoch, version, self.roster.version, changes)
+
+    def _schedule_flush(self):
+        """Publish the pending roster changes after the batching window."""
+        with self.roster_lock:
+            if self.flush_timer is None:
+                self.flush_timer = self.scheduler.call_later(self.roster_window, self._flush_roster)
+
+    def _flush_roster(self):
+        with self.flush_lock:
+            with self.roster_lock:
+                self.flush_timer = None
+                batch = self.roster.flush()
+                if batch is None:
+                    return
+                conns = list(self.subscribers)
+            frame = prot.encode(prot.PROTOCOL_V2, prot.OP_ROSTER_DELTA, self.roster.epoch, *batch)
+            for conn in conns:
+                conn.send(frame)
+            self.metrics.sent.inc(prot.OP_ROSTER_DELTA, amount=len(conns))
+
+    def on_disconnect(self, conn) -> bool:
+        """Remove a registered client and tell everyone else. Returns True if it was registered."""
+        nickname = conn.nickname
+        if not nickname:
+            return False
+        for room, remaining in self.rooms.leave_all(conn):
+            self.room_cast(remaining, prot.OP_ROOM_PART, room, nickname)
+        removed = self.clients.remove(nickname, conn)
+        with self.roster_lock:
+            self.subscribers.discard(conn)
+            if removed:
+                self.roster.leave(nickname, conn)
+        if removed:
+            # Not if the nickname was taken over meanwhile (e.g. by a federated node)
+            self.broadcast(prot.OP_LEFT, nickname, exclude_nick=nickname, key=nickname, only=self._is_legacy)
+            self._schedule_flush()
+        return removed
+
+    def handle_client(self, sock, addr):
         """Handle communication with a connected client."""
-        nickname = None
+        conn = ThreadedConnection(sock, addr, self.queue_size, self.slow_policy, self.metrics, self.socket_writer)
+        reader = FramedReader(sock, max_frame=self.max_frame)
+        self.metrics.connected(1)
+        reason = 'server'
         try:
-            data = recv_message(conn)
-            reg = parse_register(data)
-            tcp_port = None
-            if reg:
-                nickname, udp_port = reg
-                with self.lock:
-                    if nickname in self.clients:
-                        send_message(conn, make_nickname_taken())
-                        conn.close()
-                        return
-                try:
-                    port_msg = recv_message(conn)
-                    port_info = parse_port(port_msg)
-                    if port_info and port_info[0] == nickname:
-                        tcp_port = port_info[1]
-                    else:
-                        send_message(conn, make_error("Invalid PORT message or nickname mismatch"))
-                        conn.close()
-                        return
-                except Exception as e:
-                    send_message(conn, make_error(f"No TCP port received: {e}"))
-                    conn.close()
-                    return
-                with self.lock:
-                    self.clients[nickname] = (addr[0], udp_port, tcp_port, conn)
-                # Send all current users to the new client
-                with self.lock:
-                    for other_nick, (other_ip, other_udp, other_tcp, _) in self.clients.items():
-                        if other_nick != nickname:
-                            send_message(conn, f"JOINED {other_nick} {other_ip} {other_udp} {other_tcp}")
-                self.broadcast(f"JOINED {nickname} {addr[0]} {udp_port} {tcp_port}", exclude_nick=nickname)
-                while self.running:
-                    try:
-                        msg = recv_message(conn)
-                        if not msg:
-                            break
-                        if msg.startswith("BROADCAST "):
-                            self.broadcast(msg)
-                        elif msg.startswith("PORT "):
-                            port_info = parse_port(msg)
-                            if port_info and port_info[0] == nickname:
-                                with self.lock:
-                                    ip, udp, _, c = self.clients[nickname]
-                                    self.clients[nickname] = (ip, udp, port_info[1], c)
-                            else:
-                                send_message(conn, make_error("Malformed PORT message or nickname mismatch"))
-                        elif msg.startswith("REGISTER "):
-                            send_message(conn, make_error("Already registered"))
-                        elif msg.startswith("JOINED ") or msg.startswith("LEFT "):
-                            send_message(conn, make_error("JOINED/LEFT messages are server-generated only"))
-                        elif msg.startswith("ERROR ") or msg.startswith("NICKNAME_TAKEN"):
-                            send_message(conn, make_error("Client cannot send error or conflict messages"))
-                        else:
-                            send_message(conn, make_error("Unknown or unexpected command"))
-                    except Exception as e:
-                        send_message(conn, make_error(f"Server exception: {e}"))
-                        break
-            else:
-                send_message(conn, make_error("Invalid REGISTER format"))
-                conn.close()
-                return
+            while self.running:
+                if not self.on_message(conn, reader.recv()):
+                    reason = 'protocol'
+                    break
+        except (ConnectionError, OSError):
+            reason = 'closed'
+        except FrameTooLarge as e:
+            reason = 'oversized'
+            self.send(conn, prot.OP_ERROR, str(e))
         except Exception as e:
-            if conn:
-                try:
-                    send_message(conn, make_error(str(e)))
-                except:
-                    pass
+            reason = 'error'
+            self.metrics.errors.inc(type(e).__name__)
+            self.send(conn, prot.OP_ERROR, f"Server exception: {e}")
         finally:
-            if nickname:
-                with self.lock:
-                    if nickname in self.clients:
-                        del self.clients[nickname]
-                self.broadcast(make_left(nickname), exclude_nick=nickname)
+            self.on_disconnect(conn)
+            conn.close()
+            self.metrics.connected(-1)
+            self.metrics.disconnects.inc('slow' if conn.overflowed else reason)
+
+    def console_broadcast(self, msg):
+        self.queue_broadcast(msg)
+
+    def stop(self):
+        self.running = False
+
+    def start_metrics(self):
+        """Start the metrics endpoint and log line if they were configured."""
+        if self.metrics_port:
+            self.metrics.serve(self.metrics_port)
+        if self.metrics_interval > 0:
+            self.metrics.log_every(self.metrics_interval)
+
+    def input_thread(self):
+        """Read server console commands: 'q' quits, 'broadcast <msg>' broadcasts."""
+        while True:
             try:
-                conn.close()
-            except:
-                pass
+                cmd = input().strip()
+            except EOFError:
+                break
+            if cmd.lower() == 'q':
+                self.stop()
+                break
+            elif cmd.lower().startswith('broadcast '):
+                self.console_broadcast(cmd[len('broadcast '):])
 
     def start(self):
         """Start the TCP server and listen for incoming connections."""
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
+            if self.reuse_port:
+                server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             server_socket.bind((self.host, self.port))
             server_socket.listen()
-            def input_thread():
-                while True:
-                    cmd = input().strip()
-                    if cmd.lower() == 'q':
-                        self.running = False
-                        break
-                    elif cmd.lower().startswith('broadcast '):
-                        msg = cmd[len('broadcast '):]
-                        self.broadcast(make_broadcast(msg))
-            threading.Thread(target=input_thread, daemon=True).start()
+            self.start_metrics()
+            threading.Thread(target=self.input_thread, daemon=True).start()
             while self.running:
                 try:
                     server_socket.settimeout(1.0)
@@ -129,5 +444,6 @@ class PeerServer:
                     threading.Thread(target=self.handle_client, args=(conn, addr), daemon=True).start()
                 except socket.timeout:
                     continue
-                except Exception:
-                    break
\ No newline at end of file
+                except Exception as e:
+                    self.metrics.errors.inc(type(e).__name__)
+                    break
@@ -0,0 +1,262 @@
+"""
+Federated PeerChat servers.
+
+Several server nodes link to each other over TCP (the same port clients
+use; a link starts with NODE_HELLO instead of REGISTER) and gossip joins,
+leaves, port changes and broadcasts as NODE_EVENT frames, so clients on any
+node see the global peer list.
+
+Every event carries (origin node, sequence number). A node applies and
+forwards an event to its other links only the first time it sees that id,
+and roster events only if they changed something, so an event crosses each
+link at most once in each direction and relays never loop. Users are
+tagged with the node they are connected to (their owner); if two nodes
+accept the same nickname at the same time, the user on the node with the
+lower id wins everywhere and the other one gets NICKNAME_TAKEN.
+
+When a link drops, the users owned by the node at the other end are
+removed, so nodes should link directly to every other node (full mesh).
+
+A node accepts NODE_HELLO only from the hosts it links to or was told to
+allow; anyone else on the client port is refused, since a node link may
+announce, remove and take over any user.
+"""
+import itertools
+import random
+import socket
+import threading
+import time
+from collections import OrderedDict
+import network.protocol as prot
+from server.core import PeerServer
+from server.outbound import RemoteConnection
+
+class SeenCache:
+    """Bounded set of recently seen event ids (oldest forgotten first)."""
+
+    def __init__(self, maxlen: int = 4096):
+        self.maxlen = maxlen
+        self.ids = OrderedDict()
+
+    def add(self, event_id) -> bool:
+        """Remember an id. Returns False if it was already known."""
+        if event_id in self.ids:
+            return False
+        self.ids[event_id] = None
+        if len(self.ids) > self.maxlen:
+            self.ids.popitem(last=False)
+        return True
+
+class FederatedServer:
+    """Mixin for PeerServer engines that link to other server nodes."""
+
+    def setup_federation(self, links=(), node_id=None, name=None, retry: float = 2.0, allow=()):
+        self.node_id = node_id if node_id is not None else random.getrandbits(32)
+        self.node_name = name or f"{self.host}:{self.port}"
+        self.links = set()  # connections to other nodes
+        self.link_addrs = list(links)  # (host, port) we keep connected to
+        self.retry = retry
+        self.seen = SeenCache()
+        self.seq = itertools.count(1)
+        self.mesh_lock = threading.Lock()
+        # Addresses NODE_HELLO is accepted from: the linked and allowed hosts as given and resolved
+        self.node_hosts = {host for host, _ in self.link_addrs} | set(allow)
+        for host in list(self.node_hosts):
+            try:
+                self.node_hosts.update(info[4][0] for info in socket.getaddrinfo(host, None))
+            except OSError:
+                pass  # a link host is added once connected (see _link_thread)
+        self.metrics.gauge('node_links', 'Links to other server nodes', lambda: len(self.links))
+
+    def _owner(self, conn):
+        return conn.origin if isinstance(conn, RemoteConnection) else self.node_id
+
+    def _hello(self, reply: int) -> bytes:
+        return prot.encode(prot.PROTOCOL_V2, prot.OP_NODE_HELLO, self.node_id, self.node_name, reply)
+
+    # --- Events to other nodes ---
+    def _flood(self, owner, op, *fields, origin=None, seq=None, exclude=None):
+        """Send an event to every link except exclude; new events get a fresh id."""
+        if origin is None:
+            origin, seq = self.node_id, next(self.seq)
+        with self.mesh_lock:
+            self.seen.add((origin, seq))
+            links = [link for link in self.links if link is not exclude]
+        frame = prot.encode(prot.PROTOCOL_V2, prot.OP_NODE_EVENT, origin, seq, owner, prot.pack(op, *fields))
+        for link in links:
+            link.send(frame)
+
+    def _flood_join(self, nickname, entry, **relay):
+        self._flood(self._owner(entry[3]), prot.OP_JOINED, *self._joined_fields(nickname, entry), **relay)
+
+    def _complete_registration(self, conn, nickname, udp_port, tcp_port, since=(None, None)) -> bool:
+        if not super()._complete_registration(conn, nickname, udp_port, tcp_port, since):
+            return False
+        self._flood_join(nickname, self.clients.get(nickname))
+        return True
+
+    def on_disconnect(self, conn) -> bool:
+        if getattr(conn, 'node', None) is not None:
+            self.metrics.connected(1)  # taken back in _on_link_up; handle_client now counts it as gone
+            self._on_link_down(conn)
+            return False
+        removed = super().on_disconnect(conn)
+        if removed:
+            self._flood(self.node_id, prot.OP_LEFT, conn.nickname)
+        return removed
+
+    def _on_port(self, conn, record):
+        super()._on_port(conn, record)
+        if record.nickname == conn.nickname:
+            self._flood(self.node_id, prot.OP_PORT, record.nickname, record.tcp_port)
+
+    def _on_broadcast(self, conn, record):
+        super()._on_broadcast(conn, record)
+        self._flood(self.node_id, prot.OP_BROADCAST, record.message)
+
+    def console_broadcast(self, msg):
+        super().console_broadcast(msg)
+        loop = getattr(self, 'loop', None)
+        if loop is not None:
+            loop.call_soon_threadsafe(self._flood, self.node_id, prot.OP_BROADCAST, msg)
+        else:
+            self._flood(self.node_id, prot.OP_BROADCAST, msg)
+
+    # --- Frames from other nodes ---
+    def on_message(self, conn, msg) -> bool:
+        if getattr(conn, 'node', None) is not None:
+            record = prot.parse(msg)
+            if record.op == prot.OP_NODE_EVENT:
+                self._on_node_event(conn, record)
+            return True
+        if conn.nickname is None and conn.pending is None and isinstance(msg, bytes) \
+                and msg[:1] == bytes((prot.OP_NODE_HELLO,)):
+            if conn.addr[0] not in self.node_hosts:
+                self.send(conn, prot.OP_ERROR, "Not an allowed server node")
+                return False
+            record = prot.parse(msg)
+            if record.op != prot.OP_NODE_HELLO or record.node == self.node_id:
+                return False
+            self._on_link_up(conn, record)
+            return True
+        return super().on_message(conn, msg)
+
+    def _on_link_up(self, conn, hello):
+        conn.version = prot.PROTOCOL_V2
+        conn.node = hello.node
+        self.metrics.connected(-1)  # a node link is not a client
+        if hello.reply:
+            conn.send(self._hello(0))
+        with self.mesh_lock:
+            self.links.add(conn)
+        # Tell the new neighbour about everyone we know; it ignores what it already has
+        for nickname, entry in self.clients.snapshot():
+            seq = next(self.seq)
+            with self.mesh_lock:
+                self.seen.add((self.node_id, seq))  # so it is not applied again if relayed back
+            frame_fields = (self._owner(entry[3]), prot.pack(prot.OP_JOINED, *self._joined_fields(nickname, entry)))
+            conn.send(prot.encode(prot.PROTOCOL_V2, prot.OP_NODE_EVENT, self.node_id, seq, *frame_fields))
+
+    def _on_link_down(self, conn):
+        with self.mesh_lock:
+            self.links.discard(conn)
+        for nickname, entry in self.clients.snapshot():
+            if isinstance(entry[3], RemoteConnection) and entry[3].origin == conn.node:
+                if PeerServer.on_disconnect(self, entry[3]):
+                    self._flood(conn.node, prot.OP_LEFT, nickname)
+
+    def _on_node_event(self, link, event):
+        with self.mesh_lock:
+            if not self.seen.add((event.origin, event.seq)):
+                return  # already handled: this is what stops relay loops
+        record = prot.parse(event.payload)
+        if record.op == prot.OP_BROADCAST:
+            PeerServer.console_broadcast(self, record.message)
+            changed = True
+        elif record.op == prot.OP_JOINED:
+            changed = self._remote_join(event.owner, record)
+        elif record.op in (prot.OP_LEFT, prot.OP_PORT):
+            entry = self.clients.get(record.nickname)
+            conn = entry[3] if entry is not None else None
+            changed = isinstance(conn, RemoteConnection) and conn.origin == event.owner
+            if changed and record.op == prot.OP_LEFT:
+                changed = PeerServer.on_disconnect(self, conn)
+            elif changed:
+                changed = entry[2] != record.tcp_port and self.update_remote_port(conn, record.tcp_port)
+        else:
+            return
+        if changed:
+            self._flood(event.owner, record.op, *record, origin=event.origin, seq=event.seq, exclude=link)
+
+    def _remote_join(self, owner, record) -> bool:
+        entry = self.clients.get(record.nickname)
+        if entry is not None:
+            current = self._owner(entry[3])
+            if current == owner or current < owner:
+                return False
+            # Same nickname on two nodes: the lower node id keeps it
+            if isinstance(entry[3], RemoteConnection):
+                PeerServer.on_disconnect(self, entry[3])
+            else:
+                # The local client is only closed: the JOINED below replaces its entry,
+                # and its handle_client then finds the nickname gone and announces no LEFT
+                self.clients.remove(record.nickname, entry[3])
+                self.send(entry[3], prot.OP_NICKNAME_TAKEN)
+                entry[3].close()
+        conn = RemoteConnection(record.nickname, record.ip, record.flags or 0, owner)
+        return self.add_remote(conn, record.udp_port, record.tcp_port)
+
+    # --- Outgoing links ---
+    def _link_thread(self, addr):
+        while self.running:
+            try:
+                sock = socket.create_connection(addr, timeout=5)
+                sock.settimeout(None)
+                self.node_hosts.add(sock.getpeername()[0])
+                sock.sendall(self._hello(1))
+                self.handle_client(sock, addr)
+            except OSError:
+                pass
+            time.sleep(self.retry)
+
+    def connect_links(self):
+        for addr in self.link_addrs:
+            threading.Thread(target=self._link_thread, args=(addr,), daemon=True).start()
+
+class ThreadedNode(FederatedServer, PeerServer):
+    def start(self):
+        self.connect_links()
+        super().start()
+
+def _async_node_class():
+    import asyncio
+    from server.aio import AsyncPeerServer
+
+    class AsyncNode(FederatedServer, AsyncPeerServer):
+        async def _link_task(self, addr):
+            while self.running:
+                try:
+                    reader, writer = await asyncio.open_connection(*addr)
+                    self.node_hosts.add(writer.get_extra_info('peername')[0])
+                    writer.write(self._hello(1))
+                    await self.handle_client(reader, writer)
+                except OSError:
+                    pass
+                await asyncio.sleep(self.retry)
+
+        async def serve(self):
+            for addr in self.link_addrs:
+                asyncio.get_running_loop().create_task(self._link_task(addr))
+            await super().serve()
+
+    return AsyncNode
+
+def make_node(engine: str, links, *args, node_id=None, allow=(), **kwargs):
+    """Create a federated server for the given engine linking to links [(host, port)].
+
+    Links are accepted from the hosts in links and allow only.
+    """
+    cls = _async_node_class() if engine == "asyncio" else ThreadedNode
+    server = cls(*args, **kwargs)
+    server.setup_federation(links, node_id, allow=allow)
+    return server
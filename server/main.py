@@ -1,14 +1,97 @@
 import argparse
 from server.core import PeerServer
+from server.outbound import POLICIES, DROP_OLDEST
+
+def _raise_fd_limit():
+    """Raise the open-file soft limit so many idle clients fit (Unix only)."""
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or hard > soft:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
 
 def main():
     parser = argparse.ArgumentParser(description="Peer-to-Peer Server")
     parser.add_argument("-a", "--address", default="0.0.0.0", help="IP address to bind to")
     parser.add_argument("-p", "--port", type=int, default=12345, help="TCP port to listen on")
+    parser.add_argument("-e", "--engine", choices=("threads", "asyncio"), default="threads",
+                        help="Server engine: a reader thread per client, or a single asyncio event loop "
+                             "(the scalable choice for many mostly idle clients)")
+    parser.add_argument("--queue-size", type=int, default=1024,
+                        help="Maximum number of frames queued per client")
+    parser.add_argument("--slow-policy", choices=POLICIES, default=DROP_OLDEST,
+                        help="What to do when a client's outbound queue is full")
+    parser.add_argument("--roster-window", type=float, default=0.05,
+                        help="Seconds to batch joins/leaves into one roster update")
+    parser.add_argument("--broadcast-tick", type=float, default=0.02,
+                        help="Seconds to collect broadcasts into one write per client (0: send at once)")
+    parser.add_argument("--broadcast-rate", type=float, default=20.0,
+                        help="Broadcasts per second allowed per client (0: unlimited)")
+    parser.add_argument("--broadcast-burst", type=float, default=40.0,
+                        help="Broadcasts a client may send in a burst above --broadcast-rate")
+    parser.add_argument("--max-frame", type=int, default=1024 * 1024,
+                        help="Largest frame in bytes accepted from a client; larger ones close the connection")
+    parser.add_argument("-w", "--workers", type=int, default=0,
+                        help="Run this many server processes sharing the port (Unix only)")
+    parser.add_argument("-l", "--link", action="append", default=[], metavar="HOST:PORT",
+                        help="Federate with another server node (repeat for each node)")
+    parser.add_argument("--allow-node", action="append", default=[], metavar="HOST",
+                        help="Accept a link from the server node at HOST (repeat for each node; "
+                             "linked hosts are always accepted)")
+    parser.add_argument("--federate", action="store_true",
+                        help="Run as a federated node (implied by --link and --allow-node)")
+    parser.add_argument("--node-id", type=int, help="Node id for federation (default: random)")
+    parser.add_argument("--metrics-port", type=int, default=0,
+                        help="Serve Prometheus metrics on http://127.0.0.1:PORT/metrics (0: off)")
+    parser.add_argument("--metrics-interval", type=float, default=0,
+                        help="Log a metrics summary line to stderr every this many seconds (0: off)")
     args = parser.parse_args()
 
-    server = PeerServer(args.address, args.port)
+    links = []
+    for link in args.link:
+        host, _, port = link.rpartition(':')
+        if not host or not port.isdigit():
+            parser.error(f"--link expects HOST:PORT, got {link}")
+        links.append((host, int(port)))
+    federate = args.federate or bool(links) or bool(args.allow_node)
+    if federate and not (links or args.allow_node):
+        parser.error("--federate needs --link or --allow-node")
+    options = dict(metrics_port=args.metrics_port, metrics_interval=args.metrics_interval,
+                   broadcast_tick=args.broadcast_tick, broadcast_rate=args.broadcast_rate,
+                   broadcast_burst=args.broadcast_burst, max_frame=args.max_frame)
+    if federate and args.workers > 0:
+        parser.error("--link/--federate cannot be combined with --workers")
+
+    if federate:
+        from server.federation import make_node
+        if args.engine == "asyncio":
+            _raise_fd_limit()
+        server = make_node(args.engine, links, args.address, args.port, args.queue_size,
+                           args.slow_policy, args.roster_window, node_id=args.node_id,
+                           allow=args.allow_node, **options)
+        server.start()
+        return
+    if args.workers > 0:
+        from server.cluster import run_cluster
+        if args.engine == "asyncio":
+            _raise_fd_limit()
+        run_cluster(args.workers, args.engine, args.address, args.port, args.queue_size,
+                    args.slow_policy, args.roster_window, **options)
+        return
+    if args.engine == "asyncio":
+        from server.aio import AsyncPeerServer
+        _raise_fd_limit()
+        server = AsyncPeerServer(args.address, args.port, args.queue_size, args.slow_policy,
+                                 args.roster_window, **options)
+    else:
+        server = PeerServer(args.address, args.port, args.queue_size, args.slow_policy, args.roster_window,
+                            **options)
     server.start()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,244 @@
+"""
+Built-in server metrics.
+
+Counters, gauges and histograms are kept in process memory and rendered
+in the Prometheus text exposition format, either over a small HTTP
+endpoint (GET /metrics, bound to localhost) or as a periodic summary line
+on stderr. Recording a value is a dict update under a per-metric lock, so
+the metrics can stay enabled in production. Gauges are callables evaluated
+only when scraped (e.g. the number of clients or queue depths), so they
+cost nothing between scrapes.
+"""
+import bisect
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import network.protocol as prot
+
+LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+FANOUT_BUCKETS = (0, 1, 2, 5, 10, 50, 100, 500, 1000, 5000, 10000)
+
+def _labels(names, values, display) -> str:
+    if not names:
+        return ''
+    pairs = ','.join(f'{n}="{display.get(v, v)}"' for n, v in zip(names, values))
+    return '{' + pairs + '}'
+
+def _number(value) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+class Counter:
+    """Monotonic counter, optionally split by a tuple of label values.
+
+    display maps raw label values (such as opcodes) to the rendered text.
+    """
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=(), display=None):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.display = display or {}
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def total(self) -> int:
+        with self.lock:
+            return sum(self.values.values())
+
+    def samples(self):
+        with self.lock:
+            items = sorted(self.values.items(), key=lambda item: tuple(map(str, item[0])))
+        for labels, value in items:
+            yield self.name, _labels(self.labels, labels, self.display), value
+
+class Gauge:
+    """Value read from fn() at scrape time."""
+    kind = 'gauge'
+
+    def __init__(self, name, help, fn):
+        self.name = name
+        self.help = help
+        self.fn = fn
+
+    def samples(self):
+        yield self.name, '', self.fn()
+
+class Histogram:
+    """Distribution over fixed bucket upper bounds (cumulative when rendered)."""
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.bounds = list(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def quantile(self, q) -> float:
+        """Upper bound of the bucket holding the q-quantile (an estimate)."""
+        with self.lock:
+            counts, count = list(self.counts), self.count
+        if not count:
+            return 0.0
+        rank, seen = q * count, 0
+        for bound, n in zip(self.bounds + [float('inf')], counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def samples(self):
+        with self.lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        seen = 0
+        for bound, n in zip(self.bounds + [float('inf')], counts):
+            seen += n
+            yield self.name + '_bucket', '{le="' + _number(bound) + '"}', seen
+        yield self.name + '_sum', '', total
+        yield self.name + '_count', '', count
+
+class TimedLock:
+    """threading.Lock that records how long callers waited for it and held it."""
+
+    def __init__(self, wait: Histogram, hold: Histogram):
+        self.lock = threading.Lock()
+        self.wait = wait
+        self.hold = hold
+        self.acquired = 0.0
+
+    def acquire(self, blocking=True, timeout=-1) -> bool:
+        start = time.perf_counter()
+        ok = self.lock.acquire(blocking, timeout)
+        if ok:
+            self.acquired = time.perf_counter()
+            self.wait.observe(self.acquired - start)
+        return ok
+
+    def release(self):
+        held = time.perf_counter() - self.acquired
+        self.lock.release()
+        self.hold.observe(held)
+
+    def locked(self) -> bool:
+        return self.lock.locked()
+
+    __enter__ = acquire
+
+    def __exit__(self, *exc):
+        self.release()
+
+class Metrics:
+    """The metrics of one server process."""
+
+    def __init__(self, prefix: str = 'peerchat'):
+        self.prefix = prefix
+        self.started = time.time()
+        self.metrics = []
+        self.received = self.counter('messages_received_total', 'Frames received from clients',
+                                     ('op',), prot.OP_NAMES)
+        self.received_bytes = self.counter('received_bytes_total', 'Payload bytes received from clients')
+        self.sent = self.counter('messages_sent_total', 'Frames enqueued for clients', ('op',), prot.OP_NAMES)
+        self.sent_bytes = self.counter('sent_bytes_total', 'Bytes written to client sockets')
+        self.dropped = self.counter('frames_dropped_total', 'Frames dropped or coalesced by full outbound queues')
+        self.send_failures = self.counter('send_failures_total', 'Socket errors while writing to clients')
+        self.disconnects = self.counter('disconnects_total', 'Closed client connections by reason', ('reason',))
+        self.errors = self.counter('errors_total', 'Unexpected exceptions in the server', ('type',))
+        self.broadcast_latency = self.histogram('broadcast_seconds', 'Time to encode and enqueue one broadcast')
+        self.broadcast_fanout = self.histogram('broadcast_recipients', 'Clients reached by one broadcast',
+                                               FANOUT_BUCKETS)
+        self.lock_wait = self.histogram('roster_lock_wait_seconds', 'Time spent waiting for the roster lock')
+        self.lock_hold = self.histogram('roster_lock_hold_seconds', 'Time the roster lock was held')
+        self.connections = 0  # open client connections, including unregistered ones
+        self.connections_lock = threading.Lock()
+        self.gauge('connections', 'Open client connections', lambda: self.connections)
+        self.gauge('uptime_seconds', 'Seconds since the server started', lambda: round(time.time() - self.started, 3))
+        self.http = None
+
+    def counter(self, name, help, labels=(), display=None) -> Counter:
+        return self._add(Counter(f'{self.prefix}_{name}', help, labels, display))
+
+    def gauge(self, name, help, fn) -> Gauge:
+        return self._add(Gauge(f'{self.prefix}_{name}', help, fn))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(f'{self.prefix}_{name}', help, buckets))
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def timed_lock(self) -> TimedLock:
+        return TimedLock(self.lock_wait, self.lock_hold)
+
+    def connected(self, delta: int):
+        with self.connections_lock:
+            self.connections += delta
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format (version 0.0.4)."""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{labels} {_number(value)}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> str:
+        """One log line with the most important numbers."""
+        values = {metric.name[len(self.prefix) + 1:]: metric for metric in self.metrics}
+        gauges = ' '.join(f'{name}={next(m.samples())[2]}' for name, m in values.items()
+                          if m.kind == 'gauge' and name != 'uptime_seconds')
+        return (f"[metrics] {gauges} in={self.received.total()} out={self.sent.total()} "
+                f"bytes_out={self.sent_bytes.total()} dropped={self.dropped.total()} "
+                f"send_failures={self.send_failures.total()} errors={self.errors.total()} "
+                f"broadcast_p99={self.broadcast_latency.quantile(0.99) * 1e3:g}ms "
+                f"lock_wait_p99={self.lock_wait.quantile(0.99) * 1e3:g}ms")
+
+    def serve(self, port: int, host: str = '127.0.0.1'):
+        """Serve GET /metrics on (host, port) in a daemon thread."""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/metrics', '/'):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # scrapes are not worth a log line
+
+        self.http = ThreadingHTTPServer((host, port), Handler)
+        self.http.daemon_threads = True
+        threading.Thread(target=self.http.serve_forever, daemon=True).start()
+
+    def log_every(self, interval: float, out=None):
+        """Write summary() to out (stderr) every interval seconds in a daemon thread."""
+        def run():
+            while True:
+                time.sleep(interval)
+                print(self.summary(), file=out or sys.stderr, flush=True)
+        threading.Thread(target=run, daemon=True).start()
@@ -0,0 +1,398 @@
+"""
+Per-client outbound queues for the PeerChat server.
+
+Every connection owns a bounded queue of already-encoded frames that is
+drained by a writer (one SocketWriter thread shared by all clients of a
+PeerServer, a task per client for AsyncPeerServer). Producers such as
+broadcast only enqueue, so a slow or stalled client never blocks the
+sender or other clients.
+"""
+import asyncio
+import selectors
+import socket
+import threading
+import time
+import traceback
+from collections import deque
+import network.protocol as prot
+
+# Slow-consumer policies applied when a client's queue is full
+DROP_OLDEST = "drop_oldest"  # discard the oldest queued frame
+DISCONNECT = "disconnect"    # drop the client
+COALESCE = "coalesce"        # replace queued frames with the same key, else drop oldest
+POLICIES = (DROP_OLDEST, DISCONNECT, COALESCE)
+
+class OutboundQueue:
+    """Bounded FIFO of encoded frames with a slow-consumer policy.
+
+    Not thread-safe by itself; the connection classes below guard it.
+    Frames may carry a key (e.g. the nickname of a JOINED/LEFT update) so
+    that, under the coalesce policy, a newer frame supersedes a queued one
+    for the same key instead of growing the queue.
+    """
+
+    def __init__(self, maxlen: int = 1024, policy: str = DROP_OLDEST):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown slow-consumer policy: {policy}")
+        self.maxlen = maxlen
+        self.policy = policy
+        self.items = deque()  # [key, frame]
+        self.keyed = {}       # key -> queued item (coalesce only)
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def push(self, frame: bytes, key=None) -> bool:
+        """Queue a frame. Returns False if the client should be disconnected."""
+        if self.policy == COALESCE and key is not None:
+            item = self.keyed.get(key)
+            if item is not None:
+                item[1] = frame
+                self.dropped += 1
+                return True
+        if len(self.items) >= self.maxlen:
+            if self.policy == DISCONNECT:
+                self.dropped += 1  # the refused frame
+                return False
+            old_key, _ = self.items.popleft()
+            if old_key is not None:
+                self.keyed.pop(old_key, None)
+            self.dropped += 1
+        item = [key, frame]
+        self.items.append(item)
+        if self.policy == COALESCE and key is not None:
+            self.keyed[key] = item
+        return True
+
+    def drain(self) -> list:
+        """Remove and return all queued frames in order."""
+        frames = [frame for _, frame in self.items]
+        self.items.clear()
+        self.keyed.clear()
+        return frames
+
+class TokenBucket:
+    """Allows rate events per second on average and bursts of up to burst events."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.limited = False  # the last take() failed; the client has been told once
+
+    def take(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+class Connection:
+    """Per-client session state shared by both server engines."""
+
+    def __init__(self, addr):
+        self.addr = addr
+        self.version = 1       # protocol version used for frames sent to this client
+        self.nickname = None   # set once registration has completed
+        self.pending = None    # (nickname, udp_port, roster since) while waiting for PORT
+        self.caps = 0          # REGISTER capability flags
+        self.overflowed = False  # disconnected because the outbound queue was full
+        self.bucket = None       # TokenBucket limiting the client's broadcasts and room messages
+        self.rooms = set()       # names of the rooms joined (see server.rooms)
+
+    def send(self, frame: bytes, key=None):
+        raise NotImplementedError
+
+class RemoteConnection(Connection):
+    """Registry entry for a user served by another worker or server node.
+
+    Frames for it are delivered by the process it is connected to, so
+    sending here does nothing. origin identifies that process.
+    """
+
+    def __init__(self, nickname, ip, flags=0, origin=None):
+        super().__init__((ip, 0))
+        self.nickname = nickname
+        self.version = prot.PROTOCOL_V2 if flags & prot.FLAG_V2 else prot.PROTOCOL_V1
+        self.caps = flags & prot.FLAG_DATAGRAM
+        self.origin = origin
+
+    def send(self, frame: bytes, key=None):
+        pass
+
+# What a connection needs from the SocketWriter after a write attempt
+WRITE_WAIT, WRITE_IDLE, WRITE_DONE = range(3)
+
+class ThreadedConnection(Connection):
+    """Client socket with an outbound queue drained by a SocketWriter.
+
+    Without a shared writer (platforms lacking MSG_DONTWAIT) the
+    connection starts a writer thread of its own.
+    """
+
+    def __init__(self, sock: socket.socket, addr, maxlen: int = 1024, policy: str = DROP_OLDEST, metrics=None,
+                 writer=None):
+        super().__init__(addr)
+        self.sock = sock
+        self.queue = OutboundQueue(maxlen, policy)
+        self.metrics = metrics
+        self.cond = threading.Condition()
+        self.closing = False  # flush what is queued, then close
+        self.closed = False
+        self.writer = writer
+        self.scheduled = False  # handed to the writer and not written yet
+        self.out = bytearray()  # drained frames the socket did not take yet (writer thread only)
+        if writer is None:
+            threading.Thread(target=self._write_loop, daemon=True).start()
+
+    def _wake_writer(self):
+        # Call with self.cond held; returns True if the shared writer must be told
+        self.cond.notify()
+        if self.writer is None or self.scheduled:
+            return False
+        self.scheduled = True
+        return True
+
+    def send(self, frame: bytes, key=None):
+        """Enqueue an encoded frame; never blocks on the network."""
+        with self.cond:
+            if self.closing or self.closed:
+                return
+            dropped = self.queue.dropped
+            overflow = not self.queue.push(frame, key)
+            if overflow:
+                self.closed = self.overflowed = True
+            wake = self._wake_writer()
+        if self.metrics is not None and self.queue.dropped != dropped:
+            self.metrics.dropped.inc()
+        if overflow:
+            self._shutdown()
+        if wake:
+            self.writer.schedule(self)
+
+    def close(self):
+        """Close after the queued frames have been written."""
+        with self.cond:
+            self.closing = True
+            wake = self._wake_writer()
+        if wake:
+            self.writer.schedule(self)
+
+    def abort(self):
+        """Close immediately, discarding queued frames."""
+        with self.cond:
+            self.closed = True
+            wake = self._wake_writer()
+        self._shutdown()
+        if wake:
+            self.writer.schedule(self)
+
+    def _shutdown(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _close_socket(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+    def _write_ready(self):
+        """Write as much as the socket takes now (SocketWriter thread).
+
+        Frames are taken from the queue only once the previous batch is
+        written, so a client that stops reading still runs into the queue's
+        slow-consumer policy. Returns WRITE_WAIT if the socket is full,
+        WRITE_IDLE once everything was written and WRITE_DONE when the
+        connection is finished.
+        """
+        while True:
+            with self.cond:
+                self.scheduled = False
+                if self.closed:
+                    return WRITE_DONE
+                if not self.out:
+                    frames = self.queue.drain()
+                    if not frames:
+                        return WRITE_DONE if self.closing else WRITE_IDLE
+                    self.out = bytearray(b''.join(frames))
+            try:
+                while self.out:
+                    sent = self.sock.send(self.out, socket.MSG_DONTWAIT)
+                    del self.out[:sent]
+                    if self.metrics is not None:
+                        self.metrics.sent_bytes.inc(amount=sent)
+            except (BlockingIOError, InterruptedError):
+                return WRITE_WAIT
+            except OSError:
+                with self.cond:
+                    self.closed = True
+                if self.metrics is not None:
+                    self.metrics.send_failures.inc()
+                self._shutdown()
+                return WRITE_DONE
+
+    def _write_loop(self):
+        try:
+            while True:
+                with self.cond:
+                    while not self.queue and not self.closing and not self.closed:
+                        self.cond.wait()
+                    if self.closed:
+                        return
+                    frames = self.queue.drain()
+                    done = self.closing and not frames
+                if done:
+                    return
+                data = b''.join(frames)
+                self.sock.sendall(data)
+                if self.metrics is not None:
+                    self.metrics.sent_bytes.inc(amount=len(data))
+        except OSError:
+            with self.cond:
+                self.closed = True
+            if self.metrics is not None:
+                self.metrics.send_failures.inc()
+            self._shutdown()
+        finally:
+            self._close_socket()
+
+class SocketWriter:
+    """One thread writing the outbound queues of all ThreadedConnections.
+
+    Sends use MSG_DONTWAIT, so the reader threads keep their blocking
+    sockets while a client that stops reading only parks its connection
+    in a selector until the socket is writable again; it never holds up
+    the writes to other clients.
+    """
+
+    supported = hasattr(socket, 'MSG_DONTWAIT')
+
+    def __init__(self, name: str = 'writer'):
+        self.name = name
+        self.ready = deque()  # connections with frames to write or a close to finish
+        self.waiting = set()  # connections registered until their socket is writable
+        self.lock = threading.Lock()
+        self.thread = None  # started with the first write, i.e. in the process that serves
+
+    def schedule(self, conn):
+        """Have the writer thread write conn's queue. Safe to call from any thread."""
+        self.ready.append(conn)
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.selector = selectors.DefaultSelector()
+                    self._wake_r, self._wake_w = socket.socketpair()
+                    self._wake_r.setblocking(False)
+                    self._wake_w.setblocking(False)
+                    self.selector.register(self._wake_r, selectors.EVENT_READ)
+                    self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                    self.thread.start()
+        try:
+            self._wake_w.send(b'\0')
+        except OSError:
+            pass  # already woken (buffer full)
+
+    def _run(self):
+        while True:
+            for key, _ in self.selector.select():
+                if key.fileobj is self._wake_r:
+                    try:
+                        while self._wake_r.recv(4096):
+                            pass
+                    except OSError:
+                        pass
+                else:
+                    self.ready.append(key.data)  # writable again
+            while self.ready:
+                self._write(self.ready.popleft())
+
+    def _write(self, conn):
+        try:
+            state = conn._write_ready()
+        except Exception:
+            traceback.print_exc()
+            state = WRITE_DONE
+        if state == WRITE_WAIT:
+            if conn not in self.waiting:
+                self.waiting.add(conn)
+                self.selector.register(conn.sock, selectors.EVENT_WRITE, conn)
+            return
+        if conn in self.waiting:
+            self.waiting.discard(conn)
+            self.selector.unregister(conn.sock)
+        if state == WRITE_DONE:
+            conn._close_socket()
+
+class AsyncConnection(Connection):
+    """StreamWriter with an outbound queue drained by a writer task.
+
+    All methods must be called on the event loop thread.
+    """
+
+    def __init__(self, writer, maxlen: int = 1024, policy: str = DROP_OLDEST, metrics=None):
+        super().__init__(writer.get_extra_info('peername'))
+        self.writer = writer
+        self.queue = OutboundQueue(maxlen, policy)
+        self.metrics = metrics
+        self.ready = asyncio.Event()
+        self.closing = False
+        self.closed = False
+        self.task = asyncio.get_running_loop().create_task(self._write_loop())
+
+    def send(self, frame: bytes, key=None):
+        """Enqueue an encoded frame; never waits for the network."""
+        if self.closing or self.closed:
+            return
+        dropped = self.queue.dropped
+        overflow = not self.queue.push(frame, key)
+        if self.metrics is not None and self.queue.dropped != dropped:
+            self.metrics.dropped.inc()
+        if overflow:
+            self.overflowed = True
+            self.abort()
+            return
+        self.ready.set()
+
+    def close(self):
+        """Close after the queued frames have been written."""
+        self.closing = True
+        self.ready.set()
+
+    def abort(self):
+        """Close immediately, discarding queued frames."""
+        self.closed = True
+        self.ready.set()
+        self.writer.transport.abort()
+
+    async def _write_loop(self):
+        try:
+            while not self.closed:
+                if not self.queue and not self.closing:
+                    self.ready.clear()
+                    await self.ready.wait()
+                    continue
+                frames = self.queue.drain()
+                if frames:
+                    data = b''.join(frames)
+                    self.writer.write(data)
+                    await self.writer.drain()
+                    if self.metrics is not None:
+                        self.metrics.sent_bytes.inc(amount=len(data))
+                elif self.closing:
+                    break
+        except (ConnectionError, OSError):
+            self.closed = True
+            if self.metrics is not None:
+                self.metrics.send_failures.inc()
+        finally:
+            try:
+                self.writer.close()
+            except Exception:
+                pass
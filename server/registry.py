@@ -0,0 +1,92 @@
+"""
+Client registry for the PeerChat server.
+
+Registered clients are spread over shards by nickname hash, each with its
+own lock, so registrations, PORT updates and disconnects of different
+clients rarely wait for each other. Readers such as broadcast never lock:
+they iterate an immutable snapshot that is rebuilt lazily after a change.
+"""
+import itertools
+import threading
+
+class _Shard:
+    __slots__ = ('clients', 'lock', 'items')
+
+    def __init__(self):
+        self.clients = {}
+        self.lock = threading.Lock()
+        self.items = ()  # immutable copy of clients, None after a change
+
+class Registry:
+    """Sharded nickname -> (ip, udp_port, tcp_port, conn) mapping."""
+
+    def __init__(self, shards: int = 16):
+        self.shards = [_Shard() for _ in range(shards)]
+
+    def _shard(self, nickname):
+        return self.shards[hash(nickname) % len(self.shards)]
+
+    def add(self, nickname, entry) -> bool:
+        """Insert a new client. Returns False if the nickname is taken."""
+        shard = self._shard(nickname)
+        with shard.lock:
+            if nickname in shard.clients:
+                return False
+            shard.clients[nickname] = entry
+            shard.items = None
+        return True
+
+    def update(self, nickname, conn, **changes) -> bool:
+        """Change fields (ip, udp_port, tcp_port) of the entry owned by conn."""
+        shard = self._shard(nickname)
+        with shard.lock:
+            entry = shard.clients.get(nickname)
+            if entry is None or entry[3] is not conn:
+                return False
+            ip, udp_port, tcp_port, _ = entry
+            shard.clients[nickname] = (changes.get('ip', ip), changes.get('udp_port', udp_port),
+                                       changes.get('tcp_port', tcp_port), conn)
+            shard.items = None
+        return True
+
+    def remove(self, nickname, conn) -> bool:
+        """Remove the entry if it still belongs to conn."""
+        shard = self._shard(nickname)
+        with shard.lock:
+            entry = shard.clients.get(nickname)
+            if entry is None or entry[3] is not conn:
+                return False
+            del shard.clients[nickname]
+            shard.items = None
+        return True
+
+    def get(self, nickname, default=None):
+        return self._shard(nickname).clients.get(nickname, default)
+
+    def __contains__(self, nickname):
+        return nickname in self._shard(nickname).clients
+
+    def __len__(self):
+        return sum(len(shard.clients) for shard in self.shards)
+
+    def snapshot(self):
+        """Iterate all (nickname, entry) pairs without holding any lock.
+
+        Each shard keeps an immutable copy of its entries that is only
+        rebuilt after that shard changed, so a broadcast after a single
+        registration copies one shard instead of the whole registry.
+        """
+        parts = []
+        for shard in self.shards:
+            items = shard.items
+            if items is None:
+                with shard.lock:
+                    items = shard.items = tuple(shard.clients.items())
+            parts.append(items)
+        return itertools.chain.from_iterable(parts)
+
+    def items(self):
+        return self.snapshot()
+
+    def values(self):
+        return (entry for _, entry in self.snapshot())
@@ -0,0 +1,64 @@
+"""
+Group rooms for the PeerChat server.
+
+Rooms maps each room name to the set of its member connections, so a room
+message is encoded once and handed only to the members' queues; the cost
+does not depend on how many other clients or rooms exist. Member sets are
+immutable and replaced on every change, so fan-out reads them without a
+lock while joins and parts are serialized by one lock. Every connection
+also remembers its rooms (conn.rooms) so a disconnect leaves them all
+without scanning the index.
+"""
+import threading
+
+MAX_ROOM_NAME = 64        # characters
+MAX_ROOMS_PER_CLIENT = 64
+
+def valid_room_name(room) -> bool:
+    return bool(room) and len(room) <= MAX_ROOM_NAME and room.strip() == room and room.isprintable()
+
+class Rooms:
+    def __init__(self):
+        self.members = {}  # room -> frozenset of connections; empty rooms are removed
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.members)
+
+    def get(self, room) -> frozenset:
+        return self.members.get(room, frozenset())
+
+    def join(self, room, conn):
+        """Add conn to room. Returns the members before it joined, or None if it already was one."""
+        with self.lock:
+            before = self.members.get(room, frozenset())
+            if conn in before:
+                return None
+            self.members[room] = before | {conn}
+            conn.rooms.add(room)
+            return before
+
+    def part(self, room, conn):
+        """Remove conn from room. Returns the remaining members, or None if it was not a member."""
+        with self.lock:
+            before = self.members.get(room)
+            if before is None or conn not in before:
+                return None
+            after = before - {conn}
+            if after:
+                self.members[room] = after
+            else:
+                del self.members[room]
+            conn.rooms.discard(room)
+            return after
+
+    def leave_all(self, conn) -> list:
+        """Remove conn from every room. Returns [(room, remaining members)]."""
+        with self.lock:
+            rooms = list(conn.rooms)
+        left = []
+        for room in rooms:
+            remaining = self.part(room, conn)
+            if remaining is not None:
+                left.append((room, remaining))
+        return left
@@ -0,0 +1,100 @@
+"""
+Versioned roster for the PeerChat server.
+
+Joins, leaves and port changes are collected for a short window and then
+published as one numbered batch (a ROSTER_DELTA). The last batches are kept
+in a changelog so a client that reconnects with the roster version it
+already has only receives what changed since then instead of the full list.
+"""
+import random
+from collections import deque
+import network.protocol as prot
+
+class Roster:
+    """Published roster plus the pending, not yet published changes.
+
+    Not thread-safe by itself; the server guards it with its roster_lock.
+    """
+
+    def __init__(self, history: int = 256):
+        # A new epoch per server run, so versions from an earlier run are never reused
+        self.epoch = random.getrandbits(32)
+        self.version = 0
+        self.entries = {}  # nickname -> (nickname, ip, udp_port, tcp_port, flags)
+        self.pending = {}  # nickname -> change, in arrival order
+        self.fresh = set() # nicknames that joined during the current window
+        self.owners = {}   # nickname -> connection that joined last
+        self.log = deque(maxlen=history)  # (version, changes)
+
+    def join(self, entry, owner=None):
+        nickname = entry[0]
+        self.owners[nickname] = owner
+        if nickname not in self.entries and nickname not in self.pending:
+            self.fresh.add(nickname)
+        self.pending.pop(nickname, None)
+        self.pending[nickname] = (prot.CHANGE_JOIN,) + tuple(entry)
+
+    def leave(self, nickname, owner=None):
+        # The registry and the roster are locked separately, so a new owner's
+        # join may be recorded before the old owner's leave; ignore the latter
+        if self.owners.get(nickname) is not owner:
+            return
+        del self.owners[nickname]
+        self.pending.pop(nickname, None)
+        if nickname in self.fresh:
+            # Joined and left within one window: nobody needs to hear about it
+            self.fresh.discard(nickname)
+        else:
+            self.pending[nickname] = (prot.CHANGE_LEAVE, nickname)
+
+    def port(self, nickname, tcp_port):
+        change = self.pending.get(nickname)
+        if change is not None and change[0] == prot.CHANGE_JOIN:
+            self.pending[nickname] = change[:4] + (tcp_port,) + change[5:]
+        elif change is None or change[0] != prot.CHANGE_LEAVE:
+            self.pending[nickname] = (prot.CHANGE_PORT, nickname, tcp_port)
+
+    def flush(self):
+        """Publish the pending changes as the next version.
+
+        Returns (base, version, changes), or None if nothing changed.
+        """
+        if not self.pending:
+            return None
+        changes = list(self.pending.values())
+        self.pending.clear()
+        self.fresh.clear()
+        for change in changes:
+            self._apply(change)
+        base = self.version
+        self.version += 1
+        self.log.append((self.version, changes))
+        return base, self.version, changes
+
+    def _apply(self, change):
+        kind, nickname = change[0], change[1]
+        if kind == prot.CHANGE_JOIN:
+            self.entries[nickname] = change[1:]
+        elif kind == prot.CHANGE_LEAVE:
+            self.entries.pop(nickname, None)
+        elif nickname in self.entries:
+            entry = self.entries[nickname]
+            self.entries[nickname] = entry[:3] + (change[2],) + entry[4:]
+
+    def snapshot(self):
+        """Published roster as (epoch, version, entries)."""
+        return self.epoch, self.version, list(self.entries.values())
+
+    def since(self, epoch, version):
+        """Changes after the given version, or None if a snapshot is needed."""
+        if epoch != self.epoch or version is None or version > self.version:
+            return None
+        if version == self.version:
+            return []
+        if not self.log or self.log[0][0] > version + 1:
+            return None  # older than the changelog
+        changes = []
+        for logged, batch in self.log:
+            if logged > version:
+                changes.extend(batch)
+        return changes
@@ -0,0 +1,46 @@
+"""
+Delayed calls for the threaded server engine.
+
+Broadcast ticks and roster flushes are scheduled many times per second.
+A Scheduler serves all of them from one long-lived thread (a heap of due
+times and a condition variable) instead of starting a threading.Timer
+thread for each. The asyncio engine uses its event loop's call_later instead.
+"""
+import heapq
+import itertools
+import threading
+import time
+import traceback
+
+class Scheduler:
+    def __init__(self, name: str = 'scheduler'):
+        self.name = name
+        self.heap = []  # (due, sequence number, fn, args)
+        self.seq = itertools.count()  # keeps calls with the same due time in order
+        self.cond = threading.Condition()
+        self.thread = None  # started with the first call, i.e. in the process that serves
+
+    def call_later(self, delay: float, fn, *args):
+        """Run fn(*args) on the scheduler thread after delay seconds. Returns the scheduled entry."""
+        entry = (time.monotonic() + delay, next(self.seq), fn, args)
+        with self.cond:
+            heapq.heappush(self.heap, entry)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self.thread.start()
+            self.cond.notify()
+        return entry
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while True:
+                    now = time.monotonic()
+                    if self.heap and self.heap[0][0] <= now:
+                        break
+                    self.cond.wait(self.heap[0][0] - now if self.heap else None)
+                _, _, fn, args = heapq.heappop(self.heap)
+            try:
+                fn(*args)
+            except Exception:
+                traceback.print_exc()
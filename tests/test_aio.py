@@ -0,0 +1,162 @@
+import socket
+import threading
+import time
+import unittest
+import network.protocol as prot
+from network.tcp import FramedReader, encode_message, encode_frame_v2
+from server.core import PeerServer
+from server.aio import AsyncPeerServer
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+class Client:
+    """A raw protocol client reading frames with a timeout."""
+
+    def __init__(self, port):
+        self.sock = socket.create_connection(('127.0.0.1', port), timeout=5)
+        self.reader = FramedReader(self.sock)
+
+    def send(self, msg):
+        self.sock.sendall(encode_message(msg) if isinstance(msg, str) else encode_frame_v2(msg))
+
+    def recv(self):
+        return self.reader.recv()
+
+    def closed(self) -> bool:
+        try:
+            self.recv()
+        except (ConnectionError, OSError):
+            return True
+        return False
+
+    def close(self):
+        self.sock.close()
+
+class ServerFixture:
+    """Runs self.make_server(host, port) in a thread for each test."""
+
+    def make_server(self, host, port):
+        raise NotImplementedError
+
+    def setUp(self):
+        port = free_port()
+        self.server = self.make_server('127.0.0.1', port)
+        self.server.input_thread = lambda: None  # no console in tests
+        self.thread = threading.Thread(target=self.server.start, daemon=True)
+        self.thread.start()
+        self.clients = []
+        deadline = time.monotonic() + 5
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.02)
+        self.port = port
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self.server.stop()
+        self.thread.join(3)
+
+    def connect(self) -> Client:
+        client = Client(self.port)
+        self.clients.append(client)
+        return client
+
+    def register(self, nickname, udp_port, tcp_port) -> Client:
+        client = self.connect()
+        client.send(prot.make_register(nickname, udp_port))
+        client.send(prot.make_port(nickname, tcp_port))
+        # Clients are served concurrently; wait until this one is known before the next connects
+        deadline = time.monotonic() + 5
+        while nickname not in self.server.clients and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return client
+
+class EngineBehaviour(ServerFixture):
+    """Protocol checks every server engine must pass unchanged."""
+    server_class = None
+
+    def make_server(self, host, port):
+        return self.server_class(host, port)
+
+    def test_text_clients(self):
+        alice = self.register('alice', 5000, 6000)
+        bob = self.register('bob', 5001, 6001)
+        self.assertEqual(bob.recv(), 'JOINED alice 127.0.0.1 5000 6000')
+        self.assertEqual(alice.recv(), 'JOINED bob 127.0.0.1 5001 6001')
+        alice.send('BROADCAST hello all')
+        self.assertEqual(alice.recv(), 'BROADCAST hello all')
+        self.assertEqual(bob.recv(), 'BROADCAST hello all')
+        bob.close()
+        self.assertEqual(alice.recv(), 'LEFT bob')
+
+    def test_nickname_taken(self):
+        self.register('alice', 5000, 6000)
+        other = self.connect()
+        other.send(prot.make_register('alice', 5001))
+        self.assertEqual(other.recv(), 'NICKNAME_TAKEN')
+        self.assertTrue(other.closed())
+
+    def test_errors(self):
+        client = self.connect()
+        client.send('PORT alice 6000')
+        self.assertEqual(client.recv(), 'ERROR Invalid REGISTER format')
+        self.assertTrue(client.closed())
+        alice = self.register('alice', 5000, 6000)
+        alice.send('PORT bob 7000')
+        self.assertEqual(alice.recv(), 'ERROR Malformed PORT message or nickname mismatch')
+        alice.send('LEFT alice')
+        self.assertEqual(alice.recv(), 'ERROR JOINED/LEFT messages are server-generated only')
+        alice.send('BROADCAST')
+        self.assertEqual(alice.recv(), 'ERROR Unknown or unexpected command')
+
+    def test_empty_broadcast_dropped(self):
+        alice = self.register('alice', 5000, 6000)
+        alice.send('BROADCAST ')
+        alice.send(prot.make_broadcast('after'))
+        self.assertEqual(alice.recv(), 'BROADCAST after')
+
+    def test_v2_and_text_clients_mixed(self):
+        alice = self.register('alice', 5000, 6000)
+        bob = self.connect()
+        bob.send(prot.pack(prot.OP_REGISTER, 'bob', 5001, 6001, 0))
+        self.assertEqual(prot.parse(bob.recv()), prot.Welcome(prot.PROTOCOL_V2))
+        self.assertEqual(prot.parse(bob.recv()), prot.Joined('alice', '127.0.0.1', 5000, 6000, 0))
+        self.assertEqual(alice.recv(), 'JOINED bob 127.0.0.1 5001 6001')
+        bob.send(prot.pack(prot.OP_BROADCAST, 'hi'))
+        self.assertEqual(alice.recv(), 'BROADCAST hi')
+        self.assertEqual(prot.parse(bob.recv()), prot.Broadcast('hi'))
+        alice.close()
+        self.assertEqual(prot.parse(bob.recv()), prot.Left('alice'))
+
+    def test_rooms(self):
+        alice = self.connect()
+        alice.send(prot.pack(prot.OP_REGISTER, 'alice', 5000, 6000, 0))
+        self.assertEqual(prot.parse(alice.recv()), prot.Welcome(prot.PROTOCOL_V2))
+        alice.send(prot.pack(prot.OP_ROOM_JOIN, 'lobby', ''))
+        self.assertEqual(prot.parse(alice.recv()), prot.RoomJoin('lobby', 'alice'))
+        alice.send(prot.pack(prot.OP_ROOM_MSG, 'lobby', '', 'hi'))
+        self.assertEqual(prot.parse(alice.recv()), prot.RoomMsg('lobby', 'alice', 'hi'))
+        for op, args in ((prot.OP_ROOM_JOIN, ('',)), (prot.OP_ROOM_PART, ('x' * 65,)),
+                         (prot.OP_ROOM_MSG, (' lobby', 'hi'))):
+            alice.send(prot.pack(op, args[0], '', *args[1:]))
+            self.assertEqual(prot.parse(alice.recv()), prot.Error("Invalid room name"))
+        alice.send(prot.pack(prot.OP_ROOM_PART, 'lobby', ''))
+        self.assertEqual(prot.parse(alice.recv()), prot.RoomPart('lobby', 'alice'))
+
+class ThreadedEngineTest(EngineBehaviour, unittest.TestCase):
+    server_class = PeerServer
+
+class AsyncEngineTest(EngineBehaviour, unittest.TestCase):
+    server_class = AsyncPeerServer
+
+if __name__ == '__main__':
+    unittest.main()
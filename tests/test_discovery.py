@@ -0,0 +1,34 @@
+import time
+import unittest
+from client.core import PeerClient
+from tests.test_aio import free_port
+
+class LanDiscoveryTest(unittest.TestCase):
+    def setUp(self):
+        self.port = free_port()
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            if client.discovery is not None:
+                client.discovery.stop()
+
+    def start(self, nickname, udp_port) -> PeerClient:
+        client = PeerClient('127.0.0.1', 1, nickname, udp_port, udp_port + 1)
+        self.clients.append(client)
+        if client.start_discovery(port=self.port, min_interval=0.2, max_interval=30) is None:
+            self.skipTest("multicast is not available")
+        return client
+
+    def test_answers_reach_each_client_on_one_host(self):
+        alice = self.start('alice', 5000)
+        time.sleep(0.3)
+        alice.discovery.timer.cancel()  # from now on others learn alice only from her answers
+        others = [self.start(f'peer{i}', 6000 + 10 * i) for i in range(4)]
+        deadline = time.monotonic() + 5
+        while not all('alice' in c.peers for c in others) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual([c.peers.get('alice', ())[1:] for c in others], [(5000, 5001)] * 4)
+
+if __name__ == '__main__':
+    unittest.main()
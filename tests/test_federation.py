@@ -0,0 +1,57 @@
+import time
+import unittest
+import network.protocol as prot
+from server.federation import SeenCache, make_node
+from tests.test_aio import Client, ServerFixture
+
+class SeenCacheTest(unittest.TestCase):
+    def test_duplicates_and_bound(self):
+        seen = SeenCache(maxlen=2)
+        self.assertTrue(seen.add((1, 1)))
+        self.assertFalse(seen.add((1, 1)))
+        self.assertTrue(seen.add((1, 2)))
+        self.assertTrue(seen.add((2, 1)))  # forgets (1, 1)
+        self.assertFalse(seen.add((2, 1)))
+        self.assertTrue(seen.add((1, 1)))
+        self.assertEqual(len(seen.ids), 2)
+
+class NodeLinkTest(ServerFixture, unittest.TestCase):
+    def make_server(self, host, port):
+        return make_node("threads", [], host, port, node_id=5)
+
+    def hello(self) -> Client:
+        node = self.connect()
+        node.send(prot.pack(prot.OP_NODE_HELLO, 9, 'other', 1))
+        return node
+
+    def test_hello_refused_from_unknown_host(self):
+        alice = self.register('alice', 5000, 6000)
+        node = self.hello()
+        self.assertEqual(prot.parse(node.recv()), prot.Error("Not an allowed server node"))
+        self.assertTrue(node.closed())
+        self.assertEqual(self.server.links, set())
+        alice.send(prot.make_broadcast('still here'))
+        self.assertEqual(alice.recv(), 'BROADCAST still here')
+
+class AllowedNodeLinkTest(ServerFixture, unittest.TestCase):
+    def make_server(self, host, port):
+        return make_node("threads", [], host, port, node_id=5, allow=('127.0.0.1',))
+
+    def test_link_from_allowed_host(self):
+        self.register('alice', 5000, 6000)
+        node = self.connect()
+        node.send(prot.pack(prot.OP_NODE_HELLO, 9, 'other', 1))
+        self.assertEqual(prot.parse(node.recv()), prot.NodeHello(5, self.server.node_name, 0))
+        event = prot.parse(node.recv())
+        self.assertEqual((event.origin, event.owner), (5, 5))
+        self.assertEqual(prot.parse(event.payload).nickname, 'alice')
+        self.assertFalse(self.server.seen.add((event.origin, event.seq)))  # replayed ids are known
+        self.assertEqual(self.server.metrics.connections, 1)  # alice, not the link
+        node.close()
+        deadline = time.monotonic() + 5
+        while self.server.links and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.server.metrics.connections, 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+import socket
+import threading
+import time
+import unittest
+from unittest import mock
+from server.outbound import (OutboundQueue, TokenBucket, ThreadedConnection, SocketWriter,
+                             DROP_OLDEST, DISCONNECT, COALESCE)
+
+class TokenBucketTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 100.0
+        patcher = mock.patch('server.outbound.time.monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_burst_then_limited(self):
+        bucket = TokenBucket(rate=2, burst=3)
+        self.assertEqual([bucket.take() for _ in range(4)], [True, True, True, False])
+
+    def test_refill_at_rate(self):
+        bucket = TokenBucket(rate=2, burst=3)
+        for _ in range(3):
+            bucket.take()
+        self.now += 0.25
+        self.assertFalse(bucket.take())  # half a token
+        self.now += 0.25
+        self.assertTrue(bucket.take())
+        self.assertFalse(bucket.take())
+
+    def test_refill_capped_at_burst(self):
+        bucket = TokenBucket(rate=10, burst=2)
+        bucket.take()
+        self.now += 60
+        self.assertEqual([bucket.take() for _ in range(3)], [True, True, False])
+
+class OutboundQueueTest(unittest.TestCase):
+    def test_drop_oldest(self):
+        queue = OutboundQueue(2, DROP_OLDEST)
+        self.assertTrue(all(queue.push(frame) for frame in (b'1', b'2', b'3')))
+        self.assertEqual(queue.drain(), [b'2', b'3'])
+        self.assertEqual((len(queue), queue.dropped), (0, 1))
+
+    def test_disconnect(self):
+        queue = OutboundQueue(2, DISCONNECT)
+        self.assertTrue(queue.push(b'1'))
+        self.assertTrue(queue.push(b'2'))
+        self.assertFalse(queue.push(b'3'))
+        self.assertEqual(queue.dropped, 1)
+        self.assertEqual(queue.drain(), [b'1', b'2'])
+
+    def test_coalesce(self):
+        queue = OutboundQueue(3, COALESCE)
+        queue.push(b'joined bob', key='bob')
+        queue.push(b'broadcast')
+        queue.push(b'left bob', key='bob')  # replaces the queued update in place
+        queue.push(b'joined eve', key='eve')
+        self.assertEqual(queue.dropped, 1)
+        queue.push(b'joined amy', key='amy')  # full: the oldest goes, and its key with it
+        queue.push(b'left bob again', key='bob')
+        self.assertEqual(queue.drain(), [b'joined eve', b'joined amy', b'left bob again'])
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            OutboundQueue(2, 'block')
+
+def read_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        more = sock.recv(size - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+@unittest.skipUnless(SocketWriter.supported, "needs MSG_DONTWAIT")
+class SocketWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.writer = SocketWriter()
+        self.pairs = []
+
+    def tearDown(self):
+        for pair in self.pairs:
+            for sock in pair:
+                sock.close()
+
+    def connection(self, maxlen=1024, policy=DROP_OLDEST):
+        server, client = socket.socketpair()
+        client.settimeout(5)
+        self.pairs.append((server, client))
+        return ThreadedConnection(server, None, maxlen, policy, writer=self.writer), client
+
+    def test_close_flushes_then_closes(self):
+        conn, client = self.connection()
+        conn.send(b'one')
+        conn.send(b'two')
+        conn.close()
+        conn.send(b'ignored')
+        self.assertEqual(read_exactly(client, 7), b'onetwo')
+        self.assertEqual(client.recv(1), b'')
+
+    def test_stalled_client_does_not_block_others(self):
+        slow, _ = self.connection(maxlen=4, policy=DISCONNECT)
+        fast, client = self.connection()
+        frame = b'x' * 65536
+        for _ in range(200):  # far more than the socket buffers hold
+            slow.send(frame)
+            if slow.closed:
+                break
+        fast.send(b'ping')
+        self.assertEqual(read_exactly(client, 4), b'ping')
+        self.assertTrue(slow.overflowed)  # the queue policy still applies
+        deadline = time.monotonic() + 5
+        while self.writer.waiting and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.writer.waiting, set())
+
+    def test_one_thread_for_all_connections(self):
+        threads = threading.active_count()
+        connections = [self.connection() for _ in range(20)]
+        for conn, _ in connections:
+            conn.send(b'hello')
+        for _, client in connections:
+            self.assertEqual(read_exactly(client, 5), b'hello')
+        self.assertEqual(threading.active_count(), threads + 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import unittest
+import network.protocol as prot
+from network.tcp import encode_varint, decode_varint, decode_frame, encode_frame_v2, encode_message
+
+class VarintTest(unittest.TestCase):
+    def test_round_trip(self):
+        for value in (0, 1, 127, 128, 300, 16383, 16384, 2 ** 21, 2 ** 32 - 1):
+            data = encode_varint(value)
+            self.assertEqual(decode_varint(data), (value, len(data)))
+
+    def test_lengths(self):
+        self.assertEqual(encode_varint(127), b'\x7f')
+        self.assertEqual(encode_varint(128), b'\x80\x01')
+
+    def test_incomplete(self):
+        self.assertIsNone(decode_varint(b''))
+        self.assertIsNone(decode_varint(b'\x80\x80'))
+        self.assertIsNone(decode_varint(b'\x80\x01', 0, 1))
+
+    def test_too_long(self):
+        with self.assertRaises(ValueError):
+            decode_varint(b'\x80' * 6)
+
+    def test_offset(self):
+        self.assertEqual(decode_varint(b'xx\xac\x02', 2), (300, 4))
+
+class FrameTest(unittest.TestCase):
+    def test_v2_frame(self):
+        frame = encode_frame_v2(b'payload')
+        self.assertEqual(frame[0], 0xB2)
+        self.assertEqual(decode_frame(frame), b'payload')
+
+    def test_text_frame(self):
+        self.assertEqual(decode_frame(encode_message('LEFT bob')), 'LEFT bob')
+
+    def test_length_mismatch(self):
+        with self.assertRaises(ValueError):
+            decode_frame(encode_frame_v2(b'payload') + b'x')
+        with self.assertRaises(ValueError):
+            decode_frame(f"{-2:<10}".encode() + b'LEFT a')
+
+    def test_encode_versions(self):
+        self.assertEqual(prot.encode(prot.PROTOCOL_V1, prot.OP_LEFT, 'bob'), encode_message('LEFT bob'))
+        self.assertEqual(prot.encode(prot.PROTOCOL_V2, prot.OP_LEFT, 'bob'), encode_frame_v2(prot.pack(prot.OP_LEFT, 'bob')))
+        # Text clients only know JOINED without flags
+        frame = prot.encode(prot.PROTOCOL_V1, prot.OP_JOINED, 'bob', '10.0.0.2', 1, 2, prot.FLAG_V2)
+        self.assertEqual(decode_frame(frame), 'JOINED bob 10.0.0.2 1 2')
+
+class PackTest(unittest.TestCase):
+    def test_round_trip(self):
+        cases = [
+            (prot.OP_REGISTER, ('alice smith', 5000, 5001, prot.FLAG_V2, 7, 3)),
+            (prot.OP_JOINED, ('bob', '10.0.0.2', 5000, 5001, prot.FLAG_V2)),
+            (prot.OP_JOINED, ('bob', '::1', 5000, 5001, 0)),
+            (prot.OP_CHAT_MSG, ('carol', 'héllo wörld')),
+            (prot.OP_ANNOUNCE, ('dave', 1, 2, prot.FLAG_REPLY, 123456, 300, 60)),
+            (prot.OP_STREAM, (1, prot.STREAM_END, prot.OP_CHAT_MSG, b'\x00\xff')),
+            (prot.OP_PING, ()),
+        ]
+        for op, fields in cases:
+            with self.subTest(op=prot.OP_NAMES[op]):
+                self.assertEqual(prot.unpack(prot.pack(op, *fields)), (op, fields))
+
+    def test_roster_fields(self):
+        entries = [('a', '10.0.0.1', 1, 2, 0), ('b', '10.0.0.2', 3, 4, prot.FLAG_V2)]
+        changes = [(prot.CHANGE_JOIN, 'c', '10.0.0.3', 5, 6, 0), (prot.CHANGE_LEAVE, 'a'), (prot.CHANGE_PORT, 'b', 9)]
+        self.assertEqual(prot.unpack(prot.pack(prot.OP_ROSTER, 1, 2, entries)), (prot.OP_ROSTER, (1, 2, entries)))
+        payload = prot.pack(prot.OP_ROSTER_DELTA, 1, 2, 3, changes)
+        self.assertEqual(prot.unpack(payload), (prot.OP_ROSTER_DELTA, (1, 2, 3, changes)))
+
+    def test_missing_trailing_fields(self):
+        # Older senders omit fields added later; they decode as None
+        payload = prot.pack(prot.OP_REGISTER, 'alice', 5000)
+        self.assertEqual(prot.unpack(payload), (prot.OP_REGISTER, ('alice', 5000, None, None, None, None)))
+
+    def test_malformed(self):
+        with self.assertRaises(ValueError):
+            prot.unpack(b'')
+        with self.assertRaises(ValueError):
+            prot.unpack(b'\xee')
+        truncated = prot.pack(prot.OP_CHAT_MSG, 'carol', 'hello')[:-2]
+        with self.assertRaises(ValueError):
+            prot.unpack(truncated)
+        truncated = prot.pack(prot.OP_ROSTER, 1, 2, [('a', '10.0.0.1', 1, 2, 0)])[:-3]
+        with self.assertRaises(ValueError):
+            prot.unpack(truncated)
+
+class ParseTest(unittest.TestCase):
+    def test_text(self):
+        self.assertEqual(prot.parse('REGISTER "alice smith" 5000'), prot.Register('alice smith', 5000))
+        self.assertEqual(prot.parse('JOINED bob 10.0.0.2 5000 5001'), prot.Joined('bob', '10.0.0.2', 5000, 5001))
+        self.assertEqual(prot.parse('CHAT_MSG "carol" hi there'), prot.ChatMsg('carol', 'hi there'))
+        self.assertEqual(prot.parse('NICKNAME_TAKEN'), prot.NicknameTaken())
+
+    def test_v2(self):
+        record = prot.parse(prot.pack(prot.OP_JOINED, 'bob', '10.0.0.2', 5000, 5001, prot.FLAG_V2))
+        self.assertEqual(record, prot.Joined('bob', '10.0.0.2', 5000, 5001, prot.FLAG_V2))
+        self.assertEqual(record.op, prot.OP_JOINED)
+
+    def test_unknown_and_malformed(self):
+        self.assertIsInstance(prot.parse('HELLO world'), prot.Unknown)
+        self.assertIsInstance(prot.parse('BROADCAST'), prot.Unknown)  # the space is part of the command
+        self.assertEqual(prot.parse('BROADCAST '), prot.Broadcast(''))
+        self.assertIsInstance(prot.parse(b'\xee\x00'), prot.Unknown)
+        self.assertEqual(prot.parse('PORT bob notaport').op, prot.OP_MALFORMED)
+        self.assertEqual(prot.parse(prot.pack(prot.OP_CHAT_MSG, 'carol', 'hi')[:-1]).op, prot.OP_MALFORMED)
+        # Required fields missing from a v2 payload
+        self.assertEqual(prot.parse(bytes((prot.OP_JOINED,))).op, prot.OP_MALFORMED)
+
+    def test_dispatcher(self):
+        calls = []
+        dispatcher = prot.Dispatcher(default=lambda conn, record: calls.append(('default', record.op)))
+        dispatcher.register(prot.OP_LEFT, lambda conn, record: calls.append((conn, record.nickname)))
+        dispatcher.dispatch(prot.Left('bob'), 'conn')
+        dispatcher.dispatch(prot.Ping(), 'conn')
+        self.assertEqual(calls, [('conn', 'bob'), ('default', prot.OP_PING)])
+
+if __name__ == '__main__':
+    unittest.main()
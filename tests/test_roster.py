@@ -0,0 +1,58 @@
+import unittest
+import network.protocol as prot
+from server.roster import Roster
+
+BOB = ('bob', '10.0.0.2', 5000, 5001, prot.FLAG_V2)
+EVE = ('eve', '10.0.0.3', 6000, 6001, 0)
+
+class RosterTest(unittest.TestCase):
+    def test_flush_publishes_batch(self):
+        roster = Roster()
+        self.assertIsNone(roster.flush())
+        roster.join(BOB, owner='c1')
+        roster.join(EVE, owner='c2')
+        self.assertEqual(roster.flush(), (0, 1, [(prot.CHANGE_JOIN,) + BOB, (prot.CHANGE_JOIN,) + EVE]))
+        self.assertEqual(roster.snapshot(), (roster.epoch, 1, [BOB, EVE]))
+
+    def test_join_and_leave_in_one_window_cancel(self):
+        roster = Roster()
+        roster.join(BOB, owner='c1')
+        roster.leave('bob', owner='c1')
+        self.assertIsNone(roster.flush())
+
+    def test_leave_of_replaced_owner_ignored(self):
+        roster = Roster()
+        roster.join(BOB, owner='old')
+        roster.flush()
+        roster.join(BOB, owner='new')
+        roster.leave('bob', owner='old')
+        self.assertEqual(roster.flush()[2], [(prot.CHANGE_JOIN,) + BOB])
+        roster.leave('bob', owner='new')
+        self.assertEqual(roster.flush()[2], [(prot.CHANGE_LEAVE, 'bob')])
+        self.assertEqual(roster.snapshot()[2], [])
+
+    def test_port_changes(self):
+        roster = Roster()
+        roster.join(BOB, owner='c1')
+        roster.port('bob', 7000)  # folded into the pending join
+        self.assertEqual(roster.flush()[2], [(prot.CHANGE_JOIN, 'bob', '10.0.0.2', 5000, 7000, prot.FLAG_V2)])
+        roster.port('bob', 7001)
+        self.assertEqual(roster.flush()[2], [(prot.CHANGE_PORT, 'bob', 7001)])
+        self.assertEqual(roster.snapshot()[2], [('bob', '10.0.0.2', 5000, 7001, prot.FLAG_V2)])
+
+    def test_since(self):
+        roster = Roster(history=2)
+        for entry in (BOB, EVE):
+            roster.join(entry)
+            roster.flush()
+        roster.leave('bob')
+        roster.flush()
+        self.assertEqual(roster.since(roster.epoch, 3), [])
+        self.assertEqual(roster.since(roster.epoch, 1), [(prot.CHANGE_JOIN,) + EVE, (prot.CHANGE_LEAVE, 'bob')])
+        self.assertIsNone(roster.since(roster.epoch, 0))   # older than the changelog
+        self.assertIsNone(roster.since(roster.epoch, 4))   # from the future
+        self.assertIsNone(roster.since(roster.epoch + 1, 2))  # another server run
+        self.assertIsNone(roster.since(roster.epoch, None))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,193 @@
+import unittest
+from network import rudp
+
+class FakeTimer:
+    def __init__(self, fn, args):
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class FakeLoop:
+    """Runs call_soon at once and keeps call_later timers until fire() is called."""
+
+    def __init__(self):
+        self.timers = []
+
+    def in_loop(self):
+        return True
+
+    def call_soon(self, fn, *args):
+        fn(*args)
+
+    def call_later(self, delay, fn, *args):
+        timer = FakeTimer(fn, args)
+        self.timers.append(timer)
+        return timer
+
+    def fire(self, name=None):
+        """Run the pending timers, or only those calling the method of that name. Returns how many ran."""
+        timers, self.timers = self.timers, []
+        ran = 0
+        for timer in timers:
+            if timer.cancelled:
+                continue
+            if name is None or timer.fn.__name__ == name:
+                timer.fn(*timer.args)
+                ran += 1
+            else:
+                self.timers.append(timer)
+        return ran
+
+class Wire:
+    """The UDP socket of one endpoint: sent packets are queued until delivered."""
+
+    def __init__(self):
+        self.packets = []
+
+    def sendto(self, packet, addr):
+        self.packets.append(packet)
+
+class Transport:
+    def __init__(self):
+        self.sock = Wire()
+
+A, B = ('10.0.0.1', 1000), ('10.0.0.2', 2000)
+
+class ReliableUdpTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = FakeLoop()
+        self.received, self.closed = [], []
+        self.a = rudp.ReliableUdp(Transport(), self.loop, self._on_message, self._on_close, mss=10)
+        self.b = rudp.ReliableUdp(Transport(), self.loop, self._on_message, self._on_close, mss=10)
+
+    def _on_message(self, addr, channel, message):
+        self.received.append((addr, message))
+
+    def _on_close(self, addr, channel, reason):
+        self.closed.append((addr, reason))
+
+    def deliver(self, drop=()):
+        """Move queued packets both ways until none are left; drop the DATA sequence numbers given once.
+
+        Paced segments are sent right away; retransmission timeouts never fire here.
+        """
+        drop = set(drop)
+        moved = True
+        while moved:
+            moved = self.loop.fire('_paced') > 0
+            for src, dst, src_addr in ((self.a, self.b, A), (self.b, self.a, B)):
+                packets, src.transport.sock.packets = src.transport.sock.packets, []
+                for packet in packets:
+                    moved = True
+                    if packet[1] == rudp.DATA:
+                        seq = rudp.DATA_HEADER.unpack_from(packet)[3]
+                        if seq in drop:
+                            drop.discard(seq)
+                            continue
+                    dst.receive(src_addr, packet)
+                dst.flush()
+
+    def data_sent(self):
+        return [rudp.DATA_HEADER.unpack_from(p)[3] for p in self.a.transport.sock.packets if p[1] == rudp.DATA]
+
+    def test_message_segmented_and_delivered(self):
+        channel = self.a.channel(B)
+        message = bytes(range(45))
+        channel.sendall(message)
+        self.assertEqual(self.data_sent(), [0, 1, 2, 3])  # the initial window
+        self.deliver()
+        self.assertEqual(self.received, [(A, message)])
+        self.assertEqual((channel.acked, channel.in_flight, len(channel.unacked)), (5, 0, 0))
+        self.assertIsNotNone(channel.srtt)
+
+    def test_messages_in_order(self):
+        channel = self.a.channel(B)
+        for text in (b'one', b'', b'three' * 5):
+            channel.sendall(text)
+        self.deliver()
+        self.assertEqual([m for _, m in self.received], [b'one', b'', b'three' * 5])
+
+    def test_fast_retransmit(self):
+        channel = self.a.channel(B)
+        channel.sendall(b'x' * 80)  # 8 segments
+        self.deliver(drop=[1])
+        self.assertEqual(self.received, [(A, b'x' * 80)])
+        self.assertEqual(channel.acked, 8)
+        self.assertEqual(channel.timeouts, 0)  # recovered without waiting for the timeout
+        self.assertLess(channel.cwnd, 8)  # halved on loss
+
+    def test_retransmit_on_timeout(self):
+        channel = self.a.channel(B)
+        channel.sendall(b'short')
+        self.a.transport.sock.packets.clear()  # lost
+        self.loop.fire('_on_rto')
+        self.assertEqual(channel.timeouts, 1)
+        self.assertEqual(channel.cwnd, 1.0)
+        self.assertEqual(channel.rto, 2.0)
+        self.deliver()
+        self.assertEqual(self.received, [(A, b'short')])
+        self.assertEqual(channel.timeouts, 0)
+
+    def test_stale_ack_ignored(self):
+        channel = self.a.channel(B)
+        channel.sendall(b'y' * 30)
+        self.deliver()
+        channel.sendall(b'z')
+        stale = rudp.ACK_HEADER.pack(rudp.RUDP_MAGIC, rudp.ACK, channel.send_conn, 1, 0)
+        self.a.receive(B, stale)
+        self.assertEqual(channel.acked, 3)
+        self.assertFalse(channel.finished)
+        self.assertEqual(self.closed, [])
+        self.deliver()
+        self.assertEqual([m for _, m in self.received], [b'y' * 30, b'z'])
+
+    def test_duplicate_data_delivered_once(self):
+        channel = self.a.channel(B)
+        channel.sendall(b'once')
+        packet = self.a.transport.sock.packets[0]
+        self.deliver()
+        self.b.receive(A, packet)
+        self.b.flush()
+        self.assertEqual(self.received, [(A, b'once')])
+
+    def test_close_after_delivery(self):
+        channel = self.a.channel(B)
+        channel.sendall(b'bye')
+        channel.close()
+        self.assertFalse(channel.finished)  # waits for the ack
+        self.deliver()
+        self.assertTrue(channel.finished)
+        self.assertNotIn(B, self.a.channels)
+        self.assertNotIn(A, self.b.channels)
+        self.assertEqual(self.received, [(A, b'bye')])
+        self.assertEqual(self.closed, [(A, "Peer closed the connection")])
+        with self.assertRaises(OSError):
+            channel.sendall(b'more')
+
+    def test_gives_up_after_timeouts(self):
+        channel = self.a.channel(B)
+        channel.sendall(b'lost')
+        for _ in range(rudp.MAX_TIMEOUTS + 1):
+            self.a.transport.sock.packets.clear()
+            self.loop.fire('_on_rto')
+        self.assertTrue(channel.finished)
+        self.assertEqual(self.closed, [(B, "Peer stopped answering")])
+
+    def test_unknown_stream_reset(self):
+        packet = rudp.DATA_HEADER.pack(rudp.RUDP_MAGIC, rudp.DATA, 42, rudp.WINDOW + 5, rudp.FLAG_END)
+        self.b.receive(A, packet + b'x')
+        reply = self.b.transport.sock.packets
+        self.assertEqual(reply, [rudp.CLOSE_PACKET.pack(rudp.RUDP_MAGIC, rudp.CLOSE, 42)])
+        self.assertEqual(self.received, [])
+
+    def test_truncated_packets_ignored(self):
+        for packet in (bytes((rudp.RUDP_MAGIC,)), bytes((rudp.RUDP_MAGIC, rudp.DATA, 0)),
+                       bytes((rudp.RUDP_MAGIC, rudp.ACK)), bytes((rudp.RUDP_MAGIC, rudp.CLOSE, 1))):
+            self.b.receive(A, packet)
+        self.assertEqual((self.received, self.closed), ([], []))
+
+if __name__ == '__main__':
+    unittest.main()
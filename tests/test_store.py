@@ -0,0 +1,52 @@
+import os
+import tempfile
+import unittest
+from client import store
+from client.store import MessageLog, identity_path
+
+class MessageLogTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.log = MessageLog(self.dir.name, segment_size=200)
+
+    def tearDown(self):
+        self.log.close()
+        self.dir.cleanup()
+
+    def test_last_with_times_out_of_order(self):
+        for i, t in enumerate((1, 2, 4, 3, 5, 6)):
+            self.log.append('bob', 'bob', f'm{i}', t=t)
+        self.log.append('eve', 'eve', 'other', t=3.5)
+        self.log.flush()
+        self.assertEqual([m for _, _, m in self.log.last('bob', 3)], ['m3', 'm4', 'm5'])
+        self.assertEqual([m for _, _, m in self.log.last('bob', 3, before=5)], ['m1', 'm2', 'm3'])
+        self.assertEqual([m for _, _, m in self.log.last('bob', 10, before=3.5)], ['m0', 'm1', 'm3'])
+        self.assertEqual(self.log.last('nobody', 3), [])
+
+    def test_search_newest_first_across_segments(self):
+        for i in range(20):
+            self.log.append('bob' if i % 2 else 'eve', 'x', f'note {i} ' + 'pad' * i, t=i)
+        self.log.flush()
+        self.assertGreater(len(self.log._segments()), 2)
+        self.assertEqual([t for _, t, _, _ in self.log.search('note', limit=3)], [19, 18, 17])
+        self.assertEqual([t for _, t, _, _ in self.log.search('NOTE', peer='eve', limit=2)], [18, 16])
+        self.assertEqual(self.log.search('missing'), [])
+
+    def test_lines_reversed(self):
+        path = os.path.join(self.dir.name, 'lines')
+        with open(path, 'wb') as f:
+            f.write(b'one\ntwo longer line\n\nthree\n')
+        with open(path, 'rb') as f:
+            self.assertEqual(list(store._lines_reversed(f, block=4)), [b'three', b'two longer line', b'one'])
+
+class IdentityPathTest(unittest.TestCase):
+    def test_plain_names_kept_others_hashed(self):
+        self.assertEqual(identity_path('root', 'alice_1'), os.path.join('root', 'alice_1'))
+        for nickname in ('..', '../x', '/etc', 'a b', 'x' * 65):
+            path = identity_path('root', nickname)
+            self.assertEqual(os.path.dirname(path), 'root')
+            self.assertTrue(os.path.basename(path).startswith('id-'))
+        self.assertNotEqual(identity_path('root', '../a'), identity_path('root', '../b'))
+
+if __name__ == '__main__':
+    unittest.main()
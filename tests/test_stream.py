@@ -0,0 +1,108 @@
+import socket
+import threading
+import unittest
+import network.protocol as prot
+from network.stream import FrameWriter, StreamReceiver, chunks_of
+from network.tcp import FramedReader, FrameTooLarge
+from client.core import PeerClient
+
+def chunk(stream, data, end=False, kind=prot.OP_CHAT_MSG):
+    return prot.Stream(stream, prot.STREAM_END if end else 0, kind, data)
+
+class StreamReceiverTest(unittest.TestCase):
+    def test_reassembles_interleaved_streams(self):
+        receiver = StreamReceiver()
+        self.assertIsNone(receiver.feed(chunk(1, b'ab')))
+        self.assertIsNone(receiver.feed(chunk(2, b'xy')))
+        self.assertEqual(receiver.feed(chunk(1, b'cd', end=True)), (prot.OP_CHAT_MSG, b'abcd'))
+        self.assertEqual(receiver.feed(chunk(2, b'', end=True)), (prot.OP_CHAT_MSG, b'xy'))
+        self.assertEqual(receiver.streams, {})
+
+    def test_limits(self):
+        receiver = StreamReceiver(max_message=4, max_streams=1)
+        receiver.feed(chunk(1, b'abc'))
+        with self.assertRaises(ValueError):
+            receiver.feed(chunk(2, b'x'))
+        with self.assertRaises(FrameTooLarge):
+            receiver.feed(chunk(1, b'de'))
+        self.assertEqual(receiver.streams, {})
+
+    def test_consumer(self):
+        received = []
+        def consumer():
+            while True:
+                data = yield
+                received.append(data)
+                if data is None:
+                    return
+        receiver = StreamReceiver(open_consumer=lambda op: consumer() if op == prot.OP_CHAT_MSG else None)
+        receiver.feed(chunk(1, b'ab'))
+        self.assertIsNone(receiver.feed(chunk(1, b'cd', end=True)))
+        self.assertEqual(received, [b'ab', b'cd', None])
+        # Other opcodes are still reassembled
+        self.assertEqual(receiver.feed(chunk(2, b'q', end=True, kind=prot.OP_BROADCAST)), (prot.OP_BROADCAST, b'q'))
+
+    def test_close_aborts_consumers(self):
+        closed = []
+        def consumer():
+            try:
+                while True:
+                    yield
+            finally:
+                closed.append(True)
+        receiver = StreamReceiver(open_consumer=lambda op: consumer())
+        receiver.feed(chunk(1, b'ab'))
+        receiver.close()
+        self.assertEqual((closed, receiver.streams), ([True], {}))
+
+class FrameWriterTest(unittest.TestCase):
+    def test_stream_round_trip(self):
+        a, b = socket.socketpair()
+        with a, b:
+            data = bytes(range(256)) * 300
+            writer = FrameWriter(a)
+            thread = threading.Thread(target=writer.send_stream, args=(prot.OP_CHAT_MSG, chunks_of(data, 1000)))
+            thread.start()
+            reader, receiver, message = FramedReader(b), StreamReceiver(), None
+            while message is None:
+                message = receiver.feed(prot.parse(reader.recv()))
+            thread.join()
+            self.assertEqual(message, (prot.OP_CHAT_MSG, data))
+
+    def test_chunks_of(self):
+        self.assertEqual([bytes(c) for c in chunks_of(b'abcde', 2)], [b'ab', b'cd', b'e'])
+        self.assertEqual(list(chunks_of(b'', 2)), [])
+
+class MessageSizeTest(unittest.TestCase):
+    def setUp(self):
+        self.client = PeerClient('127.0.0.1', 1, 'alice', 0)
+        self.errors = []
+        self.client.callbacks['on_error'] = self.errors.append
+        self.sock, self.peer = socket.socketpair()
+        self.peer.settimeout(5)
+
+    def tearDown(self):
+        self.sock.close()
+        self.peer.close()
+
+    def test_long_message_to_v1_peer_in_one_frame(self):
+        text = 'x' * (self.client.stream_threshold * 2)
+        self.client.send_message_to_peer(self.sock, text)
+        self.assertEqual(self.errors, [])
+        self.assertEqual(prot.parse(FramedReader(self.peer).recv()), prot.ChatMsg('alice', text))
+        self.client.max_frame = 1000
+        self.client.send_message_to_peer(self.sock, text)
+        self.assertEqual(len(self.errors), 1)
+        self.assertIn('Message too long', self.errors[0])
+
+    def test_oversized_broadcast_not_sent(self):
+        self.client.server_sock = self.sock
+        self.client.server_version = prot.PROTOCOL_V2
+        self.client.send_broadcast('y' * self.client.max_server_frame)
+        self.assertEqual(len(self.errors), 1)
+        self.assertIn('Broadcast too long', self.errors[0])
+        self.client.send_broadcast('short')
+        self.assertEqual(prot.parse(FramedReader(self.peer).recv()), prot.Broadcast('short'))
+
+if __name__ == '__main__':
+    unittest.main()
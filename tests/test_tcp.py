@@ -0,0 +1,109 @@
+import asyncio
+import socket
+import unittest
+from network.tcp import (FramedReader, FrameTooLarge, encode_frame_v2, encode_message, encode_varint,
+                         recv_message, recv_message_async)
+
+class ChunkedConn:
+    """Stands in for a socket whose recv_into returns the given chunks one per call."""
+
+    def __init__(self, *chunks):
+        self.chunks = [bytes(c) for c in chunks]
+        self.calls = 0
+
+    def recv_into(self, view):
+        self.calls += 1
+        if not self.chunks:
+            return 0
+        chunk = self.chunks.pop(0)
+        n = min(len(view), len(chunk))
+        view[:n] = chunk[:n]
+        if n < len(chunk):
+            self.chunks.insert(0, chunk[n:])
+        return n
+
+class FramedReaderTest(unittest.TestCase):
+    def test_many_frames_in_one_recv(self):
+        data = encode_message('LEFT a') + encode_frame_v2(b'\x01\x02') + encode_message('LEFT b')
+        reader = FramedReader(ChunkedConn(data))
+        self.assertEqual(reader.read_frames(), ['LEFT a', b'\x01\x02', 'LEFT b'])
+        self.assertEqual((reader.start, reader.end), (0, 0))
+
+    def test_frames_split_byte_by_byte(self):
+        data = encode_frame_v2(b'x' * 200) + encode_message('PING')
+        conn = ChunkedConn(*(data[i:i + 1] for i in range(len(data))))
+        reader = FramedReader(conn)
+        self.assertEqual(reader.recv(), b'x' * 200)
+        self.assertEqual(reader.recv(), 'PING')
+        self.assertEqual(conn.calls, len(data))
+
+    def test_compaction_keeps_partial_frame(self):
+        # Frames straddle the end of a small buffer; the tail is moved to the front, not grown
+        frame = encode_frame_v2(b'y' * 20)
+        reader = FramedReader(ChunkedConn(frame * 10), bufsize=32)
+        frames = []
+        while len(frames) < 10:
+            frames += reader.read_frames()
+        self.assertEqual(frames, [b'y' * 20] * 10)
+        self.assertEqual(len(reader.buf), 32)
+
+    def test_large_frame_grows_then_shrinks(self):
+        big = b'z' * 1000
+        reader = FramedReader(ChunkedConn(encode_frame_v2(big), encode_message('LEFT a')), bufsize=64)
+        self.assertEqual(reader.recv(), big)
+        self.assertEqual(len(reader.buf), 64)  # the large buffer was given back
+        self.assertEqual(reader.recv(), 'LEFT a')
+
+    def test_max_frame(self):
+        header = bytes((0xB2,)) + encode_varint(10 ** 6)
+        reader = FramedReader(ChunkedConn(header), max_frame=1000)
+        with self.assertRaises(FrameTooLarge):
+            reader.recv()
+        self.assertLess(len(reader.buf), 10 ** 6)  # rejected before reserving memory
+        reader = FramedReader(ChunkedConn(f"{5000:<10}".encode()), max_frame=1000)
+        with self.assertRaises(FrameTooLarge):
+            reader.recv()
+
+    def test_negative_length(self):
+        reader = FramedReader(ChunkedConn(f"{-5:<10}".encode() + b'LEFT a'))
+        with self.assertRaises(ValueError):
+            reader.recv()
+        self.assertEqual(reader.start, 0)
+
+    def test_closed_connection(self):
+        reader = FramedReader(ChunkedConn(encode_message('LEFT a')[:5]))
+        with self.assertRaises(ConnectionError):
+            reader.recv()
+
+class RecvMessageTest(unittest.TestCase):
+    def test_blocking(self):
+        a, b = socket.socketpair()
+        with a, b:
+            a.sendall(encode_frame_v2(b'\x05hi') + encode_message('LEFT a') + encode_frame_v2(b'x' * 2000))
+            self.assertEqual(recv_message(b), b'\x05hi')
+            self.assertEqual(recv_message(b), 'LEFT a')
+            with self.assertRaises(FrameTooLarge):
+                recv_message(b, max_frame=1000)
+
+    def test_negative_length(self):
+        a, b = socket.socketpair()
+        with a, b:
+            a.sendall(f"{-5:<10}".encode() + b'LEFT a')
+            with self.assertRaises(ValueError):
+                recv_message(b)
+
+    def test_async(self):
+        async def read(data, **kwargs):
+            reader = asyncio.StreamReader()
+            reader.feed_data(data)
+            reader.feed_eof()
+            return await recv_message_async(reader, **kwargs)
+        self.assertEqual(asyncio.run(read(encode_frame_v2(b'abc'))), b'abc')
+        self.assertEqual(asyncio.run(read(encode_message('LEFT a'))), 'LEFT a')
+        with self.assertRaises(ValueError):
+            asyncio.run(read(f"{-5:<10}".encode() + b'LEFT a'))
+        with self.assertRaises(FrameTooLarge):
+            asyncio.run(read(encode_message('x' * 50), max_frame=10))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import os
+import socket
+import tempfile
+import threading
+import unittest
+import network.protocol as prot
+from network.tcp import FramedReader
+from client.transfer import CHUNK_SIZE_MAX, FileReceiver
+
+class Callbacks:
+    def __init__(self):
+        self.calls = []
+        self.done = threading.Event()
+
+    def _cb(self, name, *args):
+        self.calls.append((name, args))
+        if name in ('on_error', 'on_file_received'):
+            self.done.set()
+
+class FileReceiverTest(unittest.TestCase):
+    def setUp(self):
+        self.client = Callbacks()
+        self.sock, self.peer = socket.socketpair()
+        self.peer.settimeout(5)
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.peer.close()
+        self.dir.cleanup()
+
+    def receive(self, size, chunk_size):
+        offer = prot.FileOffer('bob', 7, 'notes.txt', size, chunk_size)
+        FileReceiver(self.client, ('127.0.0.1', 1), self.sock, offer, self.dir.name).respond(True)
+
+    def test_invalid_chunk_size_refused(self):
+        self.receive(10, 0)
+        self.assertTrue(self.client.done.wait(5))
+        self.assertEqual(self.client.calls, [('on_error', ("Receiving notes.txt failed: Invalid chunk size 0",))])
+        self.assertEqual(self.peer.recv(1), b'')  # closed without accepting
+        self.assertEqual(os.listdir(self.dir.name), [])
+
+    def test_oversized_chunk_size_refused(self):
+        self.receive(10, CHUNK_SIZE_MAX + 1)
+        self.assertTrue(self.client.done.wait(5))
+        self.assertEqual(self.peer.recv(1), b'')
+
+    def test_silent_sender_times_out(self):
+        self.receive(10, 4)
+        self.assertEqual(prot.parse(FramedReader(self.peer).recv()), prot.FileAccept(7, 0))
+        self.assertIsNotNone(self.sock.gettimeout())
+
+if __name__ == '__main__':
+    unittest.main()
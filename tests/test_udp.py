@@ -0,0 +1,82 @@
+import socket
+import time
+import unittest
+from network.udp import UdpTransport, FRAGMENT_HEADER, FRAGMENT_MAGIC
+
+class FragmentationTest(unittest.TestCase):
+    def setUp(self):
+        self.receiver = UdpTransport(0, '127.0.0.1', mtu=100)
+        self.sender = UdpTransport(0, '127.0.0.1', mtu=100)
+        self.addr = ('127.0.0.1', self.receiver.port)
+
+    def tearDown(self):
+        self.receiver.close()
+        self.sender.close()
+
+    def receive(self, expected: int):
+        """Collect expected messages (each batch returns what is queued so far)."""
+        messages, deadline = [], time.monotonic() + 2
+        while len(messages) < expected and time.monotonic() < deadline:
+            messages += [message for _, message in self.receiver.recv_batch()]
+        return messages
+
+    def send_raw(self, datagrams):
+        for datagram in datagrams:
+            self.sender.sock.sendto(datagram, self.addr)
+
+    def test_small_message_is_one_plain_datagram(self):
+        self.assertEqual(self.sender._datagrams(b'hello'), [b'hello'])
+        self.sender.send(self.addr, 'hello')
+        self.assertEqual(self.receive(1), [b'hello'])
+
+    def test_fragments_reassembled(self):
+        data = bytes(range(256)) * 4
+        datagrams = self.sender._datagrams(data)
+        self.assertGreater(len(datagrams), 1)
+        self.assertTrue(all(len(d) <= 100 and d[0] == FRAGMENT_MAGIC for d in datagrams))
+        self.sender.send(self.addr, data)
+        self.assertEqual(self.receive(1), [data])
+        self.assertEqual((self.receiver.partial, self.receiver.pending_bytes), ({}, 0))
+
+    def test_reordered_and_duplicated_fragments(self):
+        data = b'abcdefghij' * 30
+        datagrams = self.sender._datagrams(data)
+        # Reversed, with a duplicate in the middle and one after completion
+        self.send_raw(datagrams[::-1][:2] + datagrams[-1:] + datagrams[::-1][2:] + datagrams[:1])
+        self.sender.send(self.addr, b'after')
+        self.assertEqual(self.receive(2), [data, b'after'])
+
+    def test_incomplete_message_expires(self):
+        self.receiver.reassembly_timeout = 0.0
+        datagrams = self.sender._datagrams(b'q' * 500)
+        self.send_raw(datagrams[:-1])
+        time.sleep(0.05)
+        self.assertEqual(self.receiver.recv_batch(), [])
+        self.assertEqual((self.receiver.partial, self.receiver.pending_bytes), ({}, 0))
+
+    def test_pending_bytes_bounded(self):
+        self.receiver.max_pending = 300
+        first = self.sender._datagrams(b'1' * 1000)
+        second = self.sender._datagrams(b'2' * 1000)
+        self.send_raw(first[:-1])
+        self.send_raw(second[:2])
+        time.sleep(0.05)
+        self.receiver.recv_batch()
+        self.assertLessEqual(self.receiver.pending_bytes, 300)
+        # The oldest partial message was dropped; its last fragment completes nothing
+        self.send_raw(first[-1:])
+        time.sleep(0.05)
+        self.assertEqual(self.receiver.recv_batch(), [])
+
+    def test_bad_fragment_header(self):
+        header = FRAGMENT_HEADER.pack(FRAGMENT_MAGIC, 1, 3, 2)  # index beyond count
+        self.send_raw([header + b'x'])
+        self.sender.send(self.addr, b'ok')
+        self.assertEqual(self.receive(1), [b'ok'])
+
+    def test_message_ids_differ(self):
+        ids = {FRAGMENT_HEADER.unpack_from(self.sender._datagrams(b'x' * 300)[0])[1] for _ in range(3)}
+        self.assertEqual(len(ids), 3)
+
+if __name__ == '__main__':
+    unittest.main()